@@ -1,9 +1,16 @@
+import http.client
 import json
 import os
+import random
+import threading
 import time
-import urllib.request
+import zlib
+from collections import deque
+from dataclasses import dataclass, field
+from email.utils import parsedate_to_datetime
 from pathlib import Path
-from urllib.error import HTTPError, URLError
+from typing import NamedTuple
+from urllib.parse import urljoin, urlsplit
 
 
 # -------- Paths --------
@@ -15,6 +22,503 @@ class AmoClientError(Exception):
     pass
 
 
+def max_rps_from_env() -> float:
+    """
+    Потолок запросов в секунду к одному аккаунту amoCRM.
+    Env: AMOCRM_MAX_RPS (число). Если не задан — 7 (лимит amoCRM на интеграцию).
+    """
+    raw = (os.getenv("AMOCRM_MAX_RPS") or "").strip()
+    if not raw:
+        return 7.0
+    try:
+        v = float(raw)
+    except ValueError as e:
+        raise AmoClientError(f"AMOCRM_MAX_RPS должен быть числом, получено: {raw!r}") from e
+    if v <= 0:
+        raise AmoClientError("AMOCRM_MAX_RPS должен быть > 0")
+    return v
+
+
+def _rate_burst_from_env() -> int:
+    """
+    Ёмкость token bucket (сколько запросов можно отправить подряд без паузы).
+    Env: AMOCRM_RATE_BURST (целое). Если не задан — 1: запросы равномерно
+    разнесены по времени, что безопасно и для скользящего окна amoCRM.
+    """
+    raw = (os.getenv("AMOCRM_RATE_BURST") or "").strip()
+    if not raw:
+        return 1
+    try:
+        n = int(raw)
+    except ValueError as e:
+        raise AmoClientError(f"AMOCRM_RATE_BURST должен быть целым числом, получено: {raw!r}") from e
+    return max(1, n)
+
+
+class TokenBucket:
+    """
+    Потокобезопасный token bucket: в среднем не больше rps запросов в секунду,
+    подряд — не больше burst.
+
+    Один bucket на аккаунт делят все потоки (см. AmoSession.limiter), поэтому
+    pause() после 429 / Retry-After останавливает сразу всех, а не только поток,
+    получивший отказ.
+    """
+
+    def __init__(self, rps: float, burst: int = 1):
+        if rps <= 0:
+            raise AmoClientError("rps должен быть > 0")
+        self.rps = float(rps)
+        self.burst = max(1, int(burst))
+        self._tokens = float(self.burst)
+        self._updated_at = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def set_rate(self, rps: float, burst: int | None = None) -> None:
+        if rps <= 0:
+            raise AmoClientError("rps должен быть > 0")
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rps = float(rps)
+            if burst is not None:
+                self.burst = max(1, int(burst))
+                self._tokens = min(self._tokens, float(self.burst))
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._updated_at
+        if elapsed > 0:
+            self._tokens = min(float(self.burst), self._tokens + elapsed * self.rps)
+            self._updated_at = now
+
+    def acquire(self) -> None:
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    wait = self._paused_until - now
+                else:
+                    self._refill(now)
+                    if self._tokens >= 1.0:
+                        self._tokens -= 1.0
+                        return
+                    wait = (1.0 - self._tokens) / self.rps
+            time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """Никто не получает токен ближайшие seconds секунд; накопленный запас сгорает."""
+        if seconds <= 0:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._paused_until = max(self._paused_until, now + seconds)
+            self._tokens = 0.0
+            self._updated_at = max(self._updated_at, self._paused_until)
+
+
+_DEFAULT_RETRY_STATUSES = {429: 8, 500: 3, 502: 5, 503: 5, 504: 5}
+
+
+def _parse_retry_statuses(raw: str) -> dict[int, int]:
+    """'429:8,503:5,500:0' -> {429: 8, 503: 5, 500: 0} (0 — не повторять этот код)."""
+    out: dict[int, int] = {}
+    for item in raw.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        code_s, sep, attempts_s = item.partition(":")
+        try:
+            code = int(code_s)
+            attempts = int(attempts_s) if sep else 3
+        except ValueError as e:
+            raise AmoClientError(
+                f"AMOCRM_RETRY_STATUSES: ожидается 'код:попыток[,код:попыток...]', получено: {raw!r}"
+            ) from e
+        out[code] = max(0, attempts)
+    return out
+
+
+def _float_env(name: str, default: float) -> float:
+    raw = (os.getenv(name) or "").strip()
+    if not raw:
+        return default
+    try:
+        return float(raw)
+    except ValueError as e:
+        raise AmoClientError(f"{name} должен быть числом, получено: {raw!r}") from e
+
+
+@dataclass(frozen=True)
+class RetryPolicy:
+    """
+    Политика повторов GET-запросов к amoCRM.
+
+    statuses — сколько повторов допускается для каждого HTTP-кода (остальные коды
+    не повторяются); network_retries — для сетевых ошибок. Пауза — экспоненциальная
+    с «полным» джиттером: random(0, min(max_delay, base_delay * 2**n)); если сервер
+    прислал Retry-After, ждём не меньше указанного (но не дольше max_retry_after —
+    иначе сдаёмся, чтобы не висеть в cron).
+    """
+
+    statuses: dict[int, int] = field(default_factory=lambda: dict(_DEFAULT_RETRY_STATUSES))
+    network_retries: int = 3
+    base_delay: float = 1.0
+    max_delay: float = 30.0
+    max_retry_after: float = 120.0
+
+    @classmethod
+    def from_env(cls) -> "RetryPolicy":
+        """
+        Env:
+          AMOCRM_RETRY_STATUSES   — '429:8,500:3,502:5,503:5,504:5' (по умолчанию)
+          AMOCRM_RETRY_NETWORK    — повторов при сетевых ошибках (3)
+          AMOCRM_RETRY_BASE_DELAY — базовая пауза, c (1)
+          AMOCRM_RETRY_MAX_DELAY  — потолок паузы без Retry-After, c (30)
+          AMOCRM_RETRY_MAX_RETRY_AFTER — максимум, сколько готовы ждать по Retry-After, c (120)
+        """
+        raw = (os.getenv("AMOCRM_RETRY_STATUSES") or "").strip()
+        statuses = _parse_retry_statuses(raw) if raw else dict(_DEFAULT_RETRY_STATUSES)
+        return cls(
+            statuses=statuses,
+            network_retries=max(0, int(_float_env("AMOCRM_RETRY_NETWORK", 3))),
+            base_delay=max(0.0, _float_env("AMOCRM_RETRY_BASE_DELAY", 1.0)),
+            max_delay=max(0.0, _float_env("AMOCRM_RETRY_MAX_DELAY", 30.0)),
+            max_retry_after=max(0.0, _float_env("AMOCRM_RETRY_MAX_RETRY_AFTER", 120.0)),
+        )
+
+    def retries_for(self, status: int | None) -> int:
+        if status is None:
+            return self.network_retries
+        return self.statuses.get(status, 0)
+
+    def backoff(self, retry_no: int) -> float:
+        cap = min(self.max_delay, self.base_delay * (2 ** max(0, retry_no - 1)))
+        return random.uniform(0, cap)
+
+
+def _parse_retry_after(value: str | None) -> float | None:
+    """Retry-After: число секунд или HTTP-date. Возвращает секунды ожидания или None."""
+    if not value:
+        return None
+    v = value.strip()
+    try:
+        return max(0.0, float(v))
+    except ValueError:
+        pass
+    try:
+        dt = parsedate_to_datetime(v)
+    except (TypeError, ValueError):
+        return None
+    if dt is None:
+        return None
+    return max(0.0, dt.timestamp() - time.time())
+
+
+def _http_pool_size_from_env() -> int:
+    """
+    Сколько простаивающих keep-alive соединений держать на один аккаунт.
+    Env: AMOCRM_HTTP_POOL_SIZE (целое). Если не задан — 8.
+    """
+    raw = (os.getenv("AMOCRM_HTTP_POOL_SIZE") or "").strip()
+    if not raw:
+        return 8
+    try:
+        n = int(raw)
+    except ValueError as e:
+        raise AmoClientError(f"AMOCRM_HTTP_POOL_SIZE должен быть целым числом, получено: {raw!r}") from e
+    return max(1, n)
+
+
+def _compression_enabled_from_env() -> bool:
+    """
+    Запрашивать ли сжатые ответы (Accept-Encoding: gzip, deflate).
+    Env: AMOCRM_HTTP_COMPRESSION=0|1. Если не задан — включено.
+    """
+    raw = (os.getenv("AMOCRM_HTTP_COMPRESSION") or "").strip().lower()
+    return raw not in ("0", "false", "no", "off")
+
+
+_READ_CHUNK = 64 * 1024
+
+
+class _StreamDecoder:
+    """
+    Потоковая распаковка тела ответа по Content-Encoding (gzip / deflate / identity).
+    deflate по RFC — zlib-обёртка, но часть серверов шлёт «сырой» deflate:
+    при ошибке на первом блоке переключаемся на raw.
+    """
+
+    def __init__(self, encoding: str):
+        self.encoding = (encoding or "identity").strip().lower()
+        self._started = False
+        if self.encoding in ("gzip", "x-gzip"):
+            self._d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif self.encoding == "deflate":
+            self._d = zlib.decompressobj(zlib.MAX_WBITS)
+        elif self.encoding in ("identity", ""):
+            self._d = None
+        else:
+            raise http.client.HTTPException(f"Неподдерживаемый Content-Encoding: {encoding!r}")
+
+    def feed(self, chunk: bytes) -> bytes:
+        if self._d is None:
+            return chunk
+        if not self._started and self.encoding == "deflate":
+            self._started = True
+            try:
+                return self._d.decompress(chunk)
+            except zlib.error:
+                self._d = zlib.decompressobj(-zlib.MAX_WBITS)
+        self._started = True
+        try:
+            return self._d.decompress(chunk)
+        except zlib.error as e:
+            raise http.client.HTTPException(f"Ошибка распаковки ответа ({self.encoding}): {e}") from e
+
+    def flush(self) -> bytes:
+        if self._d is None:
+            return b""
+        return self._d.flush()
+
+
+@dataclass(frozen=True)
+class ResponseMetrics:
+    """Метрики одного запроса: байты «по проводу» против распакованных."""
+
+    method: str
+    url: str
+    status: int
+    content_encoding: str
+    raw_bytes: int
+    decoded_bytes: int
+    elapsed_s: float
+
+
+class AmoResponse(NamedTuple):
+    status: int
+    headers: http.client.HTTPMessage
+    body: bytes
+    metrics: ResponseMetrics
+
+
+class AmoSession:
+    """
+    Keep-alive HTTP(S) соединения к одному хосту (account_domain) с пулом.
+
+    Соединение берётся из пула на время одного запроса и возвращается обратно,
+    если сервер не попросил его закрыть; параллельные потоки получают разные
+    соединения. Если переиспользованное соединение оказалось закрыто сервером
+    (idle timeout), запрос один раз повторяется на новом.
+
+    Счётчики connections_opened / requests_served показывают, насколько
+    реально переиспользуются соединения, bytes_raw / bytes_decoded — выигрыш
+    от сжатия (gzip/deflate запрашивается, если не отключено AMOCRM_HTTP_COMPRESSION).
+    Метрики последних запросов лежат в recent. limiter — общий token bucket
+    аккаунта для get_json (потолок AMOCRM_MAX_RPS).
+    """
+
+    def __init__(self, base_url: str, *, pool_size: int | None = None, timeout: float = 30):
+        parts = urlsplit(base_url)
+        if parts.scheme not in ("http", "https") or not parts.hostname:
+            raise AmoClientError(f"Некорректный URL для HTTP-сессии: {base_url!r}")
+        self.scheme = parts.scheme
+        self.host = parts.hostname
+        self.port = parts.port
+        self.timeout = timeout
+        self.pool_size = pool_size if pool_size is not None else _http_pool_size_from_env()
+        self.compression = _compression_enabled_from_env()
+        self.limiter = TokenBucket(max_rps_from_env(), _rate_burst_from_env())
+
+        self._idle: list[http.client.HTTPConnection] = []
+        self._lock = threading.Lock()
+        self.connections_opened = 0
+        self.requests_served = 0
+        self.bytes_raw = 0
+        self.bytes_decoded = 0
+        self.retries = 0
+        self.recent: deque[ResponseMetrics] = deque(maxlen=256)
+
+    @property
+    def origin(self) -> str:
+        port = f":{self.port}" if self.port else ""
+        return f"{self.scheme}://{self.host}{port}"
+
+    def _new_connection(self) -> http.client.HTTPConnection:
+        cls = http.client.HTTPSConnection if self.scheme == "https" else http.client.HTTPConnection
+        conn = cls(self.host, self.port, timeout=self.timeout)
+        with self._lock:
+            self.connections_opened += 1
+        return conn
+
+    def _checkout(self) -> tuple[http.client.HTTPConnection, bool]:
+        with self._lock:
+            if self._idle:
+                return self._idle.pop(), True
+        return self._new_connection(), False
+
+    def _checkin(self, conn: http.client.HTTPConnection) -> None:
+        with self._lock:
+            if len(self._idle) < self.pool_size:
+                self._idle.append(conn)
+                return
+        conn.close()
+
+    def request(
+        self,
+        method: str,
+        url: str,
+        *,
+        headers: dict | None = None,
+        body: bytes | None = None,
+    ) -> AmoResponse:
+        """
+        Выполняет запрос и возвращает AmoResponse (тело уже распаковано).
+        Сетевые ошибки пробрасываются как OSError / http.client.HTTPException.
+        """
+        parts = urlsplit(url)
+        path = parts.path or "/"
+        if parts.query:
+            path = f"{path}?{parts.query}"
+
+        req_headers = dict(headers or {})
+        if self.compression:
+            req_headers.setdefault("Accept-Encoding", "gzip, deflate")
+
+        while True:
+            conn, reused = self._checkout()
+            started = time.monotonic()
+            try:
+                conn.request(method, path, body=body, headers=req_headers)
+                resp = conn.getresponse()
+                encoding = resp.headers.get("Content-Encoding", "") or ""
+                decoder = _StreamDecoder(encoding)
+                raw_bytes = 0
+                out: list[bytes] = []
+                while True:
+                    chunk = resp.read(_READ_CHUNK)
+                    if not chunk:
+                        break
+                    raw_bytes += len(chunk)
+                    out.append(decoder.feed(chunk))
+                out.append(decoder.flush())
+                data = b"".join(out)
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                conn.close()
+                if reused:
+                    # сервер закрыл простаивавшее соединение — повторяем на новом
+                    continue
+                raise
+            except BaseException:
+                conn.close()
+                raise
+
+            if resp.will_close:
+                conn.close()
+            else:
+                self._checkin(conn)
+
+            metrics = ResponseMetrics(
+                method=method,
+                url=url,
+                status=resp.status,
+                content_encoding=encoding or "identity",
+                raw_bytes=raw_bytes,
+                decoded_bytes=len(data),
+                elapsed_s=time.monotonic() - started,
+            )
+            with self._lock:
+                self.requests_served += 1
+                self.bytes_raw += metrics.raw_bytes
+                self.bytes_decoded += metrics.decoded_bytes
+                self.recent.append(metrics)
+            return AmoResponse(resp.status, resp.headers, data, metrics)
+
+    def note_retry(self) -> None:
+        with self._lock:
+            self.retries += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "origin": self.origin,
+                "connections_opened": self.connections_opened,
+                "requests_served": self.requests_served,
+                "bytes_raw": self.bytes_raw,
+                "bytes_decoded": self.bytes_decoded,
+                "retries": self.retries,
+                "idle": len(self._idle),
+            }
+
+    def close(self) -> None:
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
+
+_SESSIONS: dict[str, AmoSession] = {}
+_SESSIONS_LOCK = threading.Lock()
+
+
+def get_session(url: str) -> AmoSession:
+    """
+    Общая сессия на хост (scheme://host:port) в пределах процесса.
+    Экспортёры лидов и справочников одного аккаунта делят её автоматически.
+    """
+    parts = urlsplit(url)
+    key = f"{parts.scheme}://{parts.netloc}".lower()
+    with _SESSIONS_LOCK:
+        session = _SESSIONS.get(key)
+        if session is None:
+            session = AmoSession(url)
+            _SESSIONS[key] = session
+        return session
+
+
+def session_stats() -> list[dict]:
+    with _SESSIONS_LOCK:
+        sessions = list(_SESSIONS.values())
+    return [s.stats() for s in sessions]
+
+
+def format_session_stats() -> str:
+    """
+    Строка для лога по каждому хосту: соединений открыто / запросов обслужено
+    и трафик «по проводу» против распакованного.
+    """
+    parts = [
+        f"{st['origin']}: соединений открыто {st['connections_opened']}, "
+        f"запросов {st['requests_served']}, "
+        f"трафик {st['bytes_raw'] / 1024:.1f} КБ (распаковано {st['bytes_decoded'] / 1024:.1f} КБ), "
+        f"повторов {st['retries']}"
+        for st in session_stats()
+    ]
+    return "HTTP keep-alive: " + ("; ".join(parts) if parts else "запросов не было")
+
+
+def close_sessions() -> None:
+    with _SESSIONS_LOCK:
+        sessions = list(_SESSIONS.values())
+        _SESSIONS.clear()
+    for s in sessions:
+        s.close()
+
+
+_MAX_REDIRECTS = 3
+
+
+def _send(method: str, url: str, *, headers: dict, body: bytes | None = None) -> AmoResponse:
+    """Запрос через общую сессию хоста; редиректы (3xx + Location) — только для GET."""
+    for _ in range(_MAX_REDIRECTS + 1):
+        resp = get_session(url).request(method, url, headers=headers, body=body)
+        location = resp.headers.get("Location")
+        if method == "GET" and resp.status in (301, 302, 303, 307, 308) and location:
+            url = urljoin(url, location)
+            continue
+        return resp
+    raise AmoClientError(f"Слишком много редиректов при {method} {url}")
+
+
 def _resolve_secrets_paths(client_slug: str | None) -> tuple[Path, Path]:
     """
     Multi-tenant-friendly secrets layout (recommended):
@@ -84,23 +588,25 @@ def save_json(path: Path, data: dict) -> None:
 
 def post_json(url: str, payload: dict) -> dict:
     data = json.dumps(payload).encode("utf-8")
-    req = urllib.request.Request(
-        url=url,
-        data=data,
-        headers={"Content-Type": "application/json"},
-        method="POST",
-    )
 
     try:
-        with urllib.request.urlopen(req, timeout=30) as resp:
-            body = resp.read().decode("utf-8")
-            return json.loads(body)
-    except HTTPError as e:
-        body = e.read().decode("utf-8", errors="replace")
-        raise AmoClientError(f"HTTP {e.code} при POST {url}\nОтвет:\n{body}")
-    except URLError as e:
+        resp = _send(
+            "POST",
+            url,
+            headers={"Content-Type": "application/json"},
+            body=data,
+        )
+        status, body = resp.status, resp.body
+    except (OSError, http.client.HTTPException) as e:
         raise AmoClientError(f"Сетевая ошибка при POST {url}: {e}")
-    except json.JSONDecodeError:
+
+    if status >= 400:
+        text = body.decode("utf-8", errors="replace")
+        raise AmoClientError(f"HTTP {status} при POST {url}\nОтвет:\n{text}")
+
+    try:
+        return json.loads(body.decode("utf-8"))
+    except (json.JSONDecodeError, UnicodeDecodeError):
         raise AmoClientError("Не удалось разобрать JSON-ответ сервера.")
 
 
@@ -364,21 +870,75 @@ def get_valid_access_token(client_slug: str | None = None) -> tuple[str, str]:
     return _get_valid_access_token_legacy(client_slug)
 
 
-def get_json(url: str, access_token: str) -> dict:
-    req = urllib.request.Request(
-        url=url,
-        headers={"Authorization": f"Bearer {access_token}"},
-        method="GET",
-    )
+def get_json(
+    url: str,
+    access_token: str,
+    *,
+    limiter: TokenBucket | None = None,
+    retry: RetryPolicy | None = None,
+    log=print,
+) -> dict:
+    """
+    GET с Bearer-токеном через keep-alive сессию хоста (get_session).
+
+    Перед каждой попыткой берётся токен из limiter (по умолчанию — общий bucket
+    аккаунта). 429 / 5xx / сетевые ошибки повторяются по RetryPolicy (по умолчанию —
+    из env); при Retry-After пауза ставится на весь bucket, так что параллельные
+    потоки отступают вместе. Пустой ответ (amoCRM отдаёт 204 No Content, когда
+    страница за пределами выборки) возвращается как {}. Повторы пишутся в log.
+    """
+    session = get_session(url)
+    if limiter is None:
+        limiter = session.limiter
+    if retry is None:
+        retry = RetryPolicy.from_env()
+
+    retry_no = 0
+    while True:
+        limiter.acquire()
+        try:
+            resp = _send(
+                "GET",
+                url,
+                headers={"Authorization": f"Bearer {access_token}"},
+            )
+        except (OSError, http.client.HTTPException) as e:
+            if retry_no < retry.retries_for(None):
+                retry_no += 1
+                delay = retry.backoff(retry_no)
+                log(f"WARNING: сетевая ошибка при GET {url}: {e} — повтор {retry_no}/{retry.retries_for(None)} через {delay:.1f} c")
+                session.note_retry()
+                time.sleep(delay)
+                continue
+            raise AmoClientError(f"Сетевая ошибка при GET {url}: {e}")
+
+        status, body = resp.status, resp.body
+        if status >= 400 and retry_no < retry.retries_for(status):
+            retry_after = _parse_retry_after(resp.headers.get("Retry-After"))
+            if retry_after is None or retry_after <= retry.max_retry_after:
+                retry_no += 1
+                delay = max(retry_after or 0.0, retry.backoff(retry_no))
+                log(
+                    f"WARNING: HTTP {status} при GET {url} — повтор {retry_no}/{retry.retries_for(status)} через {delay:.1f} c"
+                    + (f" (Retry-After: {retry_after:g} c)" if retry_after is not None else "")
+                )
+                session.note_retry()
+                if status == 429 or retry_after is not None:
+                    limiter.pause(delay)
+                else:
+                    time.sleep(delay)
+                continue
+        break
+
+    if status >= 400:
+        text = body.decode("utf-8", errors="replace")
+        suffix = f" (после {retry_no} повторов)" if retry_no else ""
+        raise AmoClientError(f"HTTP {status} при GET {url}{suffix}\nОтвет:\n{text}")
 
     try:
-        with urllib.request.urlopen(req, timeout=30) as resp:
-            body = resp.read().decode("utf-8")
-            return json.loads(body)
-    except HTTPError as e:
-        body = e.read().decode("utf-8", errors="replace")
-        raise AmoClientError(f"HTTP {e.code} при GET {url}\nОтвет:\n{body}")
-    except URLError as e:
-        raise AmoClientError(f"Сетевая ошибка при GET {url}: {e}")
-    except json.JSONDecodeError:
+        text = body.decode("utf-8")
+        if not text.strip():
+            return {}
+        return json.loads(text)
+    except (json.JSONDecodeError, UnicodeDecodeError):
         raise AmoClientError("Не удалось разобрать JSON-ответ сервера.")
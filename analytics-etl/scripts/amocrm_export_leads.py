@@ -7,11 +7,40 @@ if str(BASE_DIR) not in sys.path:
 
 import json
 import argparse
+import os
+import queue
 import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import ExitStack
 from datetime import datetime, timezone
 from urllib.parse import urlencode
 
-from scripts.amocrm_client import get_valid_access_token, get_json
+from scripts.amocrm_client import (
+    TokenBucket,
+    format_session_stats,
+    get_json,
+    get_session,
+    get_valid_access_token,
+)
+from scripts.custom_fields import refresh_field_cache
+from scripts.leads_io import NdjsonWriter, dedupe_ndjson_keep_last, is_ndjson
+
+PAGE_LIMIT = 250
+
+
+def _workers_from_env() -> int:
+    """
+    Число параллельных запросов страниц по умолчанию.
+    Env: AMOCRM_EXPORT_WORKERS (целое). Если не задан — 1 (последовательный обход _links.next).
+    """
+    raw = (os.getenv("AMOCRM_EXPORT_WORKERS") or "").strip()
+    if not raw:
+        return 1
+    try:
+        n = int(raw)
+    except ValueError as e:
+        raise ValueError(f"AMOCRM_EXPORT_WORKERS должен быть целым числом, получено: {raw!r}") from e
+    return max(1, n)
 
 
 def _parse_since_updated_at(raw: str) -> datetime:
@@ -48,20 +77,37 @@ def _parse_since_updated_at(raw: str) -> datetime:
     return dt.astimezone(timezone.utc)
 
 
-def _leads_list_url(account_domain: str, since_updated_at: datetime | None) -> str:
+def _leads_list_url(
+    account_domain: str,
+    since_updated_at: datetime | None,
+    *,
+    until_ts: int | None = None,
+    page: int | None = None,
+) -> str:
     """
-    GET /api/v4/leads с пагинацией; при since — filter[updated_at][from|to] (unix, UTC).
+    GET /api/v4/leads с пагинацией; при since или until_ts — filter[updated_at][from|to] (unix, UTC).
+    until_ts фиксирует верхнюю границу (иначе — текущее время), в том числе для полной выгрузки
+    (since=None → from=0): без неё лид, обновлённый во время обхода, уезжает в конец выборки и сдвигает
+    номера страниц. page — явный номер страницы для параллельного обхода (без него amo отдаёт первую
+    страницу и ссылку next).
+
+    >>> _leads_list_url("https://x.amocrm.ru", None, until_ts=1700000000, page=2)
+    'https://x.amocrm.ru/api/v4/leads?limit=250&order%5Bupdated_at%5D=asc&filter%5Bupdated_at%5D%5Bfrom%5D=0&filter%5Bupdated_at%5D%5Bto%5D=1700000000&page=2'
+    >>> _leads_list_url("https://x.amocrm.ru", None)
+    'https://x.amocrm.ru/api/v4/leads?limit=250&order%5Bupdated_at%5D=asc'
     """
     base = f"{account_domain.rstrip('/')}/api/v4/leads"
     params: list[tuple[str, str]] = [
-        ("limit", "250"),
+        ("limit", str(PAGE_LIMIT)),
         ("order[updated_at]", "asc"),
     ]
-    if since_updated_at is not None:
-        ts_from = int(since_updated_at.timestamp())
-        ts_to = int(time.time())
+    if since_updated_at is not None or until_ts is not None:
+        ts_from = int(since_updated_at.timestamp()) if since_updated_at is not None else 0
+        ts_to = until_ts if until_ts is not None else int(time.time())
         params.append(("filter[updated_at][from]", str(ts_from)))
         params.append(("filter[updated_at][to]", str(ts_to)))
+    if page is not None:
+        params.append(("page", str(page)))
     q = urlencode(params)
     return f"{base}?{q}"
 
@@ -78,10 +124,350 @@ def _merge_next_url(account_domain: str, next_href: str | None) -> str | None:
     return f"{account_domain.rstrip('/')}/{href.lstrip('/')}"
 
 
-def main():
-    p = argparse.ArgumentParser(description="Выгрузка лидов из amoCRM в JSON (safe multi-client).")
+def _write_json_atomic(path: Path, data) -> None:
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, separators=(",", ":"))
+    os.replace(tmp, path)
+
+
+class ExportCheckpoint:
+    """
+    Постраничный checkpoint выгрузки лидов.
+
+    Каждая полученная страница сразу пишется в page_NNNNNN.json, а state.json хранит
+    окно выгрузки (since / зафиксированный to) и курсор — updated_at последнего
+    сохранённого лида плюс id лидов с этим updated_at. Повторный запуск того же окна
+    продолжает выборку с filter[updated_at][from] = курсор и отбрасывает уже
+    сохранённые «граничные» лиды; после успешной записи результата checkpoint удаляется.
+    """
+
+    STATE_FILE = "state.json"
+
+    def __init__(self, directory: Path, window_key: str):
+        self.directory = directory
+        self.window_key = window_key
+        self.state: dict = {}
+
+    @staticmethod
+    def make_window_key(account_domain: str, since_dt: datetime | None) -> str:
+        since = str(int(since_dt.timestamp())) if since_dt is not None else "full"
+        return f"{account_domain.rstrip('/').lower()}|{since}"
+
+    @property
+    def _state_path(self) -> Path:
+        return self.directory / self.STATE_FILE
+
+    def _page_path(self, n: int) -> Path:
+        return self.directory / f"page_{n:06d}.json"
+
+    def load(self, max_age_s: float) -> dict | None:
+        """Состояние для продолжения или None (нет checkpoint / другое окно / устарел)."""
+        if not self._state_path.exists():
+            return None
+        try:
+            with open(self._state_path, "r", encoding="utf-8") as f:
+                state = json.load(f)
+        except (OSError, json.JSONDecodeError):
+            return None
+        if state.get("window_key") != self.window_key:
+            return None
+        if time.time() - float(state.get("created_at", 0)) > max_age_s:
+            return None
+        if not state.get("pages") or state.get("cursor_updated_at") is None:
+            return None
+        self.state = state
+        return state
+
+    def start(self, until_ts: int | None) -> None:
+        self.clear()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.state = {
+            "window_key": self.window_key,
+            "until_ts": until_ts,
+            "created_at": int(time.time()),
+            "pages": 0,
+            "leads": 0,
+            "cursor_updated_at": None,
+            "cursor_ids": [],
+        }
+        _write_json_atomic(self._state_path, self.state)
+
+    def append_page(self, leads: list[dict]) -> None:
+        n = int(self.state["pages"]) + 1
+        _write_json_atomic(self._page_path(n), leads)
+
+        last_ts = leads[-1].get("updated_at")
+        ids = [ld.get("id") for ld in leads if ld.get("updated_at") == last_ts]
+        if last_ts == self.state.get("cursor_updated_at"):
+            ids = list(self.state.get("cursor_ids") or []) + ids
+
+        self.state["pages"] = n
+        self.state["leads"] = int(self.state.get("leads", 0)) + len(leads)
+        self.state["cursor_updated_at"] = last_ts
+        self.state["cursor_ids"] = ids
+        _write_json_atomic(self._state_path, self.state)
+
+    def iter_pages(self):
+        for n in range(1, int(self.state.get("pages", 0)) + 1):
+            with open(self._page_path(n), "r", encoding="utf-8") as f:
+                yield json.load(f)
+
+    def clear(self) -> None:
+        if not self.directory.exists():
+            return
+        for path in self.directory.iterdir():
+            if path.name == self.STATE_FILE or path.name.startswith("page_"):
+                path.unlink()
+        try:
+            self.directory.rmdir()
+        except OSError:
+            pass
+
+
+def _dedupe_keep_last(leads: list[dict]) -> list[dict]:
+    """Оставляет последнее вхождение каждого id (после продолжения — самая свежая версия)."""
+    last_pos = {ld.get("id"): i for i, ld in enumerate(leads)}
+    return [ld for i, ld in enumerate(leads) if last_pos.get(ld.get("id")) == i]
+
+
+def _fetch_pages_sequential(
+    account_domain: str,
+    access_token: str,
+    since_dt: datetime | None,
+    limiter: TokenBucket,
+    on_page,
+    *,
+    until_ts: int | None = None,
+    log=print,
+) -> int:
+    """
+    Последовательный обход по _links.next (исходное поведение).
+    Каждая непустая страница передаётся в on_page(leads); возвращает число страниц.
+    Повторы запросов (429 / 5xx / сеть) пишутся в log.
+    """
+    url = _leads_list_url(account_domain, since_dt, until_ts=until_ts)
+    pages = 0
+
+    while url:
+        data = get_json(url, access_token, limiter=limiter, log=log)
+        leads = data.get("_embedded", {}).get("leads", [])
+        if leads:
+            on_page(leads)
+            pages += 1
+
+        next_href = data.get("_links", {}).get("next", {}).get("href")
+        url = _merge_next_url(account_domain, next_href)
+
+    return pages
+
+
+def _fetch_pages_concurrent(
+    account_domain: str,
+    access_token: str,
+    since_dt: datetime | None,
+    limiter: TokenBucket,
+    workers: int,
+    on_page,
+    *,
+    until_ts: int | None = None,
+    log=print,
+) -> int:
+    """
+    Параллельный обход страниц по номеру (page=1..N) пулом из workers потоков.
+
+    Общее число страниц amo не сообщает, поэтому держим «окно» из workers запросов
+    и сдвигаем его, пока не встретим последнюю страницу (нет _links.next) или пустую
+    (204 No Content). Верхняя граница filter[updated_at][to] фиксируется один раз (и для полной
+    выгрузки — с from=0), чтобы все страницы относились к одной выборке. Страницы отдаются в on_page
+    строго в исходном порядке (как при последовательном обходе): пришедшие раньше
+    своей очереди ждут в буфере.
+    """
+    if until_ts is None:
+        until_ts = int(time.time())
+
+    def fetch(page: int) -> tuple[list[dict], bool]:
+        url = _leads_list_url(account_domain, since_dt, until_ts=until_ts, page=page)
+        data = get_json(url, access_token, limiter=limiter, log=log)
+        leads = data.get("_embedded", {}).get("leads", [])
+        has_next = bool(data.get("_links", {}).get("next", {}).get("href"))
+        return leads, has_next
+
+    by_page: dict[int, list[dict]] = {}
+    last_page: int | None = None
+    next_page = 1
+    flushed = 0
+    emitted = 0
+
+    def flush() -> None:
+        nonlocal flushed, emitted
+        while (flushed + 1) in by_page and (last_page is None or flushed + 1 <= last_page):
+            flushed += 1
+            leads = by_page.pop(flushed)
+            if leads:
+                on_page(leads)
+                emitted += 1
+
+    pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="amo-page")
+    try:
+        in_flight = {}
+        while True:
+            while len(in_flight) < workers and (last_page is None or next_page <= last_page):
+                in_flight[pool.submit(fetch, next_page)] = next_page
+                next_page += 1
+            if not in_flight:
+                break
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for fut in done:
+                page = in_flight.pop(fut)
+                leads, has_next = fut.result()
+                by_page[page] = leads
+                if not leads:
+                    end = page - 1
+                elif not has_next:
+                    end = page
+                else:
+                    continue
+                if last_page is None or end < last_page:
+                    last_page = end
+            flush()
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+    flush()
+    return emitted
+
+
+def fetch_lead_pages(
+    account_domain: str,
+    access_token: str,
+    since_dt: datetime | None,
+    on_page,
+    *,
+    limiter: TokenBucket | None = None,
+    workers: int | None = None,
+    until_ts: int | None = None,
+    log=print,
+) -> int:
+    """
+    Обход страниц лидов для внешних потребителей (потоковый пайплайн): workers > 1 —
+    параллельно по номерам страниц, иначе по _links.next. Страницы приходят в on_page
+    в исходном порядке; возвращает число непустых страниц. Повторы запросов — в log.
+    """
+    if limiter is None:
+        limiter = get_session(account_domain).limiter
+    if workers is None:
+        workers = _workers_from_env()
+    if workers > 1:
+        return _fetch_pages_concurrent(
+            account_domain, access_token, since_dt, limiter, workers, on_page, until_ts=until_ts, log=log
+        )
+    return _fetch_pages_sequential(
+        account_domain, access_token, since_dt, limiter, on_page, until_ts=until_ts, log=log
+    )
+
+
+def _min_updated_at(account_domain: str, access_token: str, limiter: TokenBucket) -> int | None:
+    """updated_at самого «старого» лида аккаунта (limit=1, order asc) или None, если лидов нет."""
+    base = f"{account_domain.rstrip('/')}/api/v4/leads"
+    url = f"{base}?{urlencode([('limit', '1'), ('order[updated_at]', 'asc')])}"
+    data = get_json(url, access_token, limiter=limiter)
+    leads = data.get("_embedded", {}).get("leads", [])
+    if not leads or leads[0].get("updated_at") is None:
+        return None
+    return int(leads[0]["updated_at"])
+
+
+def _split_windows(ts_from: int, ts_to: int, shards: int) -> list[tuple[int, int]]:
+    """
+    Делит [ts_from, ts_to] на не более shards непересекающихся окон целых секунд.
+    filter[updated_at][from|to] в amo включает обе границы, поэтому окна стыкуются
+    как [a, b], [b + 1, c], ... — один и тот же лид не попадает в два окна.
+    """
+    if ts_to < ts_from:
+        return []
+    span = ts_to - ts_from + 1
+    shards = max(1, min(shards, span))
+    step = span // shards
+    windows = []
+    lo = ts_from
+    for i in range(shards):
+        hi = ts_to if i == shards - 1 else lo + step - 1
+        windows.append((lo, hi))
+        lo = hi + 1
+    return windows
+
+
+def _fetch_windows_sharded(
+    account_domain: str,
+    access_token: str,
+    windows: list[tuple[int, int]],
+    limiter: TokenBucket,
+    workers: int,
+    on_page,
+    *,
+    log=print,
+) -> int:
+    """
+    Параллельная выгрузка по окнам updated_at: каждое окно пагинируется само по себе
+    (последовательно, по _links.next), окна идут параллельно пулом из workers потоков
+    под общим token bucket. Страницы отдаются в on_page по порядку окон (итог — по возрастанию
+    updated_at, как при обычном обходе): текущее окно — по мере получения, окна, ушедшие вперёд,
+    ждут своей очереди в буфере. Возвращает число страниц.
+
+    Окна непересекающиеся и закреплены (from / to), поэтому лид в двух окнах не оказывается:
+    обновлённый во время выгрузки лид уходит за верхнюю границу и пропадает из своего окна.
+    Но он сдвигает номера следующих страниц этого окна, и на стыке страниц может пропуститься
+    другой, неизменившийся лид окна — как и при обычном постраничном обходе. Обновлённый лид
+    заберёт следующий инкремент; пропущенный — следующая полная выгрузка или его изменение.
+    """
+    # по очереди на окно: ("page", leads) ... и в конце ("done", страниц) или ("error", исключение)
+    queues: list[queue.SimpleQueue] = [queue.SimpleQueue() for _ in windows]
+
+    def fetch(i: int) -> None:
+        lo, hi = windows[i]
+        since = datetime.fromtimestamp(lo, tz=timezone.utc)
+        q = queues[i]
+        try:
+            n = _fetch_pages_sequential(
+                account_domain, access_token, since, limiter, lambda leads: q.put(("page", leads)), until_ts=hi, log=log
+            )
+        except BaseException as e:
+            q.put(("error", e))
+            return
+        q.put(("done", n))
+
+    pages = 0
+    pool = ThreadPoolExecutor(max_workers=max(1, workers), thread_name_prefix="amo-window")
+    try:
+        for i in range(len(windows)):
+            pool.submit(fetch, i)
+        for q in queues:
+            while True:
+                kind, value = q.get()
+                if kind == "page":
+                    on_page(value)
+                    continue
+                if kind == "error":
+                    raise value
+                pages += value
+                break
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+    return pages
+
+
+def main(argv: list[str] | None = None) -> None:
+    p = argparse.ArgumentParser(description="Выгрузка лидов из amoCRM в JSON / NDJSON (safe multi-client).")
     p.add_argument("--client-slug", required=True, help="client_slug (для выбора secrets и путей)")
-    p.add_argument("--out", dest="out_path", default=None, help="Путь к выходному JSON")
+    p.add_argument(
+        "--out",
+        dest="out_path",
+        default=None,
+        help="Путь к выходному файлу: *.json — массив, *.ndjson / *.jsonl — по лиду на строку, "
+        "страницы дописываются по мере получения",
+    )
     p.add_argument(
         "--since-updated-at",
         dest="since_updated_at",
@@ -89,36 +475,167 @@ def main():
         help="Инкремент: только лиды с updated_at после этого момента (UTC: unix, ISO или YYYY-MM-DD HH:MM:SS). "
         "Без аргумента — полная выгрузка.",
     )
-    args = p.parse_args()
+    p.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Параллельных запросов страниц (env AMOCRM_EXPORT_WORKERS, по умолчанию 1 — последовательно).",
+    )
+    p.add_argument(
+        "--max-rps",
+        type=float,
+        default=None,
+        help="Потолок запросов в секунду к amoCRM (env AMOCRM_MAX_RPS, по умолчанию 7).",
+    )
+    p.add_argument(
+        "--shards",
+        type=int,
+        default=1,
+        help="Разбить диапазон updated_at на N непересекающихся окон и выгружать их параллельно "
+        "(для полной выгрузки нижняя граница — самый старый лид аккаунта). По умолчанию 1 — без шардирования.",
+    )
+    p.add_argument(
+        "--checkpoint",
+        action="store_true",
+        help="Сохранять каждую страницу на диск и продолжать прерванную выгрузку того же окна.",
+    )
+    p.add_argument(
+        "--checkpoint-dir",
+        default=None,
+        help="Каталог checkpoint (по умолчанию <out>.checkpoint рядом с выходным файлом).",
+    )
+    p.add_argument(
+        "--checkpoint-max-age-hours",
+        type=float,
+        default=24.0,
+        help="Checkpoint старше этого возраста не продолжается, выгрузка начинается заново (24).",
+    )
+    args = p.parse_args(argv)
+
+    if args.shards > 1 and args.checkpoint:
+        p.error("--shards не совместим с --checkpoint: окна выгружаются параллельно и не имеют общего курсора")
 
     client_slug = args.client_slug
     default_out = BASE_DIR / "var" / "data" / client_slug / "add_leads_crm.json"
     out_file = Path(args.out_path) if args.out_path else default_out
 
     account_domain, access_token = get_valid_access_token(client_slug)
+    # определения кастомных полей для индекса преобразования (custom_fields.py), если кэш устарел
+    refresh_field_cache(client_slug)
 
     since_dt: datetime | None = None
     if args.since_updated_at:
         since_dt = _parse_since_updated_at(args.since_updated_at)
 
-    url = _leads_list_url(account_domain, since_dt)
-    all_leads = []
+    workers = args.workers if args.workers is not None else _workers_from_env()
+    if args.shards > 1 and args.workers is None:
+        workers = args.shards
+    workers = max(1, workers)
+    # общий token bucket аккаунта: на 429 / Retry-After отступают все потоки разом
+    limiter = get_session(account_domain).limiter
+    if args.max_rps is not None:
+        limiter.set_rate(args.max_rps)
 
-    while url:
-        data = get_json(url, access_token)
-        leads = data.get("_embedded", {}).get("leads", [])
-        all_leads.extend(leads)
+    # окно выборки: для инкремента верхняя граница фиксируется сразу (её же берём при продолжении)
+    query_since = since_dt
+    until_ts: int | None = int(time.time()) if since_dt is not None else None
+    ndjson = is_ndjson(out_file)
+    pages: list[list[dict]] = []
+    skip_ids: set = set()
+    skip_ts = None
+    resumed = False
+    resume_state: dict | None = None
 
-        next_href = data.get("_links", {}).get("next", {}).get("href")
-        url = _merge_next_url(account_domain, next_href)
+    ckpt: ExportCheckpoint | None = None
+    if args.checkpoint:
+        ckpt_dir = Path(args.checkpoint_dir) if args.checkpoint_dir else out_file.with_name(out_file.name + ".checkpoint")
+        ckpt = ExportCheckpoint(ckpt_dir, ExportCheckpoint.make_window_key(account_domain, since_dt))
+        resume_state = ckpt.load(args.checkpoint_max_age_hours * 3600)
+        if resume_state is not None:
+            resumed = True
+            until_ts = resume_state.get("until_ts")
+            skip_ts = resume_state["cursor_updated_at"]
+            skip_ids = set(resume_state.get("cursor_ids") or [])
+            query_since = datetime.fromtimestamp(int(skip_ts), tz=timezone.utc)
+            print(
+                f"Checkpoint: продолжаем выгрузку ({resume_state['pages']} стр., "
+                f"{resume_state.get('leads', 0)} лидов уже на диске), "
+                f"курсор updated_at={skip_ts} ({query_since.strftime('%Y-%m-%d %H:%M:%S')} UTC)."
+            )
+        else:
+            ckpt.start(until_ts)
+
+    with ExitStack() as stack:
+        # NDJSON: каждая страница сразу дописывается в файл, в памяти — только текущая страница
+        writer = stack.enter_context(NdjsonWriter(out_file)) if ndjson else None
+
+        def emit(leads: list[dict]) -> None:
+            if writer is not None:
+                writer.write_many(leads)
+            else:
+                pages.append(leads)
 
-    out_file.parent.mkdir(parents=True, exist_ok=True)
-    with open(out_file, "w", encoding="utf-8") as f:
-        json.dump(all_leads, f, ensure_ascii=False, indent=2)
+        if resumed:
+            for page in ckpt.iter_pages():
+                emit(page)
+
+        def on_page(leads: list[dict]) -> None:
+            if skip_ids:
+                leads = [ld for ld in leads if not (ld.get("updated_at") == skip_ts and ld.get("id") in skip_ids)]
+                if not leads:
+                    return
+            if ckpt is not None:
+                ckpt.append_page(leads)
+            emit(leads)
+
+        started = time.monotonic()
+        if args.shards > 1:
+            ts_to = until_ts if until_ts is not None else int(time.time())
+            ts_from = int(since_dt.timestamp()) if since_dt is not None else _min_updated_at(
+                account_domain, access_token, limiter
+            )
+            windows = _split_windows(ts_from, ts_to, args.shards) if ts_from is not None else []
+            print(f"Шардирование: окон {len(windows)} по updated_at [{ts_from}, {ts_to}], потоков {workers}")
+            fetched = _fetch_windows_sharded(account_domain, access_token, windows, limiter, workers, on_page)
+        elif workers > 1:
+            fetched = _fetch_pages_concurrent(
+                account_domain, access_token, query_since, limiter, workers, on_page, until_ts=until_ts
+            )
+        else:
+            fetched = _fetch_pages_sequential(
+                account_domain, access_token, query_since, limiter, on_page, until_ts=until_ts
+            )
+        elapsed = time.monotonic() - started
+
+    if ndjson:
+        total = writer.count
+        if resumed:
+            total -= dedupe_ndjson_keep_last(out_file)
+    else:
+        all_leads = [lead for page in pages for lead in page]
+        if resumed:
+            all_leads = _dedupe_keep_last(all_leads)
+        total = len(all_leads)
+
+        out_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(out_file, "w", encoding="utf-8") as f:
+            json.dump(all_leads, f, ensure_ascii=False, indent=2)
+
+    if ckpt is not None:
+        ckpt.clear()
 
     mode = "incremental (updated_at)" if since_dt is not None else "full"
-    print(f"Готово. Режим: {mode}. Лидов выгружено: {len(all_leads)}")
+    if resumed:
+        mode += ", продолжение по checkpoint"
+    if args.shards > 1:
+        mode += f", окон updated_at: {args.shards}"
+    print(f"Готово. Режим: {mode}. Формат: {'NDJSON' if ndjson else 'JSON'}. Лидов выгружено: {total}")
+    print(
+        f"Страниц запрошено: {fetched} | потоков: {workers} | потолок: {limiter.rps:g} rps | "
+        f"время выгрузки: {elapsed:.1f} c"
+    )
     print("Файл:", out_file)
+    print(format_session_stats())
 
 
 if __name__ == "__main__":
@@ -14,13 +14,13 @@ from datetime import datetime, UTC
 from scripts.clients_map import get_client_id
 
 # Берём токен и делаем запросы через твой клиент (он сам refresh делает)
-from scripts.amocrm_client import get_valid_access_token, get_json
+from scripts.amocrm_client import get_valid_access_token, get_json, format_session_stats
 
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
 
-def main():
+def main(argv: list[str] | None = None) -> None:
     p = argparse.ArgumentParser(description="Выгрузка pipelines/statuses из amoCRM в CSV (safe multi-client).")
     p.add_argument(
         "--client-slug",
@@ -28,7 +28,7 @@ def main():
         help="client_slug клиента (PostgreSQL / client_registry; fallback — clients_map)",
     )
     p.add_argument("--out", dest="out_path", default=None, help="Путь к выходному CSV")
-    args = p.parse_args()
+    args = p.parse_args(argv)
 
     client_slug = args.client_slug
     client_id = get_client_id(client_slug)
@@ -81,6 +81,7 @@ def main():
         w.writerows(rows)
 
     print("Готово:", out_csv, "строк:", len(rows))
+    print(format_session_stats())
 
 
 if __name__ == "__main__":
@@ -0,0 +1,359 @@
+"""
+Версионированные миграции схемы ClickHouse: sql/migrations/NNNN_описание.sql.
+
+Файл миграции — один или несколько SQL-операторов через ';', имя базы — плейсхолдер {db}
+(подставляется CLICKHOUSE_DB). Операторы должны быть идемпотентными (IF NOT EXISTS / IF EXISTS):
+если миграция упала на середине, повторный запуск дойдёт до конца. Применённые версии
+записываются в {db}.schema_migrations вместе с контрольной суммой файла — изменение уже
+применённого файла показывается в --status как предупреждение (правки — только новой миграцией).
+
+PARTITION BY / ORDER BY существующей таблицы ALTER'ом не меняются: CREATE TABLE IF NOT EXISTS
+не трогает таблицу, созданную раньше вручную. --inspect сравнивает текущий layout с целевым
+(последний CREATE TABLE таблицы в миграциях и ALTER TABLE после него), --rebuild TABLE переливает таблицу в целевой layout.
+
+Запуск:
+  python scripts/ch_migrate.py                    # применить новые миграции
+  python scripts/ch_migrate.py --status           # применённые / ожидающие
+  python scripts/ch_migrate.py --dry-run          # показать SQL, ничего не выполнять
+  python scripts/ch_migrate.py --inspect          # текущий layout таблиц vs целевой
+  python scripts/ch_migrate.py --rebuild leads_fact_v2
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import re
+import sys
+import time
+from dataclasses import dataclass
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+if str(BASE_DIR) not in sys.path:
+    sys.path.insert(0, str(BASE_DIR))
+
+from scripts.clickhouse_db import get_clickhouse_client, ident, table_exists
+
+MIGRATIONS_DIR = BASE_DIR / "sql" / "migrations"
+STATE_TABLE = "schema_migrations"
+
+_FILE_RE = re.compile(r"^(\d{4})_([A-Za-z0-9_]+)\.sql$")
+_STATEMENT_SPLIT_RE = re.compile(r";\s*(?:\n|$)")
+_CREATE_TABLE_RE = re.compile(r"^\s*CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?\{db\}\.(\w+)", re.IGNORECASE)
+_ALTER_TABLE_RE = re.compile(r"^\s*ALTER\s+TABLE\s+\{db\}\.(\w+)", re.IGNORECASE)
+_COMMENT_RE = re.compile(r"/\*.*?\*/", re.DOTALL)
+
+
+@dataclass
+class Migration:
+    version: int
+    name: str
+    path: Path
+    sql: str
+    checksum: str
+
+    @property
+    def statements(self) -> list[str]:
+        return split_statements(self.sql)
+
+
+def split_statements(sql: str) -> list[str]:
+    """Операторы файла без комментариев /* */ (';' — в конце строки)."""
+    body = _COMMENT_RE.sub("", sql.lstrip("\ufeff"))
+    return [s.strip() for s in _STATEMENT_SPLIT_RE.split(body) if s.strip()]
+
+
+def load_migrations(directory: Path = MIGRATIONS_DIR) -> list[Migration]:
+    migrations: list[Migration] = []
+    seen: dict[int, Path] = {}
+    for path in sorted(directory.glob("*.sql")):
+        m = _FILE_RE.match(path.name)
+        if not m:
+            raise ValueError(f"Имя файла миграции должно быть вида 0001_описание.sql: {path.name}")
+        version = int(m.group(1))
+        if version in seen:
+            raise ValueError(f"Две миграции с версией {version:04d}: {seen[version].name}, {path.name}")
+        seen[version] = path
+        sql = path.read_text(encoding="utf-8")
+        migrations.append(
+            Migration(
+                version=version,
+                name=m.group(2),
+                path=path,
+                sql=sql,
+                checksum=hashlib.sha256(sql.encode("utf-8")).hexdigest()[:16],
+            )
+        )
+    return migrations
+
+
+def render(statement: str, db: str) -> str:
+    return statement.replace("{db}", ident(db))
+
+
+def ensure_state_table(client, db: str) -> None:
+    client.command(
+        f"CREATE TABLE IF NOT EXISTS {ident(db)}.{STATE_TABLE} "
+        "(version UInt32, name String, checksum String, applied_at DateTime DEFAULT now()) "
+        "ENGINE = ReplacingMergeTree(applied_at) ORDER BY version"
+    )
+
+
+def applied_migrations(client, db: str) -> dict[int, tuple[str, str]]:
+    """version → (checksum, applied_at)."""
+    if not table_exists(client, db, STATE_TABLE):
+        return {}
+    rows = client.query(
+        f"SELECT version, argMax(checksum, applied_at), toString(max(applied_at)) "
+        f"FROM {ident(db)}.{STATE_TABLE} GROUP BY version"
+    ).result_rows
+    return {int(r[0]): (str(r[1]), str(r[2])) for r in rows}
+
+
+def apply_pending(client, db: str, migrations: list[Migration], *, dry_run: bool = False, log=print) -> int:
+    """Применяет ещё не применённые миграции по порядку версий; возвращает их число."""
+    done = applied_migrations(client, db)
+    pending = [m for m in migrations if m.version not in done]
+    if not pending:
+        log("Схема актуальна: новых миграций нет.")
+        return 0
+    if not dry_run:
+        ensure_state_table(client, db)
+    for m in pending:
+        log(f"== {m.version:04d}_{m.name} ({len(m.statements)} операторов)")
+        t0 = time.monotonic()
+        for statement in m.statements:
+            sql = render(statement, db)
+            if dry_run:
+                log(sql + ";\n")
+            else:
+                client.command(sql)
+        if not dry_run:
+            client.insert(
+                f"{ident(db)}.{STATE_TABLE}",
+                [[m.version, m.name, m.checksum]],
+                column_names=["version", "name", "checksum"],
+            )
+            log(f"   применена за {time.monotonic() - t0:.1f} c")
+    return len(pending)
+
+
+def print_status(client, db: str, migrations: list[Migration]) -> None:
+    done = applied_migrations(client, db)
+    for m in migrations:
+        if m.version in done:
+            checksum, applied_at = done[m.version]
+            note = "" if checksum == m.checksum else "  WARNING: файл изменён после применения"
+            print(f"[x] {m.version:04d}_{m.name}  ({applied_at}){note}")
+        else:
+            print(f"[ ] {m.version:04d}_{m.name}")
+    unknown = sorted(set(done) - {m.version for m in migrations})
+    for v in unknown:
+        print(f"[?] {v:04d} — применена, но файла нет в {MIGRATIONS_DIR}")
+
+
+# --- layout: текущий vs целевой ---
+
+
+def target_statements(migrations: list[Migration]) -> dict[str, list[str]]:
+    """
+    Таблица → целевой DDL: последний CREATE TABLE из миграций и все ALTER TABLE этой таблицы после него
+    (индексы, настройки).
+    """
+    targets: dict[str, list[str]] = {}
+    for m in migrations:
+        for statement in m.statements:
+            match = _CREATE_TABLE_RE.match(statement)
+            if match:
+                targets[match.group(1)] = [statement]
+                continue
+            match = _ALTER_TABLE_RE.match(statement)
+            if match and match.group(1) in targets:
+                targets[match.group(1)].append(statement)
+    return targets
+
+
+def _shadow_statement(statement: str, table: str, shadow: str) -> str:
+    return re.sub(r"\{db\}\." + re.escape(table) + r"\b", "{db}." + shadow, statement, count=1)
+
+
+def _create_shadow(client, db: str, table: str, statements: list[str], shadow: str) -> None:
+    client.command(f"DROP TABLE IF EXISTS {ident(db)}.{shadow}")
+    for statement in statements:
+        client.command(render(_shadow_statement(statement, table, shadow), db))
+
+
+def describe_table(client, db: str, table: str) -> dict:
+    """PARTITION BY / ORDER BY / движок, колонки (тип + кодек) и skip-индексы таблицы."""
+    t = client.query(
+        "SELECT engine, partition_key, sorting_key, primary_key FROM system.tables "
+        "WHERE database = {db:String} AND name = {table:String}",
+        parameters={"db": db, "table": table},
+    ).result_rows[0]
+    columns = client.query(
+        "SELECT name, type, compression_codec FROM system.columns "
+        "WHERE database = {db:String} AND table = {table:String} ORDER BY position",
+        parameters={"db": db, "table": table},
+    ).result_rows
+    indices = client.query(
+        "SELECT name, type_full, expr, granularity FROM system.data_skipping_indices "
+        "WHERE database = {db:String} AND table = {table:String} ORDER BY name",
+        parameters={"db": db, "table": table},
+    ).result_rows
+    return {
+        "engine": str(t[0]),
+        "partition_key": str(t[1]),
+        "sorting_key": str(t[2]),
+        "primary_key": str(t[3]),
+        "columns": {str(c[0]): f"{c[1]} {c[2]}".strip() for c in columns},
+        "indices": {str(i[0]): f"{i[1]} ON {i[2]} GRANULARITY {i[3]}" for i in indices},
+    }
+
+
+def target_layout(client, db: str, table: str, statements: list[str]) -> dict:
+    """Целевой layout: пустая теневая таблица по DDL миграций — ClickHouse сам нормализует выражения."""
+    shadow = f"{table}__layout_target"
+    _create_shadow(client, db, table, statements, shadow)
+    try:
+        return describe_table(client, db, shadow)
+    finally:
+        client.command(f"DROP TABLE IF EXISTS {ident(db)}.{shadow}")
+
+
+def diff_layout(current: dict, target: dict) -> list[str]:
+    diffs: list[str] = []
+    for key in ("engine", "partition_key", "sorting_key", "primary_key"):
+        if current[key] != target[key]:
+            diffs.append(f"{key}: {current[key] or '—'}  →  {target[key] or '—'}")
+    for name, spec in target["columns"].items():
+        have = current["columns"].get(name)
+        if have is None:
+            diffs.append(f"колонка {name}: нет  →  {spec}")
+        elif have != spec:
+            diffs.append(f"колонка {name}: {have}  →  {spec}")
+    for name in current["columns"]:
+        if name not in target["columns"]:
+            diffs.append(f"колонка {name}: лишняя (в целевой схеме нет)")
+    for name, spec in target["indices"].items():
+        if current["indices"].get(name) != spec:
+            diffs.append(f"индекс {name}: {current['indices'].get(name) or 'нет'}  →  {spec}")
+    return diffs
+
+
+def needs_rebuild(current: dict, target: dict) -> bool:
+    """Ключи и движок ALTER'ом не меняются — только переливкой (--rebuild)."""
+    return any(current[k] != target[k] for k in ("engine", "partition_key", "sorting_key", "primary_key"))
+
+
+def inspect_layout(client, db: str, migrations: list[Migration]) -> int:
+    """Печатает расхождения текущего layout с целевым; возвращает число таблиц с расхождениями."""
+    differing = 0
+    for table, statements in target_statements(migrations).items():
+        target = target_layout(client, db, table, statements)
+        if not table_exists(client, db, table):
+            print(f"{db}.{table}: не существует (будет создана миграцией)")
+            differing += 1
+            continue
+        current = describe_table(client, db, table)
+        diffs = diff_layout(current, target)
+        if not diffs:
+            print(f"{db}.{table}: OK — совпадает с целевым layout")
+            continue
+        differing += 1
+        print(f"{db}.{table}: расхождений {len(diffs)}")
+        for d in diffs:
+            print(f"  - {d}")
+        if needs_rebuild(current, target):
+            print(f"  → ключи / движок отличаются: python scripts/ch_migrate.py --rebuild {table}")
+    return differing
+
+
+def rebuild_table(client, db: str, table: str, statements: list[str], *, log=print) -> str:
+    """
+    Переливает таблицу в целевой layout: новая таблица по CREATE из миграций, INSERT ... SELECT
+    общих колонок, EXCHANGE TABLES (атомарно). Materialized view, читающие таблицу, пересоздаются.
+    Старые данные остаются в {table}__before_rebuild — удалить вручную после проверки.
+    Загрузки в таблицу на время переливки должны быть остановлены.
+    """
+    d, t = ident(db), ident(table)
+    new = f"{t}__rebuild"
+    old = f"{t}__before_rebuild"
+    if table_exists(client, db, old):
+        raise RuntimeError(f"{d}.{old} уже существует — удалите её после проверки прошлой переливки")
+
+    views = client.query(
+        "SELECT name, create_table_query FROM system.tables "
+        "WHERE database = {db:String} AND engine = 'MaterializedView' AND name IN ("
+        "SELECT arrayJoin(dependencies_table) FROM system.tables WHERE database = {db:String} AND name = {table:String})",
+        parameters={"db": db, "table": table},
+    ).result_rows
+
+    _create_shadow(client, db, table, statements, new)
+    target = describe_table(client, db, new)
+    cols = [c for c in describe_table(client, db, table)["columns"] if c in target["columns"]]
+    col_list = ", ".join(cols)
+    # Replacing/Collapsing/...MergeTree схлопывают строки с одинаковым ключом сортировки — при INSERT
+    # (optimize_on_insert) и фоновыми слияниями в любой из таблиц, поэтому count() сторон может
+    # законно разойтись. Сверяется то, что слияния не меняют: число уникальных ключей новой таблицы.
+    if target["engine"] != "MergeTree" and target["sorting_key"]:
+        measure, unit = f"uniqExact({target['sorting_key']})", f"ключей ({target['sorting_key']})"
+    else:
+        measure, unit = "count()", "строк"
+    t0 = time.monotonic()
+    try:
+        client.command(f"INSERT INTO {d}.{new} ({col_list}) SELECT {col_list} FROM {d}.{t}")
+        old_n = int(client.command(f"SELECT {measure} FROM {d}.{t}"))
+        new_n = int(client.command(f"SELECT {measure} FROM {d}.{new}"))
+    except BaseException:
+        client.command(f"DROP TABLE IF EXISTS {d}.{new}")
+        raise
+    if new_n != old_n:
+        client.command(f"DROP TABLE IF EXISTS {d}.{new}")
+        raise RuntimeError(f"Переливка {d}.{t}: {old_n} {unit} в источнике, {new_n} в новой таблице — отменено")
+    log(f"{d}.{t}: перелито за {time.monotonic() - t0:.1f} c, {unit}: {new_n} — совпадает с источником")
+
+    client.command(f"EXCHANGE TABLES {d}.{t} AND {d}.{new}")
+    client.command(f"RENAME TABLE {d}.{new} TO {d}.{old}")
+    for name, create_query in views:
+        client.command(f"DROP VIEW IF EXISTS {d}.{ident(name)}")
+        client.command(create_query)
+        log(f"Пересоздан {d}.{name}")
+    log(f"{d}.{t}: layout обновлён; прежние данные — в {d}.{old} (DROP TABLE после проверки)")
+    return old
+
+
+def main(argv: list[str] | None = None) -> None:
+    p = argparse.ArgumentParser(description="Миграции схемы ClickHouse (sql/migrations).")
+    p.add_argument("--status", action="store_true", help="Показать применённые и ожидающие миграции")
+    p.add_argument("--dry-run", action="store_true", help="Показать SQL ожидающих миграций без выполнения")
+    p.add_argument("--inspect", action="store_true", help="Сравнить текущий layout таблиц с целевым")
+    p.add_argument("--rebuild", metavar="TABLE", help="Перелить таблицу в целевой layout (PARTITION BY / ORDER BY)")
+    p.add_argument("--dir", default=str(MIGRATIONS_DIR), help="Каталог миграций")
+    args = p.parse_args(argv)
+
+    migrations = load_migrations(Path(args.dir))
+    client, db = get_clickhouse_client()
+
+    if args.status:
+        print_status(client, db, migrations)
+        return
+    if args.inspect:
+        differing = inspect_layout(client, db, migrations)
+        if differing:
+            raise SystemExit(1)
+        return
+    if args.rebuild:
+        targets = target_statements(migrations)
+        if args.rebuild not in targets:
+            raise SystemExit(f"Таблицы {args.rebuild} нет в миграциях: {', '.join(sorted(targets))}")
+        rebuild_table(client, db, args.rebuild, targets[args.rebuild])
+        return
+
+    n = apply_pending(client, db, migrations, dry_run=args.dry_run)
+    if n and not args.dry_run:
+        print(f"OK. Применено миграций: {n}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+"""
+Темп создания частей в таблицах ETL: сколько новых частей появляется в час и сколько активных частей
+в самой «толстой» партиции относительно порогов parts_to_delay_insert / parts_to_throw_insert.
+
+Каждый INSERT — новая часть в каждой задетой партиции. Когда много клиентов
+гоняют инкремент каждые несколько минут, части появляются быстрее, чем сливаются, и при
+parts_to_throw_insert активных частей в партиции ClickHouse начинает отвергать вставки
+(«Too many parts»). Отчёт показывает, насколько далеко до этого порога.
+
+Источники:
+  system.part_log (если включён в конфиге сервера) — NewPart / MergeParts за окно, в т.ч. по клиентам:
+    партиции факта — (client_id, месяц), справочников и leads_current — client_id, так что
+    client_id — первая часть partition_id;
+  system.parts — активные части; без part_log новые части оцениваются по ещё не слитым частям
+    уровня 0 (нижняя граница — слитые уже не видны).
+Пороги берутся из system.merge_tree_settings (значения по умолчанию сервера, без переопределений
+в SETTINGS таблицы).
+
+Запуск:
+  python scripts/ch_parts_report.py                          # факт, leads_current, справочники; окно 1 ч
+  python scripts/ch_parts_report.py --hours 24 --table leads_fact_v2
+
+Env:
+  ETL_PARTS_WARN_RATIO — предупреждать, когда частей в партиции не меньше этой доли
+    от parts_to_delay_insert (по умолчанию 0.5)
+"""
+
+from __future__ import annotations
+
+import argparse
+import os
+import sys
+from dataclasses import dataclass, field
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+if str(BASE_DIR) not in sys.path:
+    sys.path.insert(0, str(BASE_DIR))
+
+from scripts.clickhouse_db import get_clickhouse_client, table_exists
+from scripts.leads_ch_rows import DEFAULT_LEADS_TABLE
+from scripts.leads_current import CURRENT_TABLE
+
+DEFAULT_TABLES = [DEFAULT_LEADS_TABLE, CURRENT_TABLE, "statuses_dim_v2", "loss_reasons_dim_v2"]
+TOP_CLIENTS = 5
+
+
+@dataclass
+class PartsStat:
+    table: str
+    active_parts: int = 0
+    partitions: int = 0
+    max_parts: int = 0
+    max_partition: str = ""
+    new_parts: int = 0
+    merges: int = 0
+    new_rows: int = 0
+    from_part_log: bool = False
+    top_clients: list[tuple[str, int]] = field(default_factory=list)
+
+
+def _warn_ratio_from_env() -> float:
+    raw = (os.getenv("ETL_PARTS_WARN_RATIO") or "").strip()
+    if not raw:
+        return 0.5
+    try:
+        return float(raw)
+    except ValueError as e:
+        raise ValueError(f"ETL_PARTS_WARN_RATIO должен быть числом, получено: {raw!r}") from e
+
+
+def part_thresholds(client) -> dict[str, int]:
+    """parts_to_delay_insert / parts_to_throw_insert сервера (system.merge_tree_settings)."""
+    rows = client.query(
+        "SELECT name, value FROM system.merge_tree_settings "
+        "WHERE name IN ('parts_to_delay_insert', 'parts_to_throw_insert')"
+    ).result_rows
+    return {name: int(value) for name, value in rows}
+
+
+def _active_parts(client, db: str, stats: dict[str, PartsStat]) -> None:
+    rows = client.query(
+        """
+        SELECT table, partition_id, count() AS parts
+        FROM system.parts
+        WHERE active AND database = {db:String} AND table IN {tables:Array(String)}
+        GROUP BY table, partition_id
+        """,
+        parameters={"db": db, "tables": list(stats)},
+    ).result_rows
+    for table, partition_id, parts in rows:
+        st = stats[table]
+        st.active_parts += int(parts)
+        st.partitions += 1
+        if int(parts) > st.max_parts:
+            st.max_parts, st.max_partition = int(parts), str(partition_id)
+
+
+def _rates_from_part_log(client, db: str, stats: dict[str, PartsStat], hours: float) -> None:
+    params = {"db": db, "tables": list(stats), "seconds": int(hours * 3600)}
+    rows = client.query(
+        """
+        SELECT table,
+               countIf(event_type = 'NewPart') AS new_parts,
+               countIf(event_type = 'MergeParts') AS merges,
+               sumIf(rows, event_type = 'NewPart') AS new_rows
+        FROM system.part_log
+        WHERE database = {db:String} AND table IN {tables:Array(String)}
+          AND event_time >= now() - toIntervalSecond({seconds:UInt32})
+        GROUP BY table
+        """,
+        parameters=params,
+    ).result_rows
+    for table, new_parts, merges, new_rows in rows:
+        st = stats[table]
+        st.new_parts, st.merges, st.new_rows = int(new_parts), int(merges), int(new_rows)
+    rows = client.query(
+        """
+        SELECT table, splitByChar('-', partition_id)[1] AS client, count() AS new_parts
+        FROM system.part_log
+        WHERE database = {db:String} AND table IN {tables:Array(String)} AND event_type = 'NewPart'
+          AND event_time >= now() - toIntervalSecond({seconds:UInt32})
+        GROUP BY table, client
+        ORDER BY table, new_parts DESC
+        LIMIT {top:UInt32} BY table
+        """,
+        parameters={**params, "top": TOP_CLIENTS},
+    ).result_rows
+    for table, client_key, new_parts in rows:
+        stats[table].top_clients.append((str(client_key), int(new_parts)))
+    for st in stats.values():
+        st.from_part_log = True
+
+
+def _rates_from_parts(client, db: str, stats: dict[str, PartsStat], hours: float) -> None:
+    rows = client.query(
+        """
+        SELECT table, count() AS new_parts, sum(rows) AS new_rows
+        FROM system.parts
+        WHERE active AND level = 0 AND database = {db:String} AND table IN {tables:Array(String)}
+          AND modification_time >= now() - toIntervalSecond({seconds:UInt32})
+        GROUP BY table
+        """,
+        parameters={"db": db, "tables": list(stats), "seconds": int(hours * 3600)},
+    ).result_rows
+    for table, new_parts, new_rows in rows:
+        stats[table].new_parts, stats[table].new_rows = int(new_parts), int(new_rows)
+
+
+def parts_report(client, db: str, tables: list[str], *, hours: float = 1.0) -> list[PartsStat]:
+    """Активные части и новые части за последние hours часов по существующим таблицам из tables."""
+    stats = {t: PartsStat(t) for t in tables if table_exists(client, db, t)}
+    if not stats:
+        return []
+    _active_parts(client, db, stats)
+    if table_exists(client, "system", "part_log"):
+        _rates_from_part_log(client, db, stats, hours)
+    else:
+        _rates_from_parts(client, db, stats, hours)
+    return list(stats.values())
+
+
+def format_parts_report(
+    stats: list[PartsStat],
+    thresholds: dict[str, int],
+    *,
+    hours: float,
+    warn_ratio: float | None = None,
+) -> tuple[list[str], list[str]]:
+    """Строки отчёта и предупреждения (партиции, приближающиеся к parts_to_delay_insert)."""
+    warn_ratio = _warn_ratio_from_env() if warn_ratio is None else warn_ratio
+    delay = thresholds.get("parts_to_delay_insert")
+    throw = thresholds.get("parts_to_throw_insert")
+    lines = [
+        f"Части за {hours:g} ч (пороги: delay={delay if delay is not None else '?'}, "
+        f"throw={throw if throw is not None else '?'}):"
+    ]
+    warnings: list[str] = []
+    for st in stats:
+        rate = st.new_parts / hours if hours > 0 else 0.0
+        rows_per_part = st.new_rows / st.new_parts if st.new_parts else 0.0
+        source = "part_log" if st.from_part_log else "parts, нижняя граница"
+        line = (
+            f"  {st.table}: новых частей {st.new_parts} ({rate:.1f}/ч, ~{rows_per_part:.0f} строк на часть; {source})"
+            + (f", слияний {st.merges}" if st.from_part_log else "")
+            + f" | активных {st.active_parts} в {st.partitions} партициях, макс. {st.max_parts}"
+            + (f" (partition_id {st.max_partition})" if st.max_partition else "")
+        )
+        lines.append(line)
+        if st.top_clients:
+            lines.append("    больше всего новых частей: " + ", ".join(f"client {c}: {n}" for c, n in st.top_clients))
+        if delay and warn_ratio > 0 and st.max_parts >= delay * warn_ratio:
+            warnings.append(
+                f"WARNING: {st.table}: {st.max_parts} активных частей в партиции {st.max_partition} "
+                f"(parts_to_delay_insert = {delay}) — включите ETL_CH_SPOOL=1 (scripts/leads_spool.py) или реже запускайте инкремент"
+            )
+    return lines, warnings
+
+
+def main(argv: list[str] | None = None) -> None:
+    p = argparse.ArgumentParser(description="Темп создания частей и запас до «Too many parts» в таблицах ETL.")
+    p.add_argument("--hours", type=float, default=1.0, help="Окно для подсчёта новых частей, часов (по умолчанию 1)")
+    p.add_argument(
+        "--table",
+        action="append",
+        default=None,
+        help=f"Таблица (без БД), можно несколько раз. По умолчанию: {', '.join(DEFAULT_TABLES)}",
+    )
+    args = p.parse_args(argv)
+    if args.hours <= 0:
+        p.error("--hours должен быть > 0")
+
+    client, db = get_clickhouse_client()
+    stats = parts_report(client, db, args.table or DEFAULT_TABLES, hours=args.hours)
+    if not stats:
+        raise SystemExit(f"В {db} нет ни одной из таблиц: {', '.join(args.table or DEFAULT_TABLES)}")
+    lines, warnings = format_parts_report(stats, part_thresholds(client), hours=args.hours)
+    for line in lines + warnings:
+        print(line)
+    if warnings:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
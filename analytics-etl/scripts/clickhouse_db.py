@@ -0,0 +1,510 @@
+"""
+Подключение к ClickHouse для ETL (один клиент на процесс и набор параметров подключения).
+
+Env:
+  CLICKHOUSE_HOST, CLICKHOUSE_PORT (по умолчанию 8123), CLICKHOUSE_USER,
+  CLICKHOUSE_PASSWORD, CLICKHOUSE_DB
+
+Загрузчики и run_pipeline (шаги в одном процессе) получают общий клиент через
+get_clickhouse_client(), поэтому HTTP-сессия clickhouse_connect создаётся один раз.
+
+Здесь же — полная перезапись данных клиента через staging-таблицу и REPLACE PARTITION
+(prepare_staging / swap_client_partitions); для справочников — refresh_client_dim.
+
+INSERT с токеном дедупликации (insert_block): блок с тем же токеном ClickHouse второй раз не вставляет
+(для MergeTree нужна настройка таблицы non_replicated_deduplication_window — sql/migrations/0004),
+поэтому повтор INSERT после сетевой ошибки или перезапуск пайплайна на том же окне не плодят дубли.
+
+Частые маленькие дозагрузки копятся в буфере загрузчика по партициям (scripts/leads_spool.py) и уходят
+одним INSERT на партицию — тоже с токеном.
+
+Env:
+  ETL_CH_INSERT_RETRIES — попыток INSERT с токеном при сетевой ошибке (по умолчанию 3)
+  ETL_REPLACE_MIN_RATIO — защита от «усыхания» при полной перезаписи: новая версия должна содержать
+    не меньше этой доли уникальных ключей от текущей (по умолчанию 0.5; 0 — проверка выключена)
+"""
+
+from __future__ import annotations
+
+import hashlib
+import os
+import re
+import threading
+import time
+from datetime import datetime
+
+from scripts.load_dev_env import load_local_env_files
+
+load_local_env_files()
+
+import clickhouse_connect
+from clickhouse_connect.driver.exceptions import OperationalError
+
+_CLIENTS: dict[tuple, object] = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def _env_required(name: str) -> str:
+    v = os.getenv(name)
+    if v is None or str(v).strip() == "":
+        raise ValueError(f"Не задан env {name} (обязателен).")
+    return v
+
+
+def get_clickhouse_client():
+    """
+    Возвращает (client, db). Клиент кэшируется по параметрам подключения из env:
+    повторный вызов в том же процессе не открывает новую сессию.
+    """
+    host = _env_required("CLICKHOUSE_HOST")
+    port = int(os.getenv("CLICKHOUSE_PORT", "8123"))
+    user = _env_required("CLICKHOUSE_USER")
+    password = _env_required("CLICKHOUSE_PASSWORD")
+    db = _env_required("CLICKHOUSE_DB")
+
+    key = (host, port, user, password, db)
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.get(key)
+        if client is None:
+            client = clickhouse_connect.get_client(
+                host=host,
+                port=port,
+                username=user,
+                password=password,
+                database=db,
+            )
+            _CLIENTS[key] = client
+    return client, db
+
+
+def close_clickhouse_clients() -> None:
+    with _CLIENTS_LOCK:
+        clients = list(_CLIENTS.values())
+        _CLIENTS.clear()
+    for client in clients:
+        try:
+            client.close()
+        except Exception:
+            pass
+
+
+# --- идемпотентный INSERT: токен дедупликации + повтор при сетевой ошибке ---
+
+
+def dedup_token(client_id: int, table: str, window: str, content_digest: str) -> str:
+    """Детерминированный insert_deduplication_token блока: клиент, таблица, окно загрузки, хэш содержимого."""
+    return hashlib.sha256(f"{int(client_id)}|{table}|{window}|{content_digest}".encode("utf-8")).hexdigest()
+
+
+def row_digest_bytes(values) -> bytes:
+    """
+    Однозначное и стабильное между версиями Python представление строки для хэша содержимого:
+    у значения — метка типа, у строки — длина (разделители внутри текста не склеивают соседние поля).
+    """
+    parts = []
+    for v in values:
+        if v is None:
+            parts.append("N")
+        elif isinstance(v, str):
+            parts.append(f"s{len(v)}:{v}")
+        elif isinstance(v, float):
+            parts.append(f"f{v!r}")
+        elif isinstance(v, datetime):
+            parts.append(f"t{v.isoformat()}")
+        else:
+            parts.append(f"{type(v).__name__}:{v}")
+        parts.append("\x1f")
+    parts.append("\x1e")
+    return "".join(parts).encode("utf-8")
+
+
+def rows_content_digest(rows, columns: list[int] | None = None) -> str:
+    """sha256 строк INSERT (или только колонок с индексами columns) — хэш содержимого для dedup_token."""
+    h = hashlib.sha256()
+    for row in rows:
+        h.update(row_digest_bytes(row if columns is None else [row[i] for i in columns]))
+    return h.hexdigest()
+
+
+def _insert_retries_from_env() -> int:
+    raw = (os.getenv("ETL_CH_INSERT_RETRIES") or "").strip()
+    if not raw:
+        return 3
+    try:
+        return max(1, int(raw))
+    except ValueError as e:
+        raise ValueError(f"ETL_CH_INSERT_RETRIES должен быть целым числом, получено: {raw!r}") from e
+
+
+def insert_block(
+    client,
+    full_table: str,
+    data,
+    *,
+    column_names: list[str],
+    token: str | None = None,
+    column_oriented: bool = False,
+    log=print,
+):
+    """
+    client.insert с insert_deduplication_token. С токеном сетевая ошибка (OperationalError — ответа
+    сервера нет, неизвестно, записан ли блок) повторяется с тем же токеном: если первая попытка дошла,
+    ClickHouse повтор отбросит. Без токена — одна попытка, как раньше.
+    """
+    settings = {"insert_deduplication_token": token} if token else None
+    attempts = _insert_retries_from_env() if token else 1
+    for attempt in range(1, attempts + 1):
+        try:
+            return client.insert(
+                full_table,
+                data,
+                column_names=column_names,
+                column_oriented=column_oriented,
+                settings=settings,
+            )
+        except OperationalError as e:
+            if attempt >= attempts:
+                raise
+            delay = min(2**attempt, 10)
+            log(f"WARNING: INSERT в {full_table} не прошёл ({e}); повтор {attempt}/{attempts - 1} через {delay} c с тем же токеном")
+            time.sleep(delay)
+
+
+# --- полная перезапись данных клиента: staging-таблица + REPLACE PARTITION ---
+
+_IDENT_RE = re.compile(r"^[A-Za-z_][A-Za-z0-9_]*$")
+
+
+class ClickHouseReplaceError(Exception):
+    pass
+
+
+def ident(name: str) -> str:
+    if not _IDENT_RE.match(name or ""):
+        raise ValueError(f"Недопустимое имя объекта ClickHouse: {name!r}")
+    return name
+
+
+def table_exists(client, db: str, table: str) -> bool:
+    return bool(
+        client.query(
+            "SELECT count() FROM system.tables WHERE database = {db:String} AND name = {table:String}",
+            parameters={"db": db, "table": table},
+        ).result_rows[0][0]
+    )
+
+
+def partition_key(client, db: str, table: str) -> str:
+    """Выражение PARTITION BY таблицы (пустая строка — таблица не партиционирована)."""
+    rows = client.query(
+        "SELECT partition_key FROM system.tables WHERE database = {db:String} AND name = {table:String}",
+        parameters={"db": db, "table": table},
+    ).result_rows
+    if not rows:
+        raise ClickHouseReplaceError(f"Таблица {db}.{table} не найдена")
+    return str(rows[0][0] or "")
+
+
+def supports_client_replace(client, db: str, table: str) -> bool:
+    """
+    REPLACE PARTITION по клиенту возможен, только если client_id входит в ключ партиционирования:
+    тогда каждая партиция целиком принадлежит одному клиенту и её можно подменить, не задев других.
+    """
+    return re.search(r"\bclient_id\b", partition_key(client, db, table)) is not None
+
+
+def replace_min_ratio_from_env() -> float:
+    raw = (os.getenv("ETL_REPLACE_MIN_RATIO") or "").strip()
+    if not raw:
+        return 0.5
+    try:
+        v = float(raw)
+    except ValueError as e:
+        raise ValueError(f"ETL_REPLACE_MIN_RATIO должен быть числом, получено: {raw!r}") from e
+    return min(max(v, 0.0), 1.0)
+
+
+def staging_table_name(table: str, client_id: int) -> str:
+    return f"{ident(table)}__staging_c{int(client_id)}"
+
+
+def prepare_staging(client, db: str, table: str, client_id: int) -> str:
+    """
+    Пустая staging-таблица с той же структурой, движком и PARTITION BY, что у целевой
+    (CREATE TABLE ... AS). Остаток прошлого упавшего запуска удаляется.
+    """
+    staging = staging_table_name(table, client_id)
+    client.command(f"DROP TABLE IF EXISTS {ident(db)}.{staging}")
+    client.command(f"CREATE TABLE {ident(db)}.{staging} AS {ident(db)}.{ident(table)}")
+    # сверка в swap_client_partitions идёт по uniqExact ключа сортировки, который слияния не меняют,
+    # так что остановка слияний только экономит работу на таблице-однодневке; без прав на SYSTEM
+    # просто продолжаем
+    try:
+        client.command(f"SYSTEM STOP MERGES {ident(db)}.{staging}")
+    except Exception:
+        pass
+    return staging
+
+
+def drop_staging(client, db: str, staging: str) -> None:
+    try:
+        client.command(f"DROP TABLE IF EXISTS {ident(db)}.{ident(staging)}")
+    except Exception:
+        pass
+
+
+def client_partitions(client, db: str, table: str, client_id: int) -> set[str]:
+    """ID партиций {db}.{table}, в которых есть строки клиента."""
+    rows = client.query(
+        f"SELECT DISTINCT _partition_id FROM {ident(db)}.{ident(table)} WHERE client_id = {{cid:UInt64}}",
+        parameters={"cid": int(client_id)},
+    ).result_rows
+    return {str(r[0]) for r in rows}
+
+
+def sorting_key_columns(client, db: str, table: str) -> list[str]:
+    """
+    Колонки ORDER BY таблицы (system.tables.sorting_key). Ключ из выражений (toDate(x) и т.п.)
+    загрузчик на своей стороне не посчитает — ClickHouseReplaceError.
+    """
+    rows = client.query(
+        "SELECT sorting_key FROM system.tables WHERE database = {db:String} AND name = {table:String}",
+        parameters={"db": db, "table": table},
+    ).result_rows
+    if not rows:
+        raise ClickHouseReplaceError(f"Таблица {db}.{table} не найдена")
+    raw = str(rows[0][0] or "")
+    columns = [c.strip() for c in raw.split(",") if c.strip()]
+    if not columns or not all(_IDENT_RE.match(c) for c in columns):
+        raise ClickHouseReplaceError(
+            f"ORDER BY {db}.{table} ({raw or 'пуст'}) — не список колонок, сверка staging по ключу невозможна"
+        )
+    return columns
+
+
+class SortingKeyCounter:
+    """
+    Число уникальных ключей сортировки среди строк, вставленных в staging: с ним swap_client_partitions
+    сверяет uniqExact ключа в staging. Хранится hash() ключа — около 60 байт на строку.
+    """
+
+    def __init__(self, column_names: list[str], key_columns: list[str]):
+        missing = [c for c in key_columns if c not in column_names]
+        if missing:
+            raise ClickHouseReplaceError(f"Колонок ключа сортировки {missing} нет среди вставляемых")
+        self._idx = [column_names.index(c) for c in key_columns]
+        self._seen: set[int] = set()
+
+    def add_rows(self, rows) -> None:
+        idx = self._idx
+        self._seen.update(hash(tuple(r[i] for i in idx)) for r in rows)
+
+    def add_columns(self, columns: list[list]) -> None:
+        self._seen.update(map(hash, zip(*(columns[i] for i in self._idx))))
+
+    def __len__(self) -> int:
+        return len(self._seen)
+
+
+def swap_client_partitions(
+    client,
+    db: str,
+    table: str,
+    staging: str,
+    client_id: int,
+    *,
+    expected_keys: int,
+    key_column: str,
+    min_ratio: float = 0.5,
+    allow_shrink: bool = False,
+    log=print,
+) -> dict:
+    """
+    Подменяет данные клиента в {db}.{table} содержимым staging:
+      1) число уникальных ключей сортировки (ORDER BY таблицы) в staging должно равняться expected_keys —
+         столько их во вставленных загрузчиком строках (SortingKeyCounter). count() для сверки не годится:
+         ReplacingMergeTree схлопывает одинаковые ключи при INSERT и слияниях, а слияния в staging
+         не остановлены, если SYSTEM STOP MERGES не прошёл. В staging не должно быть чужих client_id;
+      2) защита от «усыхания»: число уникальных key_column в staging не меньше min_ratio от текущего
+         в целевой таблице (иначе — ошибка, если не allow_shrink);
+      3) ALTER TABLE ... REPLACE PARTITION ID по каждой партиции staging и DROP PARTITION ID
+         для партиций клиента, которых в новой версии нет.
+    Атомарна подмена одной партиции, поэтому клиент целиком подменяется атомарно только в таблицах
+    с PARTITION BY client_id — leads_current и справочниках. leads_fact_v2 (партиция — (client_id, месяц))
+    — история версий для ETL, не для отчётов: его партиции подменяются по очереди, и пока идут ALTER'ы,
+    запрос к факту может увидеть часть месяцев клиента в новой версии, часть — в старой. Все читатели
+    (sql/daily_report, DataLens) читают leads_current: он пересобирается из факта после подмены
+    и подменяется одной партицией. Staging удаляется в конце (и при ошибке тоже).
+    """
+    d, t, s = ident(db), ident(table), ident(staging)
+    key = ident(key_column)
+    try:
+        order_key = ", ".join(sorting_key_columns(client, db, table))
+        staged_rows = int(client.command(f"SELECT count() FROM {d}.{s}"))
+        if staged_rows == 0:
+            raise ClickHouseReplaceError(f"Staging {d}.{s} пуста — данные клиента не заменяются пустой версией")
+        staged_keys = int(client.command(f"SELECT uniqExact({order_key}) FROM {d}.{s}"))
+        if staged_keys != expected_keys:
+            raise ClickHouseReplaceError(
+                f"В staging {d}.{s} {staged_keys} уникальных ключей ({order_key}), ожидалось {expected_keys} "
+                "— подмена отменена"
+            )
+        foreign = int(
+            client.query(
+                f"SELECT count() FROM {d}.{s} WHERE client_id != {{cid:UInt64}}",
+                parameters={"cid": int(client_id)},
+            ).result_rows[0][0]
+        )
+        if foreign:
+            raise ClickHouseReplaceError(f"В staging {d}.{s} {foreign} строк другого client_id — подмена отменена")
+        new_keys = int(client.command(f"SELECT uniqExact({key}) FROM {d}.{s}"))
+        old_keys = int(
+            client.query(
+                f"SELECT uniqExact({key}) FROM {d}.{t} WHERE client_id = {{cid:UInt64}}",
+                parameters={"cid": int(client_id)},
+            ).result_rows[0][0]
+        )
+        log(f"Replace: {d}.{t} client_id={client_id}: сейчас {key} = {old_keys}, в новой версии = {new_keys}")
+        if old_keys and new_keys < old_keys * min_ratio and not allow_shrink:
+            raise ClickHouseReplaceError(
+                f"Новая версия содержит {new_keys} {key} против {old_keys} сейчас "
+                f"(< {min_ratio:.0%}) — похоже на неполную выгрузку, подмена отменена. "
+                "Если так и должно быть — запустите с разрешением на сокращение (--allow-shrink)."
+            )
+
+        new_parts = {
+            str(r[0])
+            for r in client.query(
+                "SELECT DISTINCT partition_id FROM system.parts "
+                "WHERE database = {db:String} AND table = {table:String} AND active",
+                parameters={"db": db, "table": staging},
+            ).result_rows
+        }
+        old_parts = client_partitions(client, db, table, client_id)
+        stale = sorted(old_parts - new_parts)
+        atomic = len(new_parts) + len(stale) <= 1
+        if not atomic:
+            log(
+                f"Replace: {len(new_parts) + len(stale)} партиций подменяются по очереди — до конца подмены "
+                f"запросы к {d}.{t} могут видеть данные клиента частично в старой версии"
+            )
+
+        for pid in sorted(new_parts):
+            client.command(f"ALTER TABLE {d}.{t} REPLACE PARTITION ID '{pid}' FROM {d}.{s}")
+        for pid in stale:
+            client.command(f"ALTER TABLE {d}.{t} DROP PARTITION ID '{pid}'")
+        log(f"Replace: подменено партиций {len(new_parts)}, удалено устаревших {len(stale)}")
+        return {
+            "rows": staged_rows,
+            "keys": staged_keys,
+            "old_keys": old_keys,
+            "new_keys": new_keys,
+            "replaced_partitions": len(new_parts),
+            "dropped_partitions": len(stale),
+            "atomic": atomic,
+        }
+    finally:
+        drop_staging(client, db, staging)
+
+
+def replace_client_data(
+    client,
+    db: str,
+    table: str,
+    client_id: int,
+    rows: list[list],
+    *,
+    column_names: list[str],
+    key_column: str,
+    allow_shrink: bool = False,
+    log=print,
+) -> dict:
+    """
+    Полный набор строк клиента (справочник) → staging → swap_client_partitions.
+    Staging новая на каждый запуск, поэтому токен по содержимому безопасен: он только гасит повтор
+    INSERT после сетевой ошибки.
+    """
+    keys = SortingKeyCounter(column_names, sorting_key_columns(client, db, table))
+    keys.add_rows(rows)
+    staging = prepare_staging(client, db, table, client_id)
+    try:
+        insert_block(
+            client,
+            f"{ident(db)}.{staging}",
+            rows,
+            column_names=column_names,
+            token=dedup_token(client_id, table, "snapshot", rows_content_digest(rows)),
+            log=log,
+        )
+    except BaseException:
+        drop_staging(client, db, staging)
+        raise
+    return swap_client_partitions(
+        client,
+        db,
+        table,
+        staging,
+        client_id,
+        expected_keys=len(keys),
+        key_column=key_column,
+        min_ratio=replace_min_ratio_from_env(),
+        allow_shrink=allow_shrink,
+        log=log,
+    )
+
+
+def refresh_client_dim(
+    client,
+    db: str,
+    table: str,
+    client_id: int,
+    rows: list[list],
+    *,
+    column_names: list[str],
+    key_column: str,
+    allow_shrink: bool = False,
+    dry_run: bool = False,
+    log=print,
+) -> None:
+    """
+    Обновляет справочник клиента целиком (загрузчики statuses_dim / loss_reasons_dim).
+    При PARTITION BY client_id справочник клиента — одна партиция: replace_client_data (staging +
+    REPLACE PARTITION, без мутаций), отчёты видят либо прежний, либо новый набор целиком.
+    Иначе (схема до миграций) — ALTER DELETE строк клиента и INSERT с токеном этого запуска.
+    dry_run — только строка плана.
+    """
+    full_table = f"{ident(db)}.{ident(table)}"
+    replace = supports_client_replace(client, db, table)
+    if dry_run:
+        if replace:
+            log(f"Planned: INSERT rows в staging + REPLACE PARTITION партиции client_id = {client_id}")
+        else:
+            log(f"Planned: DELETE WHERE client_id = {client_id} (mutations_sync) + INSERT rows")
+        return
+
+    if replace:
+        replace_client_data(
+            client,
+            db,
+            table,
+            client_id,
+            rows,
+            column_names=column_names,
+            key_column=key_column,
+            allow_shrink=allow_shrink,
+            log=log,
+        )
+    else:
+        log(
+            f"WARNING: PARTITION BY таблицы {full_table} не содержит client_id — справочник обновляется "
+            "через ALTER DELETE (примените миграции схемы: scripts/ch_migrate.py --inspect / --rebuild)."
+        )
+        # ждём завершения мутации, чтобы DELETE не гонялся с последующим INSERT
+        refresh_started = datetime.now()
+        client.command(f"ALTER TABLE {full_table} DELETE WHERE client_id = {int(client_id)} SETTINGS mutations_sync = 2")
+        # токен дедупликации: повтор INSERT после сетевой ошибки не задвоит справочник. Окно — этот запуск:
+        # после DELETE тот же набор строк обязан вставиться, а токен прошлого запуска ClickHouse отбросил бы
+        token = dedup_token(client_id, table, f"refresh={refresh_started:%Y-%m-%dT%H:%M:%S.%f}", rows_content_digest(rows))
+        insert_block(client, full_table, rows, column_names=column_names, token=token, log=log)
+
+    log(f"OK. Inserted {len(rows)} rows into {full_table} for client_id={client_id}" + (" (replace)" if replace else ""))
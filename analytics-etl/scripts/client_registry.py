@@ -7,10 +7,14 @@
 
 from __future__ import annotations
 
+import logging
+import threading
 from dataclasses import dataclass
 
 from scripts.db import get_connection
 
+logger = logging.getLogger(__name__)
+
 # Пока в БД нет timezone; при появлении колонки можно читать её из SELECT.
 DEFAULT_CLIENT_TIMEZONE = "Asia/Yekaterinburg"
 
@@ -19,6 +23,17 @@ class ClientRegistryError(Exception):
     pass
 
 
+# Кэш контекстов на время процесса: шаги run_pipeline в одном процессе
+# (и повторные get_client_id / get_valid_access_token) не ходят в PostgreSQL заново.
+_CONTEXT_CACHE: dict[str, "ClientContext"] = {}
+_CONTEXT_CACHE_LOCK = threading.Lock()
+
+
+def clear_client_context_cache() -> None:
+    with _CONTEXT_CACHE_LOCK:
+        _CONTEXT_CACHE.clear()
+
+
 def _normalize_account_domain(raw: str) -> str:
     """
     amoCRM API и urllib ожидают URL со схемой. В БД иногда хранят только хост
@@ -49,34 +64,75 @@ class ClientContext:
     is_enabled: bool
 
 
-def resolve_client_context(slug: str) -> ClientContext:
+def resolve_client_context(slug: str, *, use_cache: bool = True) -> ClientContext:
     """
     Возвращает контекст клиента по client_slug (clients + amocrm_integrations).
+    Успешный результат кэшируется в процессе; use_cache=False — всегда читать из БД.
     """
     s = (slug or "").strip()
     if not s:
         raise ClientRegistryError("client slug пустой")
 
+    if use_cache:
+        with _CONTEXT_CACHE_LOCK:
+            cached = _CONTEXT_CACHE.get(s)
+        if cached is not None:
+            return cached
+
+    ctx = _load_client_context(s)
+    with _CONTEXT_CACHE_LOCK:
+        _CONTEXT_CACHE[s] = ctx
+    return ctx
+
+
+_CONTEXT_SELECT = """
+    SELECT
+        c.id,
+        c.client_slug,
+        c.is_enabled,
+        i.id AS integration_id,
+        i.account_domain,
+        i.amo_oauth_client_id,
+        i.amo_oauth_client_secret,
+        i.amo_oauth_redirect_uri
+    FROM clients c
+    INNER JOIN amocrm_integrations i ON i.client_id = c.id
+"""
+
+
+def list_enabled_clients() -> list[ClientContext]:
+    """
+    Все включённые клиенты (clients.is_enabled) с интеграцией amoCRM, по client_slug.
+    Клиенты с пустым account_domain пропускаются. Результат заодно кладётся в кэш контекстов.
+    """
     conn = get_connection()
     try:
         with conn.cursor() as cur:
-            cur.execute(
-                """
-                SELECT
-                    c.id,
-                    c.client_slug,
-                    c.is_enabled,
-                    i.id AS integration_id,
-                    i.account_domain,
-                    i.amo_oauth_client_id,
-                    i.amo_oauth_client_secret,
-                    i.amo_oauth_redirect_uri
-                FROM clients c
-                INNER JOIN amocrm_integrations i ON i.client_id = c.id
-                WHERE c.client_slug = %s
-                """,
-                (s,),
-            )
+            cur.execute(_CONTEXT_SELECT + " WHERE c.is_enabled ORDER BY c.client_slug")
+            rows = cur.fetchall()
+    finally:
+        conn.close()
+
+    contexts = []
+    for row in rows:
+        try:
+            ctx = _context_from_row(row)
+        except ClientRegistryError as e:
+            logger.warning("Клиент пропущен: %s", e)
+            continue
+        contexts.append(ctx)
+
+    with _CONTEXT_CACHE_LOCK:
+        for ctx in contexts:
+            _CONTEXT_CACHE[ctx.client_slug] = ctx
+    return contexts
+
+
+def _load_client_context(s: str) -> ClientContext:
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(_CONTEXT_SELECT + " WHERE c.client_slug = %s", (s,))
             row = cur.fetchone()
     finally:
         conn.close()
@@ -86,6 +142,10 @@ def resolve_client_context(slug: str) -> ClientContext:
             f"Клиент не найден или нет интеграции amoCRM: slug={s!r}"
         )
 
+    return _context_from_row(row)
+
+
+def _context_from_row(row) -> ClientContext:
     (
         row_id,
         client_slug_val,
@@ -98,7 +158,7 @@ def resolve_client_context(slug: str) -> ClientContext:
     ) = row
     domain = _normalize_account_domain(str(account_domain or ""))
     if not domain:
-        raise ClientRegistryError(f"Пустой account_domain для slug={s!r}")
+        raise ClientRegistryError(f"Пустой account_domain для slug={client_slug_val!r}")
 
     oauth_id = (amo_oauth_client_id or "").strip() if amo_oauth_client_id is not None else ""
     oauth_secret = (
@@ -0,0 +1,318 @@
+"""
+Индекс кастомных полей сделок клиента: field_id → роль в плоской строке (phone, email, source, utm_*).
+
+Раньше extract_utm для каждого значения каждого лида чистил field_name (clean_text) и искал в нём
+«utm_*» / «источник». Полей в аккаунте — десятки, значений за всю историю — миллионы. Теперь роли
+считаются один раз на поле:
+  - определения полей берутся из amoCRM (/api/v4/leads/custom_fields) и кэшируются в
+    var/state/<client_slug>/lead_custom_fields.json (обновляет выгрузка лидов, когда кэш старше
+    ETL_CUSTOM_FIELDS_TTL_HOURS или помечен устаревшим);
+  - поле, которого нет в кэше (создано после него), классифицируется по field_code / field_name
+    из самого лида — так же, как раньше, — и запоминается; кэш помечается устаревшим, и следующая
+    выгрузка перечитает определения;
+  - config/custom_fields/<client_slug>.json — явные роли полей клиента:
+      {
+        "by_id":   {"123456": "utm_source", "654321": "ignore"},
+        "by_name": {"Откуда узнали о нас": "source"}
+      }
+    by_name сравнивается с очищенным названием без учёта регистра; by_id важнее by_name;
+    "ignore" — поле не используется вовсе.
+
+Роли поля — группы ключей строки: значение поля пишется в первый ещё пустой ключ группы
+(классификация по названию: «utm_source utm_medium» — сначала utm_source, потом utm_medium).
+
+Env:
+  ETL_CUSTOM_FIELDS_TTL_HOURS — возраст кэша определений, после которого выгрузка их перечитывает
+    (по умолчанию 24; 0 — перечитывать каждый раз)
+
+Запуск (просмотр индекса, подбор by_id / by_name):
+  python scripts/custom_fields.py --client-slug <slug> [--refresh]
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+if str(BASE_DIR) not in sys.path:
+    sys.path.insert(0, str(BASE_DIR))
+
+from scripts.amocrm_client import get_json, get_valid_access_token
+from scripts.transform_utils import CUSTOM_FIELD_KEYS, FieldRoles, clean_text, field_roles
+
+STATE_DIR = BASE_DIR / "var" / "state"
+OVERRIDES_DIR = BASE_DIR / "config" / "custom_fields"
+CACHE_FILENAME = "lead_custom_fields.json"
+IGNORE = "ignore"
+
+
+class CustomFieldsError(Exception):
+    pass
+
+
+def _ttl_hours_from_env() -> float:
+    raw = (os.getenv("ETL_CUSTOM_FIELDS_TTL_HOURS") or "").strip()
+    if not raw:
+        return 24.0
+    try:
+        return float(raw)
+    except ValueError as e:
+        raise CustomFieldsError(f"ETL_CUSTOM_FIELDS_TTL_HOURS должен быть числом, получено: {raw!r}") from e
+
+
+def cache_path(client_slug: str) -> Path:
+    return STATE_DIR / client_slug / CACHE_FILENAME
+
+
+def overrides_path(client_slug: str) -> Path:
+    return OVERRIDES_DIR / f"{client_slug}.json"
+
+
+def _read_json(path: Path) -> dict | None:
+    try:
+        return json.loads(path.read_text(encoding="utf-8"))
+    except FileNotFoundError:
+        return None
+    except ValueError as e:
+        raise CustomFieldsError(f"{path}: не JSON: {e}") from e
+
+
+def _write_json_atomic(path: Path, data: dict) -> None:
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_name(path.name + ".tmp")
+    tmp.write_text(json.dumps(data, ensure_ascii=False, indent=2), encoding="utf-8")
+    os.replace(tmp, path)
+
+
+def _override_roles(role: str, where: str) -> FieldRoles:
+    if role == IGNORE:
+        return ()
+    if role not in CUSTOM_FIELD_KEYS:
+        raise CustomFieldsError(f"{where}: неизвестная роль {role!r} (допустимо: {', '.join(CUSTOM_FIELD_KEYS)}, {IGNORE})")
+    return ((role,),)
+
+
+def load_overrides(client_slug: str) -> tuple[dict[int, FieldRoles], dict[str, FieldRoles], str]:
+    """Явные роли клиента: (by_id, by_name по очищенному названию в нижнем регистре, sha256 файла)."""
+    path = overrides_path(client_slug)
+    try:
+        raw = path.read_bytes()
+    except FileNotFoundError:
+        return {}, {}, ""
+    try:
+        config = json.loads(raw.decode("utf-8"))
+    except ValueError as e:
+        raise CustomFieldsError(f"{path}: не JSON: {e}") from e
+    by_id: dict[int, FieldRoles] = {}
+    for key, role in (config.get("by_id") or {}).items():
+        try:
+            field_id = int(key)
+        except ValueError as e:
+            raise CustomFieldsError(f"{path}: by_id — ключ не число: {key!r}") from e
+        by_id[field_id] = _override_roles(str(role), f"{path}: by_id {key}")
+    by_name = {
+        clean_text(str(name)).lower(): _override_roles(str(role), f"{path}: by_name {name!r}")
+        for name, role in (config.get("by_name") or {}).items()
+    }
+    return by_id, by_name, hashlib.sha256(raw).hexdigest()
+
+
+def overrides_digest(client_slug: str) -> str:
+    return load_overrides(client_slug)[2]
+
+
+class FieldIndex:
+    """
+    Роли кастомных полей клиента. roles(field) — по field_id за O(1); поле без записи в индексе
+    классифицируется по field_code / field_name значения один раз и запоминается.
+    """
+
+    def __init__(
+        self,
+        client_slug: str,
+        definitions: list[dict] | None = None,
+        *,
+        overrides: tuple[dict[int, FieldRoles], dict[str, FieldRoles], str] | None = None,
+        fetched_at: str | None = None,
+    ):
+        self.client_slug = client_slug
+        self.fetched_at = fetched_at
+        self._overrides_by_id, self._overrides_by_name, self.overrides_digest = overrides or ({}, {}, "")
+        self._by_id: dict[int, FieldRoles] = {}
+        self._by_name: dict[tuple, FieldRoles] = {}
+        for d in definitions or []:
+            try:
+                field_id = int(d["id"])
+            except (KeyError, TypeError, ValueError):
+                continue
+            self._by_id[field_id] = self._classify(field_id, d.get("code"), d.get("name"))
+        self.indexed = len(self._by_id)
+        self.unknown: set[int] = set()
+
+    def _classify(self, field_id: int | None, code, name) -> FieldRoles:
+        if field_id is not None and field_id in self._overrides_by_id:
+            return self._overrides_by_id[field_id]
+        cleaned = clean_text(name or "")
+        override = self._overrides_by_name.get(cleaned.lower()) if isinstance(cleaned, str) else None
+        if override is not None:
+            return override
+        return field_roles(code, cleaned)
+
+    def roles(self, field: dict) -> FieldRoles:
+        field_id = field.get("field_id")
+        try:
+            return self._by_id[field_id]
+        except KeyError:
+            pass
+        except TypeError:
+            field_id = None
+        if field_id is None:
+            key = (field.get("field_code"), field.get("field_name"))
+            try:
+                return self._by_name[key]
+            except KeyError:
+                roles = self._by_name[key] = self._classify(None, *key)
+                return roles
+        roles = self._by_id[field_id] = self._classify(field_id, field.get("field_code"), field.get("field_name"))
+        self.unknown.add(field_id)
+        return roles
+
+    def reset_stats(self) -> None:
+        self.unknown.clear()
+
+    def learned(self) -> dict[int, FieldRoles]:
+        """Роли новых полей (unknown), классифицированных по ходу, — воркер передаёт их родителю."""
+        return {field_id: self._by_id[field_id] for field_id in self.unknown}
+
+    def learn(self, classified: dict[int, FieldRoles]) -> None:
+        """Новые поля, классифицированные в другом процессе: в индекс и в unknown (для статистики и stale)."""
+        for field_id, roles in classified.items():
+            self._by_id.setdefault(field_id, roles)
+        self.unknown.update(classified)
+
+    def format_stats(self) -> str:
+        source = f"кэш от {self.fetched_at}" if self.fetched_at else "без кэша определений"
+        used = sum(1 for roles in self._by_id.values() if roles)
+        line = f"Кастомные поля ({self.client_slug}): в индексе {self.indexed} ({source}), с ролью {used}"
+        if self._overrides_by_id or self._overrides_by_name:
+            line += f", явных ролей {len(self._overrides_by_id) + len(self._overrides_by_name)}"
+        if self.unknown:
+            line += f", новых полей (нет в кэше) {len(self.unknown)}"
+        return line
+
+    def mark_stale_if_unknown(self) -> bool:
+        """Встретились поля, которых нет в кэше, — следующая выгрузка перечитает определения."""
+        if not self.unknown:
+            return False
+        path = cache_path(self.client_slug)
+        data = _read_json(path)
+        if data is None or data.get("stale"):
+            return False
+        data["stale"] = True
+        _write_json_atomic(path, data)
+        return True
+
+
+def fetch_field_definitions(client_slug: str, *, log=print) -> list[dict]:
+    """Определения кастомных полей сделок из amoCRM (все страницы); повторы запросов — в log."""
+    account_domain, access_token = get_valid_access_token(client_slug)
+    url: str | None = f"{account_domain}/api/v4/leads/custom_fields?limit=250"
+    definitions: list[dict] = []
+    while url:
+        data = get_json(url, access_token, log=log)
+        for f in data.get("_embedded", {}).get("custom_fields", []):
+            definitions.append({"id": f.get("id"), "name": f.get("name"), "code": f.get("code"), "type": f.get("type")})
+        next_href = (data.get("_links", {}).get("next") or {}).get("href")
+        url = next_href if next_href and next_href != url else None
+    return definitions
+
+
+def refresh_field_cache(client_slug: str, *, force: bool = False, log=print) -> bool:
+    """
+    Перечитывает определения полей, если кэш старше TTL, помечен устаревшим или force.
+    Ошибка amoCRM не роняет выгрузку: остаётся прежний кэш (или классификация по названию).
+    """
+    path = cache_path(client_slug)
+    data = _read_json(path)
+    if data is not None and not force and not data.get("stale"):
+        age_h = (time.time() - float(data.get("fetched_ts") or 0)) / 3600
+        if age_h < _ttl_hours_from_env():
+            return False
+    try:
+        definitions = fetch_field_definitions(client_slug, log=log)
+    except Exception as e:
+        log(f"WARNING: не удалось обновить определения кастомных полей {client_slug}: {e}")
+        return False
+    now = datetime.now(timezone.utc)
+    _write_json_atomic(
+        path,
+        {
+            "fetched_at": now.strftime("%Y-%m-%d %H:%M:%S"),
+            "fetched_ts": int(now.timestamp()),
+            "stale": False,
+            "fields": definitions,
+        },
+    )
+    log(f"Определения кастомных полей {client_slug} обновлены: {len(definitions)} полей → {path}")
+    return True
+
+
+_INDEXES: dict[str, tuple[tuple, FieldIndex]] = {}
+_INDEXES_LOCK = threading.Lock()
+
+
+def _mtime(path: Path) -> float | None:
+    try:
+        return path.stat().st_mtime
+    except FileNotFoundError:
+        return None
+
+
+def load_field_index(client_slug: str) -> FieldIndex:
+    """Индекс полей клиента из кэша и явных ролей; один на процесс, пока файлы не изменились."""
+    key = (_mtime(cache_path(client_slug)), _mtime(overrides_path(client_slug)))
+    with _INDEXES_LOCK:
+        cached = _INDEXES.get(client_slug)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        data = _read_json(cache_path(client_slug)) or {}
+        index = FieldIndex(
+            client_slug,
+            data.get("fields") or [],
+            overrides=load_overrides(client_slug),
+            fetched_at=data.get("fetched_at"),
+        )
+        _INDEXES[client_slug] = (key, index)
+    return index
+
+
+def main(argv: list[str] | None = None) -> None:
+    p = argparse.ArgumentParser(description="Индекс кастомных полей сделок клиента (роли для phone/email/source/utm_*).")
+    p.add_argument("--client-slug", required=True, help="client_slug клиента")
+    p.add_argument("--refresh", action="store_true", help="Перечитать определения полей из amoCRM")
+    args = p.parse_args(argv)
+
+    try:
+        if args.refresh:
+            refresh_field_cache(args.client_slug, force=True)
+        index = load_field_index(args.client_slug)
+        data = _read_json(cache_path(args.client_slug)) or {}
+    except CustomFieldsError as e:
+        raise SystemExit(f"ERROR: {e}")
+    print(index.format_stats())
+    for d in data.get("fields") or []:
+        roles = index.roles({"field_id": d.get("id"), "field_code": d.get("code"), "field_name": d.get("name")})
+        label = " | ".join("/".join(group) for group in roles) or "-"
+        print(f"  {d.get('id')}\t{d.get('code') or ''}\t{d.get('name')}\t→ {label}")
+
+
+if __name__ == "__main__":
+    main()
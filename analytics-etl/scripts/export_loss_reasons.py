@@ -10,7 +10,7 @@ import argparse
 from pathlib import Path
 from datetime import datetime, UTC
 
-from scripts.amocrm_client import get_valid_access_token, get_json, AmoClientError
+from scripts.amocrm_client import get_valid_access_token, get_json, format_session_stats, AmoClientError
 from scripts.clients_map import get_client_id
 
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -26,7 +26,7 @@ def unix_to_dt_str(value):
     return datetime.fromtimestamp(ts, tz=UTC).strftime("%Y-%m-%d %H:%M:%S")
 
 
-def main():
+def main(argv: list[str] | None = None) -> None:
     try:
         p = argparse.ArgumentParser(description="Выгрузка loss_reasons из amoCRM в CSV (safe multi-client).")
         p.add_argument(
@@ -35,7 +35,7 @@ def main():
             help="client_slug клиента (PostgreSQL / client_registry; fallback — clients_map)",
         )
         p.add_argument("--out", dest="out_path", default=None, help="Путь к выходному CSV")
-        args = p.parse_args()
+        args = p.parse_args(argv)
 
         client_slug = args.client_slug
         client_id = get_client_id(client_slug)
@@ -84,6 +84,7 @@ def main():
 
         print("CSV выгружен:", out_path)
         print(f"Записей: {len(items)}")
+        print(format_session_stats())
 
     except AmoClientError as e:
         print("Ошибка клиента amoCRM:", e)
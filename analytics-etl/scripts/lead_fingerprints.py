@@ -0,0 +1,168 @@
+"""
+Отпечатки загруженных лидов: lead_id → хэш исходной записи amoCRM, отдельный SQLite-файл на клиента
+(var/state/<client_slug>/lead_fingerprints.sqlite).
+
+Инкремент намеренно перевыгружает лиды за ETL_LEADS_OVERLAP_MINUTES до watermark. Без отпечатков
+каждый такой лид заново проходит очистку (leads_json_to_datalens_csv) и вставляется в факт новой
+версией. С отпечатками лид, чья запись не изменилась с последней загрузки, отбрасывается до
+преобразования и INSERT.
+
+Отпечатки двухфазные, как watermark: преобразование пишет их в pending, а в fingerprints они
+переносятся (commit) только после успешной загрузки в ClickHouse и записи watermark. Упавший запуск
+оставляет pending, и следующий запуск их сбрасывает (begin) — лиды из него обработаются заново.
+Полная выгрузка не фильтрует ничего и заменяет отпечатки целиком.
+
+Хэш считается по записи лида (json с отсортированными ключами), соль — client_id, код преобразования,
+правила source/channel и явные роли кастомных полей клиента (transform_salt): после изменения правил
+очистки все лиды один раз проходят преобразование заново.
+
+Env:
+  ETL_LEAD_FINGERPRINTS — 0: не пропускать неизменившиеся лиды (по умолчанию 1)
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import os
+import sqlite3
+from pathlib import Path
+from typing import Iterable
+
+from scripts.custom_fields import overrides_digest
+from scripts.source_rules import load_rules
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+STATE_DIR = BASE_DIR / "var" / "state"
+STORE_FILENAME = "lead_fingerprints.sqlite"
+
+# код, от которого зависит строка факта, полученная из записи лида
+_TRANSFORM_FILES = (
+    "leads_json_to_datalens_csv.py",
+    "transform_utils.py",
+    "source_rules.py",
+    "custom_fields.py",
+    "leads_ch_rows.py",
+)
+_LOOKUP_CHUNK = 500
+
+
+def fingerprints_enabled_from_env() -> bool:
+    return (os.getenv("ETL_LEAD_FINGERPRINTS") or "1").strip() != "0"
+
+
+def store_path(client_slug: str) -> Path:
+    return STATE_DIR / client_slug / STORE_FILENAME
+
+
+def transform_salt(client_id: int, config_digest: str = "") -> str:
+    h = hashlib.sha256(f"{int(client_id)}|{config_digest}".encode("utf-8"))
+    for name in _TRANSFORM_FILES:
+        h.update((Path(__file__).resolve().parent / name).read_bytes())
+    return h.hexdigest()
+
+
+def lead_fingerprint(lead: dict) -> bytes:
+    """16 байт blake2b от записи лида (порядок ключей не важен)."""
+    payload = json.dumps(lead, sort_keys=True, ensure_ascii=False, separators=(",", ":"), default=str)
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).digest()
+
+
+def _lead_id(lead: dict) -> int | None:
+    try:
+        lead_id = int(lead.get("id"))
+    except (TypeError, ValueError):
+        return None
+    return lead_id if lead_id > 0 else None
+
+
+class LeadFingerprintStore:
+    """
+    fingerprints — отпечатки лидов, уже загруженных в ClickHouse; pending — отпечатки текущего запуска.
+    Соединение можно передать в другой поток (fused-режим), но использовать одновременно из двух нельзя.
+    """
+
+    def __init__(self, path: Path, *, salt: str):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.conn.executescript(
+            """
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS fingerprints (lead_id INTEGER PRIMARY KEY, fp BLOB NOT NULL);
+            CREATE TABLE IF NOT EXISTS pending (lead_id INTEGER PRIMARY KEY, fp BLOB NOT NULL);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+            """
+        )
+        self.reset = False
+        if self._meta("salt") != salt:
+            # другой код преобразования — прежние отпечатки не гарантируют ту же строку факта
+            with self.conn:
+                self.reset = self._meta("salt") is not None
+                self.conn.execute("DELETE FROM fingerprints")
+                self._set_meta("salt", salt)
+
+    def _meta(self, key: str) -> str | None:
+        row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key: str, value: str) -> None:
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+
+    def __len__(self) -> int:
+        return int(self.conn.execute("SELECT count() FROM fingerprints").fetchone()[0])
+
+    def begin(self, *, full: bool) -> None:
+        """Начало запуска: сброс pending от упавшего запуска; full — commit заменит отпечатки целиком."""
+        with self.conn:
+            self.conn.execute("DELETE FROM pending")
+            self._set_meta("pending_full", "1" if full else "0")
+
+    def changed(self, leads: Iterable[dict], *, skip_unchanged: bool = True) -> tuple[list[dict], int]:
+        """
+        Лиды, которые нужно преобразовать и загрузить, и число отброшенных неизменившихся.
+        Отпечатки возвращаемых лидов записываются в pending.
+        """
+        items = []
+        for lead in leads:
+            lead_id = _lead_id(lead)
+            items.append((lead, lead_id, lead_fingerprint(lead) if lead_id is not None else None))
+        known: dict[int, bytes] = {}
+        if skip_unchanged:
+            ids = [lead_id for _, lead_id, _ in items if lead_id is not None]
+            for i in range(0, len(ids), _LOOKUP_CHUNK):
+                chunk = ids[i : i + _LOOKUP_CHUNK]
+                marks = ",".join("?" * len(chunk))
+                known.update(
+                    self.conn.execute(f"SELECT lead_id, fp FROM fingerprints WHERE lead_id IN ({marks})", chunk)
+                )
+        out: list[dict] = []
+        pending: list[tuple[int, bytes]] = []
+        for lead, lead_id, fp in items:
+            if lead_id is not None and known.get(lead_id) == fp:
+                continue
+            out.append(lead)
+            if lead_id is not None:
+                pending.append((lead_id, fp))
+        with self.conn:
+            self.conn.executemany("INSERT OR REPLACE INTO pending (lead_id, fp) VALUES (?, ?)", pending)
+        return out, len(items) - len(out)
+
+    def commit(self) -> int:
+        """Переносит pending в fingerprints (после успешной загрузки); возвращает число отпечатков."""
+        with self.conn:
+            if self._meta("pending_full") == "1":
+                self.conn.execute("DELETE FROM fingerprints")
+            n = self.conn.execute("INSERT OR REPLACE INTO fingerprints SELECT lead_id, fp FROM pending").rowcount
+            self.conn.execute("DELETE FROM pending")
+            self._set_meta("pending_full", "0")
+        return n
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def open_store(client_slug: str, client_id: int) -> LeadFingerprintStore:
+    rules = load_rules(client_slug)
+    digest = f"{rules.digest}|{overrides_digest(client_slug)}"
+    return LeadFingerprintStore(store_path(client_slug), salt=transform_salt(client_id, digest))
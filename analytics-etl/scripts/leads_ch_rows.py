@@ -0,0 +1,255 @@
+"""
+Плоская строка лида (FIELDS из leads_json_to_datalens_csv) → строка INSERT в факт лидов ClickHouse.
+
+Без pandas: значения приводятся по одному, с той же семантикой, что и загрузчик CSV
+(load_leads_csv_to_clickhouse): пустое / нечисловое → NULL, *_dt → DateTime без tz,
+responsible_user_id → manager_id, version = updated_at или etl_loaded_at, lead_id <= 0 отбрасывается.
+Вход может быть как «родными» значениями (int / None из JSON), так и строками из CSV.
+
+Две формы результата: to_insert_row — строка для client.insert (потоковый пайплайн),
+LeadColumns — колонки для колоночного INSERT (column_oriented=True) в загрузчике.
+
+Хэш содержимого блока (rows_content_digest(rows, DIGEST_INDEXES) / LeadColumns.digest, оба —
+clickhouse_db.row_digest_bytes) — для insert_deduplication_token: etl_loaded_at и version в него
+не входят (меняются от запуска к запуску при тех же данных лида).
+"""
+
+from __future__ import annotations
+
+import hashlib
+import math
+from datetime import datetime
+
+from scripts.clickhouse_db import row_digest_bytes
+
+DEFAULT_LEADS_TABLE = "leads_fact_v2"
+
+LEADS_INSERT_COLUMNS = [
+    "client_id",
+    "lead_id",
+    "created_at",
+    "updated_at",
+    "closed_at",
+    "created_dt",
+    "updated_dt",
+    "closed_dt",
+    "status_id",
+    "pipeline_id",
+    "loss_reason_id",
+    "price",
+    "account_id",
+    "created_by",
+    "updated_by",
+    "score",
+    "manager_id",
+    "is_deleted",
+    "client_slug",
+    "name",
+    "utm_source",
+    "utm_medium",
+    "utm_campaign",
+    "utm_content",
+    "utm_term",
+    "source",
+    "phone",
+    "email",
+    "channel",
+    "phone_from_name",
+    "name_clean",
+    "etl_loaded_at",
+    "version",
+]
+
+# колонка ClickHouse → поле плоской строки
+NUMERIC_COLUMNS = {
+    "status_id": "status_id",
+    "pipeline_id": "pipeline_id",
+    "loss_reason_id": "loss_reason_id",
+    "price": "price",
+    "account_id": "account_id",
+    "created_by": "created_by",
+    "updated_by": "updated_by",
+    "score": "score",
+    "manager_id": "responsible_user_id",
+}
+
+STRING_COLUMNS = [
+    "client_slug",
+    "name",
+    "utm_source",
+    "utm_medium",
+    "utm_campaign",
+    "utm_content",
+    "utm_term",
+    "source",
+    "phone",
+    "email",
+    "channel",
+    "phone_from_name",
+    "name_clean",
+]
+
+
+_FIXED_ROW_BYTES = 8 * (len(LEADS_INSERT_COLUMNS) - len(STRING_COLUMNS))
+
+# колонки, от которых зависит хэш содержимого (без служебных etl_loaded_at / version)
+DIGEST_COLUMNS = [c for c in LEADS_INSERT_COLUMNS if c not in ("etl_loaded_at", "version")]
+DIGEST_INDEXES = [LEADS_INSERT_COLUMNS.index(c) for c in DIGEST_COLUMNS]
+
+
+def to_number(value):
+    """int / float / числовая строка → int (если целое) или float; всё остальное → None."""
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float):
+        if math.isnan(value) or math.isinf(value):
+            return None
+        return int(value) if value.is_integer() else value
+    s = str(value).strip()
+    if not s:
+        return None
+    try:
+        return int(s)
+    except ValueError:
+        pass
+    try:
+        f = float(s)
+    except ValueError:
+        return None
+    if math.isnan(f) or math.isinf(f):
+        return None
+    return int(f) if f.is_integer() else f
+
+
+def to_datetime(value) -> datetime | None:
+    """'YYYY-MM-DD HH:MM:SS' (или ISO с T / таймзоной) → naive datetime; пустое / мусор → None."""
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=None)
+    s = str(value).strip()
+    if not s:
+        return None
+    try:
+        # fromisoformat в разы быстрее strptime и покрывает формат ts_to_iso
+        return datetime.fromisoformat(s).replace(tzinfo=None)
+    except ValueError:
+        pass
+    try:
+        return datetime.strptime(s[:19], "%Y-%m-%d %H:%M:%S")
+    except ValueError:
+        return None
+
+
+def to_string(value) -> str | None:
+    if value is None:
+        return None
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    s = str(value)
+    return s if s != "" else None
+
+
+def _convert(row: dict, client_id: int, etl_loaded_at: datetime) -> dict | None:
+    lead_id = to_number(row.get("id"))
+    if not isinstance(lead_id, int) or lead_id <= 0:
+        return None
+
+    # каждая дата разбирается один раз: *_at и *_dt в ClickHouse — одно и то же значение
+    created = to_datetime(row.get("created_dt"))
+    updated = to_datetime(row.get("updated_dt"))
+    closed = to_datetime(row.get("closed_dt"))
+
+    is_deleted = to_number(row.get("is_deleted"))
+    values = {
+        "client_id": client_id,
+        "lead_id": lead_id,
+        "created_at": created,
+        "updated_at": updated,
+        "closed_at": closed,
+        "created_dt": created,
+        "updated_dt": updated,
+        "closed_dt": closed,
+        "is_deleted": int(is_deleted) if is_deleted is not None else 0,
+        "etl_loaded_at": etl_loaded_at,
+        "version": updated if updated is not None else etl_loaded_at,
+    }
+    for col, src in NUMERIC_COLUMNS.items():
+        values[col] = to_number(row.get(src))
+    if values["pipeline_id"] is None:
+        # pipeline_id входит в ORDER BY факта (sql/migrations/0001) и не может быть NULL
+        values["pipeline_id"] = 0
+    for col in STRING_COLUMNS:
+        values[col] = to_string(row.get(col))
+    return values
+
+
+def to_insert_row(
+    row: dict,
+    *,
+    client_id: int,
+    etl_loaded_at: datetime,
+) -> list | None:
+    """
+    Строка в порядке LEADS_INSERT_COLUMNS или None, если lead_id не положительный.
+    client_id всегда берётся из аргумента (как «фиксируем ЖЁСТКО» в загрузчике CSV).
+    """
+    values = _convert(row, client_id, etl_loaded_at)
+    if values is None:
+        return None
+    return [values[c] for c in LEADS_INSERT_COLUMNS]
+
+
+class LeadColumns:
+    """
+    Колоночный буфер под LEADS_INSERT_COLUMNS: по списку на колонку, NULL — None
+    (маску Nullable clickhouse_connect строит сам при сериализации).
+    """
+
+    def __init__(self, *, client_id: int, etl_loaded_at: datetime, digest: bool = False):
+        self.client_id = client_id
+        self.etl_loaded_at = etl_loaded_at
+        self.data: dict[str, list] = {c: [] for c in LEADS_INSERT_COLUMNS}
+        self.skipped = 0
+        self.approx_bytes = 0
+        self.max_updated_dt: datetime | None = None
+        self._hash = hashlib.sha256() if digest else None
+
+    def __len__(self) -> int:
+        return len(self.data["lead_id"])
+
+    def append(self, row: dict) -> bool:
+        values = _convert(row, self.client_id, self.etl_loaded_at)
+        if values is None:
+            self.skipped += 1
+            return False
+        for col, buf in self.data.items():
+            buf.append(values[col])
+        # грубая оценка объёма блока (строки — по длине, остальное — 8 байт) для лимита --block-mb
+        self.approx_bytes += _FIXED_ROW_BYTES + sum(len(values[c]) for c in STRING_COLUMNS if values[c] is not None)
+        u = values["updated_dt"]
+        if u is not None and (self.max_updated_dt is None or u > self.max_updated_dt):
+            self.max_updated_dt = u
+        if self._hash is not None:
+            self._hash.update(row_digest_bytes([values[c] for c in DIGEST_COLUMNS]))
+        return True
+
+    def digest(self) -> str | None:
+        """sha256 содержимого текущего блока (тот же, что rows_content_digest(rows, DIGEST_INDEXES)); None, если создан без digest=True."""
+        return self._hash.hexdigest() if self._hash is not None else None
+
+    def columns(self) -> list[list]:
+        """Колонки в порядке LEADS_INSERT_COLUMNS (для client.insert(..., column_oriented=True))."""
+        return [self.data[c] for c in LEADS_INSERT_COLUMNS]
+
+    def clear(self) -> None:
+        """Очищает буферы (счётчики skipped / max_updated_dt копятся дальше — по всей загрузке)."""
+        for buf in self.data.values():
+            buf.clear()
+        self.approx_bytes = 0
+        if self._hash is not None:
+            self._hash = hashlib.sha256()
@@ -0,0 +1,177 @@
+"""
+Текущее состояние лидов в ClickHouse: одна строка на (client_id, lead_id) — последняя версия.
+
+Факт leads_fact_v2 получает новую строку-версию лида при каждой загрузке (overlap инкремента,
+повторные выгрузки), и отчёты по нему либо считают дубли, либо платят за FINAL по всем версиям.
+leads_current — компактная копия с последними версиями:
+
+  leads_current     ReplacingMergeTree(version), PARTITION BY client_id, ORDER BY (client_id, lead_id);
+                    колонки — как у leads_fact_v2 (DDL — sql/migrations/0003_leads_current.sql)
+  leads_current_mv  MATERIALIZED VIEW leads_fact_v2 → leads_current: каждый INSERT в факт сразу
+                    попадает и сюда
+
+Синхронизация со стороны загрузчика (sync_after_load, вызывается load_leads_csv_to_clickhouse
+и fused-режимом после успешной загрузки):
+  - обычная дозагрузка: строки уже пришли через MV, больше ничего не делается — старые версии
+    схлопывают фоновые слияния ReplacingMergeTree (OPTIMIZE ... FINAL после каждого инкремента
+    переписывал бы всю партицию клиента ради десятка строк);
+  - полная перезапись (REPLACE PARTITION в факте MV не видит): текущее состояние клиента
+    пересобирается из факта через staging, подменяется целиком — удалённые в amoCRM лиды уходят —
+    и свежая партиция схлопывается OPTIMIZE ... FINAL (один раз на полную выгрузку).
+
+Отчёты (sql/daily_report) и DataLens читают leads_current FINAL: последняя версия выбирается при
+чтении, даже если фоновые слияния ещё не дошли до новых частей (FINAL читает только партицию клиента).
+Читать нужно именно leads_current: полная перезапись клиента атомарна только здесь (одна партиция),
+а в leads_fact_v2 месяцы клиента подменяются по очереди.
+
+Запуск:
+  python scripts/leads_current.py --setup                    # миграции + первичное заполнение
+  python scripts/leads_current.py --client-slug <slug>       # пересобрать текущее состояние клиента
+"""
+
+from __future__ import annotations
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+if str(BASE_DIR) not in sys.path:
+    sys.path.insert(0, str(BASE_DIR))
+
+from scripts.ch_migrate import apply_pending, load_migrations
+from scripts.clickhouse_db import (
+    client_partitions,
+    drop_staging,
+    get_clickhouse_client,
+    ident,
+    prepare_staging,
+    swap_client_partitions,
+    table_exists,
+)
+from scripts.clients_map import get_client_id
+from scripts.leads_ch_rows import DEFAULT_LEADS_TABLE
+
+CURRENT_TABLE = "leads_current"
+CURRENT_MV = "leads_current_mv"
+
+
+def _latest_versions_select(source: str, db: str, where: str = "") -> str:
+    # версия лида входит в ключ факта (история версий), поэтому FINAL по факту даёт все версии —
+    # последнюю выбираем явно
+    return (
+        f"SELECT * FROM {ident(db)}.{ident(source)} {where} "
+        "ORDER BY client_id, lead_id, version DESC, etl_loaded_at DESC LIMIT 1 BY client_id, lead_id"
+    )
+
+
+def setup_current_table(client, db: str, *, source: str = DEFAULT_LEADS_TABLE, log=print) -> bool:
+    """
+    Создаёт leads_current и MV миграциями (sql/migrations/0003_leads_current.sql, если ещё не применены)
+    и заполняет пустую таблицу из факта. Возвращает True, если было заполнение.
+    """
+    apply_pending(client, db, load_migrations(), log=log)
+    d = ident(db)
+    if int(client.command(f"SELECT count() FROM {d}.{CURRENT_TABLE}")):
+        return False
+    # MV уже подключён: вставки, пришедшие во время INSERT ... SELECT, не потеряются
+    # (если строка попадёт и туда, и туда — дубль схлопнет ReplacingMergeTree)
+    t0 = time.monotonic()
+    client.command(f"INSERT INTO {d}.{CURRENT_TABLE} {_latest_versions_select(source, db)}")
+    client.command(f"OPTIMIZE TABLE {d}.{CURRENT_TABLE} FINAL")
+    rows = int(client.command(f"SELECT count() FROM {d}.{CURRENT_TABLE}"))
+    log(f"{d}.{CURRENT_TABLE} заполнена из {d}.{ident(source)}: {rows} лидов за {time.monotonic() - t0:.1f} c")
+    return True
+
+
+def optimize_client(client, db: str, client_id: int) -> int:
+    """Схлопывает версии в партициях клиента; возвращает число партиций."""
+    parts = client_partitions(client, db, CURRENT_TABLE, client_id)
+    for pid in sorted(parts):
+        client.command(f"OPTIMIZE TABLE {ident(db)}.{CURRENT_TABLE} PARTITION ID '{pid}' FINAL")
+    return len(parts)
+
+
+def rebuild_client(client, db: str, client_id: int, *, source: str = DEFAULT_LEADS_TABLE, log=print) -> int:
+    """
+    Пересобирает текущее состояние клиента из факта (последняя версия каждого лида)
+    и подменяет партицию клиента в leads_current. Возвращает число лидов.
+    """
+    d, src = ident(db), ident(source)
+    staging = prepare_staging(client, db, CURRENT_TABLE, client_id)
+    try:
+        client.command(
+            f"INSERT INTO {d}.{staging} "
+            + _latest_versions_select(src, db, f"WHERE client_id = {int(client_id)}")
+        )
+        rows = int(client.command(f"SELECT count() FROM {d}.{staging}"))
+    except BaseException:
+        drop_staging(client, db, staging)
+        raise
+    # объём новой версии уже проверен при подмене факта — здесь сокращение допустимо;
+    # LIMIT 1 BY client_id, lead_id даёт по строке на ключ сортировки leads_current, так что count()
+    # сразу после INSERT и есть число ключей (слияния в staging его уже не изменят)
+    swap_client_partitions(
+        client,
+        db,
+        CURRENT_TABLE,
+        staging,
+        client_id,
+        expected_keys=rows,
+        key_column="lead_id",
+        allow_shrink=True,
+        log=log,
+    )
+    return rows
+
+
+def sync_after_load(
+    client,
+    db: str,
+    client_id: int,
+    *,
+    replaced: bool,
+    source: str = DEFAULT_LEADS_TABLE,
+    log=print,
+) -> None:
+    """
+    Приводит leads_current клиента в соответствие с фактом после загрузки. Дозагрузку MV уже доставил —
+    ничего не делает; после полной перезаписи пересобирает клиента и схлопывает его партицию.
+    Без таблицы (не выполнен --setup) или при загрузке не в leads_fact_v2 — ничего не делает.
+    """
+    if not replaced or source != DEFAULT_LEADS_TABLE or not table_exists(client, db, CURRENT_TABLE):
+        return
+    t0 = time.monotonic()
+    rows = rebuild_client(client, db, client_id, source=source, log=log)
+    optimize_client(client, db, client_id)
+    log(
+        f"{CURRENT_TABLE}: текущее состояние клиента {client_id} пересобрано ({rows} лидов) "
+        f"за {time.monotonic() - t0:.1f} c"
+    )
+
+
+def main(argv: list[str] | None = None) -> None:
+    p = argparse.ArgumentParser(description="Таблица текущего состояния лидов leads_current (последняя версия лида).")
+    p.add_argument("--setup", action="store_true", help="Создать leads_current и MV, заполнить из факта")
+    p.add_argument("--client-slug", help="Пересобрать текущее состояние одного клиента из факта")
+    p.add_argument("--source-table", default=DEFAULT_LEADS_TABLE, help="Таблица факта (без БД)")
+    args = p.parse_args(argv)
+    if not args.setup and not args.client_slug:
+        p.error("укажите --setup и/или --client-slug")
+
+    client, db = get_clickhouse_client()
+    if args.setup:
+        if not setup_current_table(client, db, source=args.source_table):
+            print(f"{db}.{CURRENT_TABLE} уже заполнена")
+    if args.client_slug:
+        client_id = get_client_id(args.client_slug)
+        if not table_exists(client, db, CURRENT_TABLE):
+            raise SystemExit(f"{db}.{CURRENT_TABLE} не найдена — сначала выполните --setup")
+        rows = rebuild_client(client, db, client_id, source=args.source_table)
+        optimize_client(client, db, client_id)
+        print(f"OK. {db}.{CURRENT_TABLE}: клиент {args.client_slug} (id={client_id}) — {rows} лидов")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+"""
+Чтение и запись промежуточных файлов лидов.
+
+Два формата:
+  - JSON-массив (исторический, `*.json`) — читается целиком;
+  - NDJSON (`*.ndjson` / `*.jsonl`) — один лид на строку; читается и пишется потоково,
+    поэтому в памяти держится одна страница / одна запись, а не весь аккаунт.
+
+Формат определяется по расширению файла.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+from pathlib import Path
+from typing import Iterable, Iterator
+
+NDJSON_SUFFIXES = (".ndjson", ".jsonl")
+
+
+def is_ndjson(path: Path | str) -> bool:
+    return Path(path).suffix.lower() in NDJSON_SUFFIXES
+
+
+def iter_json_records(data) -> Iterator[dict]:
+    """
+    Поддерживаем 2 формата JSON:
+    - list[dict] (как у выгрузки лидов)
+    - dict с любым list внутри (fallback)
+    """
+    if isinstance(data, list):
+        for it in data:
+            if isinstance(it, dict):
+                yield it
+        return
+
+    if isinstance(data, dict):
+        for v in data.values():
+            if isinstance(v, list):
+                for it in v:
+                    if isinstance(it, dict):
+                        yield it
+
+
+def iter_records(path: Path | str) -> Iterator[dict]:
+    """Лиды из JSON-массива или NDJSON (построчно)."""
+    path = Path(path)
+    if is_ndjson(path):
+        with open(path, "r", encoding="utf-8-sig") as f:
+            for lineno, line in enumerate(f, start=1):
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    rec = json.loads(line)
+                except json.JSONDecodeError as e:
+                    raise ValueError(f"{path}: строка {lineno} не является JSON: {e}") from e
+                if isinstance(rec, dict):
+                    yield rec
+        return
+
+    with open(path, "r", encoding="utf-8-sig") as f:
+        data = json.load(f)
+    yield from iter_json_records(data)
+
+
+def count_records(path: Path | str) -> int:
+    """Число записей; для NDJSON — без разбора JSON (по непустым строкам)."""
+    path = Path(path)
+    if is_ndjson(path):
+        n = 0
+        with open(path, "rb") as f:
+            for line in f:
+                if line.strip():
+                    n += 1
+        return n
+    return sum(1 for _ in iter_records(path))
+
+
+class NdjsonWriter:
+    """
+    Построчная запись лидов в NDJSON через временный файл: итоговый путь появляется
+    только после успешного close(), при исключении внутри with временный файл удаляется.
+    """
+
+    def __init__(self, path: Path | str):
+        self.path = Path(path)
+        self.tmp_path = self.path.with_name(self.path.name + ".tmp")
+        self.count = 0
+        self._f = None
+
+    def __enter__(self) -> "NdjsonWriter":
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self._f = open(self.tmp_path, "w", encoding="utf-8")
+        return self
+
+    def write(self, record: dict) -> None:
+        self._f.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")))
+        self._f.write("\n")
+        self.count += 1
+
+    def write_many(self, records: Iterable[dict]) -> None:
+        for rec in records:
+            self.write(rec)
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self._f.close()
+        if exc_type is None:
+            os.replace(self.tmp_path, self.path)
+        else:
+            try:
+                self.tmp_path.unlink()
+            except OSError:
+                pass
+
+
+def write_records(path: Path | str, records: Iterable[dict]) -> int:
+    """Пишет записи в формате по расширению (NDJSON потоково, JSON — массивом с indent=2)."""
+    path = Path(path)
+    if is_ndjson(path):
+        with NdjsonWriter(path) as w:
+            w.write_many(records)
+        return w.count
+
+    data = list(records)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+    return len(data)
+
+
+def dedupe_ndjson_keep_last(path: Path | str) -> int:
+    """
+    Оставляет в NDJSON последнее вхождение каждого id (два прохода, в памяти только id).
+    Возвращает число удалённых строк.
+    """
+    path = Path(path)
+    last_line: dict = {}
+    for i, rec in enumerate(iter_records(path)):
+        last_line[rec.get("id")] = i
+
+    total = i + 1 if last_line else 0
+    if len(last_line) == total:
+        return 0
+
+    records = (rec for i, rec in enumerate(iter_records(path)) if last_line.get(rec.get("id")) == i)
+    tmp_out = path.with_name(path.name + ".dedup.ndjson")
+    kept = write_records(tmp_out, records)
+    os.replace(tmp_out, path)
+    return total - kept
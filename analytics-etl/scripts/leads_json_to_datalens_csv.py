@@ -5,18 +5,28 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 if str(BASE_DIR) not in sys.path:
     sys.path.insert(0, str(BASE_DIR))
 
-import json
 import csv
+import os
 import re
 import argparse
+import multiprocessing
 import sys
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
 from pathlib import Path
 from datetime import datetime, timezone
 from scripts.clients_map import get_client_id
+from scripts.custom_fields import FieldIndex, load_field_index
+from scripts.lead_fingerprints import LeadFingerprintStore, open_store
+from scripts.leads_io import NdjsonWriter, is_ndjson, iter_records
+from scripts.source_rules import RuleSet, load_rules
 from scripts.transform_utils import (
     clean_text,
-    fix_mojibake,
-    normalize_phone,
+    format_normalizer_stats,
+    merge_normalizer_stats,
+    normalizer_cache_stats,
     parse_name_fields,
     extract_utm as extract_custom_fields,
 )
@@ -25,10 +35,6 @@ BASE_DIR = Path(__file__).resolve().parent.parent
 DEFAULT_INPUT_FILE = BASE_DIR / "data" / "add_leads_crm_with_client.json"
 DEFAULT_OUTPUT_FILE = BASE_DIR / "data" / "add_leads_crm_flat_datalens.csv"
 
-# client_slug берём из параметра запуска при запуске как скрипт; при импорте — дефолт
-CLIENT_SLUG = "artroyal_detailing"
-CLIENT_ID = get_client_id(CLIENT_SLUG)
-
 BASE_FIELDS = [
     "client_id",
     "client_slug",
@@ -73,11 +79,11 @@ EXTRA_FIELDS = [
 
 FIELDS = BASE_FIELDS + DATE_FIELDS + EXTRA_FIELDS
 
+# лидов в одной пачке leads_to_rows (env ETL_TRANSFORM_CHUNK)
+TRANSFORM_CHUNK = 2000
+
 TAG_RE = re.compile(r"<[^>]+>")
 PHONE_RE = re.compile(r"\+?\d[\d\s\-\(\)]{8,}\d")
-DEAL_ONLY_RE = re.compile(r"^\s*сделка\s*#\s*\d+\s*$", re.IGNORECASE)
-SITE_MARKER = "artroyal-detailing.ru"
-VA_SIP_RE = re.compile(r"\b(?:va|sip)\b", re.IGNORECASE)
 
 
 def ts_to_iso(ts):
@@ -108,63 +114,269 @@ def extract_tags(lead: dict) -> str:
     # убираем дубли, сортируем чтобы было стабильно
     return "; ".join(sorted(set(names)))
 
-def apply_rules(row: dict) -> dict:
+
+def apply_rules(row: dict, rules: RuleSet | None = None) -> dict:
+    """
+    source / channel по правилам клиента (scripts/source_rules.py, config/source_rules/<client_slug>.json;
+    по умолчанию — default.json): оффлайн‑сделка «Сделка #123», звонок по name, домен сайта клиента,
+    тег instagram; source без сработавших правил — очистка, va/sip → «звонок», lower().
+    """
+    if rules is None:
+        rules = load_rules(str(row.get("client_slug") or ""))
+    return rules.apply(row)
+
+
+def _iter_changed(leads, store: LeadFingerprintStore, *, skip_unchanged: bool, counter: dict, chunk: int = 500):
+    """Лиды без неизменившихся (по отпечаткам store); отпечатки остальных — в pending."""
+    buf: list[dict] = []
+    for lead in leads:
+        buf.append(lead)
+        if len(buf) >= chunk:
+            out, skipped = store.changed(buf, skip_unchanged=skip_unchanged)
+            counter["skipped"] += skipped
+            yield from out
+            buf = []
+    if buf:
+        out, skipped = store.changed(buf, skip_unchanged=skip_unchanged)
+        counter["skipped"] += skipped
+        yield from out
+
+
+class TransformCache:
+    """
+    Результаты по уникальным значениям колонок для leads_to_rows (даты, очистка name, состояние полей
+    правил): значение, повторяющееся в пачке, считается один раз. Общий на весь запуск; словарь,
+    переросший max_entries (уникальные имена, телефоны), очищается между пачками. Разбор name и
+    отдельные строки (значения кастомных полей, теги) идут через LRU-кэши transform_utils.
+    """
+
+    def __init__(self, max_entries: int = 200_000):
+        self.max_entries = max_entries
+        self.memos: dict[str, dict] = {}
+
+    def column(self, name: str, fn, values: list) -> list:
+        """fn над колонкой: вычисляется только для значений, которых ещё нет в кэше."""
+        cache = self.memos.setdefault(name, {})
+        for v in dict.fromkeys(values):
+            if v not in cache:
+                cache[v] = fn(v)
+        return [cache[v] for v in values]
+
+    def trim(self) -> None:
+        for cache in self.memos.values():
+            if len(cache) > self.max_entries:
+                cache.clear()
+
+
+def leads_to_rows(
+    leads: list[dict],
+    client_id: int,
+    client_slug: str,
+    cache: TransformCache | None = None,
+    rules: RuleSet | None = None,
+    fields: FieldIndex | None = None,
+) -> list[dict]:
+    """
+    Пачка лидов → плоские строки FIELDS (как в CSV для DataLens / ClickHouse), по колонкам:
+    даты, очистка и разбор name, правила source/channel считаются по уникальным
+    значениям колонки, а не заново для каждого лида. fields — индекс кастомных полей клиента
+    (по умолчанию load_field_index).
+    """
+    cache = cache or TransformCache()
+    fields = fields or load_field_index(client_slug)
+    cache.trim()
+
+    rows = [{k: lead.get(k, "") for k in BASE_FIELDS} for lead in leads]
+    for row in rows:
+        row["client_id"] = client_id
+        row["client_slug"] = client_slug
+
+    # даты: timestamp -> ISO (UTC), *_at и *_dt — одно значение
+    for at, dt in (("created_at", "created_dt"), ("updated_at", "updated_dt"), ("closed_at", "closed_dt")):
+        iso = cache.column("ts_to_iso", ts_to_iso, [row[at] for row in rows])
+        for row, value in zip(rows, iso):
+            row[at] = row[dt] = value
+
+    # name: очистка и разбор (канал, телефон, имя без префиксов)
+    names = cache.column("name", clean_text, [str(row.get("name", "")) for row in rows])
+    # parse_name_fields уже с LRU-кэшем в transform_utils — второй словарь здесь не нужен
+    parsed = [parse_name_fields(name) for name in names]
+    for row, name, (channel, phone_from_name, name_clean) in zip(rows, names, parsed):
+        row["name"] = name
+        row["channel"] = channel
+        row["phone_from_name"] = phone_from_name
+        row["name_clean"] = name_clean
+
+    # кастомные поля и теги — вложенные списки, разбираются по лиду: роль поля — по field_id из индекса,
+    # очистка значений — через LRU-кэш clean_text
+    for row, lead in zip(rows, leads):
+        row.update(extract_custom_fields(lead.get("custom_fields_values"), fields=fields))
+        row["tags"] = extract_tags(lead)
+
+    _apply_rules_columns(rows, cache, rules or load_rules(client_slug))
+    return rows
+
+
+def _apply_rules_columns(rows: list[dict], cache: TransformCache, rules: RuleSet) -> None:
+    """apply_rules пачкой: состояние полей условий (очистка + поиск подстрок) — по уникальным значениям."""
+    memo = f"rule_state:{rules.name}:{rules.digest}"
+    states = {
+        f: cache.column(memo, rules.field_state, [str(row.get(f, "")) for row in rows]) for f in rules.fields
+    }
+    for i, row in enumerate(rows):
+        rules.apply(row, {f: column[i] for f, column in states.items()})
+
+
+def _positive_int_env(name: str, default: int) -> int:
+    raw = (os.getenv(name) or "").strip()
+    if not raw:
+        return default
+    try:
+        n = int(raw)
+    except ValueError as e:
+        raise ValueError(f"{name} должен быть целым числом, получено: {raw!r}") from e
+    return max(1, n)
+
+
+def _workers_from_env() -> int:
     """
-    Правила:
-    - если name == 'Сделка #123' -> source = 'оффлайн'
-    - если встречается artroyal-detailing.ru -> source/channel = 'заявка с сайта'
-    - source: va/sip -> 'звонок'
-    - source lower()
-    - если в name есть 'Сделка по звонку' / 'по звонку' / 'звонок' -> source/channel = 'звонок'
+    Процессов преобразования по умолчанию.
+    Env: ETL_TRANSFORM_WORKERS (целое). Если не задан — 1 (в текущем процессе).
     """
-    name = clean_text(str(row.get("name", "")))
-    low_name = name.lower()
+    return _positive_int_env("ETL_TRANSFORM_WORKERS", 1)
+
 
-    # оффлайн по чистому имени вида "Сделка #123"
-    if DEAL_ONLY_RE.match(name):
-        row["source"] = "оффлайн"
+def _chunk_size_from_env() -> int:
+    return _positive_int_env("ETL_TRANSFORM_CHUNK", TRANSFORM_CHUNK)
 
-    # если по name явно звонок
-    if ("сделка по звонку" in low_name) or ("по звонку" in low_name) or ("звонок" in low_name):
-        row["source"] = "звонок"
-        row["channel"] = "звонок"
 
-    # если где-то есть домен сайта -> заявка с сайта (приоритет выше, чем va/sip)
-    combined = " ".join(
-        clean_text(str(row.get(k, ""))) for k in [
-            "name", "name_clean", "source", "channel",
-            "utm_source", "utm_medium", "utm_campaign", "utm_content", "utm_term", "tags"
-        ]
-    ).lower()
+@dataclass
+class WorkerStats:
+    leads: int = 0
+    chunks: int = 0
+    busy_s: float = 0.0
+    # кэши нормализации воркера с его старта (normalizer_cache_stats за вычетом снимка при запуске)
+    normalize: dict = field(default_factory=dict)
 
-    if SITE_MARKER in combined:
-        row["source"] = "заявка с сайта"
-        row["channel"] = "заявка с сайта"
 
-    # source: va/sip -> звонок (после сайта)
-    src = clean_text(str(row.get("source", "")))
-    if src:
-        src = VA_SIP_RE.sub("звонок", src)
-        # добиваем варианты типа sip: / SIP-...
-        src = re.sub(r"(?i)sip", "звонок", src)
-        src = re.sub(r"(?i)\bva\b", "звонок", src)
-        src = src.lower()
+# состояние процесса-воркера: свои TransformCache, правила и индекс полей на весь запуск
+_WORKER: dict = {}
+
+
+def _init_worker(client_id: int, client_slug: str) -> None:
+    _WORKER.update(
+        client_id=client_id,
+        client_slug=client_slug,
+        cache=TransformCache(),
+        rules=load_rules(client_slug),
+        fields=load_field_index(client_slug),
+        # снимок на старте воркера: счётчики кэшей нормализации — только за его пачки
+        normalize_since=normalizer_cache_stats(),
+    )
+
+
+def _transform_chunk(chunk: list[dict]) -> tuple[list[dict], int, float, dict, dict, dict]:
+    """
+    leads_to_rows в воркере: строки, pid, время, срабатывания правил и новые поля этой пачки (с ролями),
+    кэши нормализации воркера с его старта.
+    """
+    started = time.perf_counter()
+    rules, fields = _WORKER["rules"], _WORKER["fields"]
+    rules.reset_stats()
+    fields.reset_stats()
+    rows = leads_to_rows(chunk, _WORKER["client_id"], _WORKER["client_slug"], _WORKER["cache"], rules, fields)
+    return (
+        rows,
+        os.getpid(),
+        time.perf_counter() - started,
+        dict(rules.fired),
+        fields.learned(),
+        normalizer_cache_stats(since=_WORKER["normalize_since"]),
+    )
 
-    row["source"] = src
 
-    ## ФИНАЛЬНОЕ ПРАВИЛО: если среди тегов есть instagram — source всегда instagram
-    tags = [t.strip() for t in clean_text(str(row.get("tags", ""))).lower().split(";") if t.strip()]
-    if "instagram" in tags:
-        row["source"] = "instagram"
+def transform_parallel(
+    chunks,
+    client_id: int,
+    client_slug: str,
+    *,
+    workers: int,
+    rules: RuleSet,
+    fields: FieldIndex,
+    stats: dict[int, WorkerStats],
+):
+    """
+    Пачки лидов → пачки строк в пуле из workers процессов, в исходном порядке. В работе не больше
+    2 × workers пачек, так что вход читается по мере записи результата. Срабатывания правил и новые
+    кастомные поля (с ролями) сводятся в rules / fields текущего процесса, время по воркерам — в stats (pid →).
 
-    if isinstance(row.get("channel"), str):
-        row["channel"] = clean_text(row["channel"])
+    Воркеры стартуют через forkserver, а не fork: шаг может выполняться внутри процесса с потоками и
+    открытыми соединениями (in-process шаги run_pipeline), и fork такого процесса может повиснуть на
+    чужой блокировке. Воркер импортирует модуль заново и сам загружает правила и индекс полей.
+    """
+    pool = ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context("forkserver"),
+        initializer=_init_worker,
+        initargs=(client_id, client_slug),
+    )
+    pending: deque = deque()
+
+    def collect(future) -> list[dict]:
+        rows, pid, busy_s, fired, learned, normalize = future.result()
+        st = stats.setdefault(pid, WorkerStats())
+        st.leads += len(rows)
+        st.chunks += 1
+        st.busy_s += busy_s
+        st.normalize = normalize
+        rules.fired.update(fired)
+        rules.rows += len(rows)
+        fields.learn(learned)
+        return rows
 
-    return row
+    try:
+        for chunk in chunks:
+            pending.append(pool.submit(_transform_chunk, chunk))
+            if len(pending) >= 2 * workers:
+                yield collect(pending.popleft())
+        while pending:
+            yield collect(pending.popleft())
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+
+
+def format_worker_stats(stats: dict[int, WorkerStats], elapsed_s: float) -> list[str]:
+    total = sum(st.leads for st in stats.values())
+    lines = [
+        f"Преобразование: процессов {len(stats)}, лидов {total} за {elapsed_s:.1f} c "
+        f"({total / elapsed_s if elapsed_s > 0 else 0:.0f} лидов/с)"
+    ]
+    for pid, st in sorted(stats.items()):
+        rate = st.leads / st.busy_s if st.busy_s > 0 else 0
+        lines.append(f"  воркер {pid}: пачек {st.chunks}, лидов {st.leads}, в работе {st.busy_s:.1f} c ({rate:.0f} лидов/с)")
+    return lines
+
+
+def _normalizer_stats_line(stats: dict[int, WorkerStats], since: dict) -> str:
+    """Кэши нормализации за запуск: сумма по воркерам или текущего процесса с начала запуска."""
+    if stats:
+        return format_normalizer_stats(merge_normalizer_stats([st.normalize for st in stats.values()]))
+    return format_normalizer_stats(normalizer_cache_stats(since=since))
+
+
+def _chunks(leads, size: int):
+    chunk: list[dict] = []
+    for lead in leads:
+        chunk.append(lead)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
 
 
 # --- main ---
-if __name__ == "__main__":
+def main(argv: list[str] | None = None) -> None:
     # Backward compatible:
     # - old style: python leads_json_to_datalens_csv.py <client_slug>
     # - new style: python leads_json_to_datalens_csv.py --client-slug <slug> --in ... --out ...
@@ -176,70 +388,124 @@ if __name__ == "__main__":
         default=None,
         help="client_slug клиента (PostgreSQL / client_registry; fallback — clients_map)",
     )
-    p.add_argument("--in", dest="in_path", default=str(DEFAULT_INPUT_FILE), help="Путь к входному JSON")
-    p.add_argument("--out", dest="out_path", default=str(DEFAULT_OUTPUT_FILE), help="Путь к выходному CSV")
-    args = p.parse_args()
-
-    CLIENT_SLUG = (args.client_slug or args.client_slug_pos)
-    if not CLIENT_SLUG:
+    p.add_argument(
+        "--in",
+        dest="in_path",
+        default=str(DEFAULT_INPUT_FILE),
+        help="Путь к входному JSON (или NDJSON: *.ndjson / *.jsonl — читается построчно)",
+    )
+    p.add_argument(
+        "--out",
+        dest="out_path",
+        default=str(DEFAULT_OUTPUT_FILE),
+        help="Путь к выходному CSV (или *.ndjson — плоские строки для load_leads_csv_to_clickhouse)",
+    )
+    p.add_argument(
+        "--fingerprints",
+        choices=["incremental", "full"],
+        default=None,
+        help="Отпечатки лидов (scripts/lead_fingerprints.py): incremental — пропустить лиды, не изменившиеся "
+        "с прошлой загрузки; full — ничего не пропускать, отпечатки заменить целиком. Фиксирует run_pipeline "
+        "после загрузки в ClickHouse.",
+    )
+    p.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Процессов преобразования (env ETL_TRANSFORM_WORKERS, по умолчанию 1 — в текущем процессе). "
+        "Порядок строк на выходе — как у входа.",
+    )
+    p.add_argument(
+        "--chunk-size",
+        type=int,
+        default=None,
+        help=f"Лидов в пачке преобразования (env ETL_TRANSFORM_CHUNK, по умолчанию {TRANSFORM_CHUNK})",
+    )
+    args = p.parse_args(argv)
+    workers = args.workers if args.workers is not None else _workers_from_env()
+    chunk_size = args.chunk_size if args.chunk_size is not None else _chunk_size_from_env()
+    if workers < 1 or chunk_size < 1:
+        p.error("--workers и --chunk-size должны быть >= 1")
+
+    client_slug = (args.client_slug or args.client_slug_pos)
+    if not client_slug:
         raise SystemExit("ERROR: required --client-slug (or legacy positional client_slug).")
-    CLIENT_ID = get_client_id(CLIENT_SLUG)
+    client_id = get_client_id(client_slug)
 
     in_path = Path(args.in_path)
     out_path = Path(args.out_path)
 
-    with open(in_path, "r", encoding="utf-8") as f:
-        leads = json.load(f)
-
-    out_path.parent.mkdir(parents=True, exist_ok=True)
-    with open(out_path, "w", newline="", encoding="utf-8-sig") as f:
-        writer = csv.DictWriter(
-            f,
-            fieldnames=FIELDS,
-            delimiter=";",
-            quoting=csv.QUOTE_MINIMAL  # без лишних кавычек
-        )
-        writer.writeheader()
-
-        for lead in leads:
-            row = {k: lead.get(k, "") for k in BASE_FIELDS}
-
-            # принудительно проставляем корректного клиента
-            row["client_id"] = CLIENT_ID
-            row["client_slug"] = CLIENT_SLUG
-
-            # ===== даты: timestamp -> ISO (UTC) =====
-            created_iso = ts_to_iso(row.get("created_at"))
-            updated_iso = ts_to_iso(row.get("updated_at"))
-            closed_iso = ts_to_iso(row.get("closed_at"))
-
-            # Основные поля (для ClickHouse и отчётов) — делаем нормальными DateTime-строками
-            row["created_at"] = created_iso
-            row["updated_at"] = updated_iso
-            row["closed_at"] = closed_iso
-
-            # Дубли для DataLens (можно оставить)
-            row["created_dt"] = created_iso
-            row["updated_dt"] = updated_iso
-            row["closed_dt"] = closed_iso
-
-            # чистим name и распаковываем из него поля
-            row["name"] = clean_text(str(row.get("name", "")))
-            channel, phone_from_name, name_clean = parse_name_fields(row["name"])
-            row["channel"] = channel
-            row["phone_from_name"] = phone_from_name
-            row["name_clean"] = name_clean
-
-            # кастомные поля
-            row.update(extract_custom_fields(lead.get("custom_fields_values")))
-
-            # теги
-            row["tags"] = extract_tags(lead)
-
-            # правила по source/channel
-            row = apply_rules(row)
-
-            writer.writerow(row)
-
-    print("Готово. CSV сохранён:", out_path)
-    print("Лидов выгружено:", len(leads))
\ No newline at end of file
+    # JSON-массив читается целиком; NDJSON (*.ndjson / *.jsonl) — построчно, по одному лиду
+    leads = iter_records(in_path)
+    n_leads = 0
+    store = open_store(client_slug, client_id) if args.fingerprints else None
+    unchanged = {"skipped": 0}
+    try:
+        if store is not None:
+            if store.reset:
+                print("Код преобразования изменился — отпечатки лидов сброшены, все лиды обрабатываются заново")
+            store.begin(full=args.fingerprints == "full")
+            leads = _iter_changed(leads, store, skip_unchanged=args.fingerprints == "incremental", counter=unchanged)
+
+        # преобразование пачками по колонкам (leads_to_rows): очистка — по уникальным значениям;
+        # --workers > 1 — пачки считаются в пуле процессов, запись — здесь же, в исходном порядке
+        rules = load_rules(client_slug)
+        rules.reset_stats()
+        fields = load_field_index(client_slug)
+        fields.reset_stats()
+        worker_stats: dict[int, WorkerStats] = {}
+        normalize_since = normalizer_cache_stats()
+        started = time.monotonic()
+        if workers > 1:
+            batches = transform_parallel(
+                _chunks(leads, chunk_size),
+                client_id,
+                client_slug,
+                workers=workers,
+                rules=rules,
+                fields=fields,
+                stats=worker_stats,
+            )
+        else:
+            cache = TransformCache()
+            batches = (
+                leads_to_rows(chunk, client_id, client_slug, cache, rules, fields) for chunk in _chunks(leads, chunk_size)
+            )
+
+        if is_ndjson(out_path):
+            # *.ndjson на выходе — те же плоские строки по одной на строку файла (типы значений сохраняются)
+            with NdjsonWriter(out_path) as w:
+                for rows in batches:
+                    n_leads += len(rows)
+                    w.write_many(rows)
+            print("Готово. NDJSON сохранён:", out_path)
+        else:
+            out_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(out_path, "w", newline="", encoding="utf-8-sig") as f:
+                writer = csv.writer(
+                    f,
+                    delimiter=";",
+                    quoting=csv.QUOTE_MINIMAL  # без лишних кавычек
+                )
+                writer.writerow(FIELDS)
+
+                for rows in batches:
+                    n_leads += len(rows)
+                    writer.writerows([row.get(k, "") for k in FIELDS] for row in rows)
+            print("Готово. CSV сохранён:", out_path)
+
+        print("Лидов выгружено:", n_leads)
+        if unchanged["skipped"]:
+            print("Пропущено неизменившихся лидов (отпечатки):", unchanged["skipped"])
+        if worker_stats:
+            print("\n".join(format_worker_stats(worker_stats, time.monotonic() - started)))
+        print(rules.format_stats())
+        print(fields.format_stats())
+        print(_normalizer_stats_line(worker_stats, normalize_since))
+        fields.mark_stale_if_unknown()
+    finally:
+        if store is not None:
+            store.close()
+
+if __name__ == "__main__":
+    main()
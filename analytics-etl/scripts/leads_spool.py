@@ -0,0 +1,370 @@
+"""
+Буфер дозагрузок лидов на стороне загрузчика: плоские строки копятся в SQLite-файле клиента
+(var/state/<client_slug>/leads_spool_<table>.sqlite) по партициям факта и уходят в ClickHouse одним
+INSERT на партицию — когда в партиции набралось ETL_CH_SPOOL_ROWS строк или самая старая строка ждёт
+дольше ETL_CH_SPOOL_MAX_AGE_MIN минут.
+
+Зачем: факт партиционирован по (client_id, месяц created_at), и INSERT создаёт по части в каждой
+партиции, которую задел. Инкремент по 15–100 лидов каждые несколько минут на клиента даёт части по
+десятку строк, которые копятся быстрее, чем сливаются («Too many parts»). Асинхронные вставки сервера
+этого не исправляют: строки разных партиций в одну часть не попадают, а вставки одного клиента
+разнесены на минуты и в один буфер сервера не успевают. Буфер загрузчика превращает N маленьких INSERT
+в партицию в один.
+
+Токен дедупликации сохраняется. Сброс сначала закрепляет строки партиции за номером пачки (batch),
+затем вставляет их блоками с токеном (клиент, таблица, партиция, пачка, хэш блока) и только после
+успешного INSERT удаляет. Упавший сброс оставляет пачку как есть — следующий отправит те же блоки
+с теми же токенами, и ClickHouse повтор отбросит.
+
+Watermark при включённом буфере двигается после записи строк в буфер (одна транзакция SQLite):
+в ClickHouse строки появляются с задержкой до ETL_CH_SPOOL_MAX_AGE_MIN. Потерянный файл буфера —
+потерянные не сброшенные строки; восстанавливается полной выгрузкой клиента (--leads-full-refresh).
+Полная перезапись клиента (REPLACE PARTITION) очищает его буфер: в новой версии всё уже есть.
+
+Env:
+  ETL_CH_SPOOL — 1: дозагрузки лидов через буфер (по умолчанию 0)
+  ETL_CH_SPOOL_ROWS — сброс партиции при таком числе строк (по умолчанию 20000)
+  ETL_CH_SPOOL_MAX_AGE_MIN — сброс партиции, когда самая старая строка ждёт столько минут (по умолчанию 30)
+
+Запуск (состояние буфера, сброс):
+  python scripts/leads_spool.py --client-slug <slug>                 # что лежит в буфере
+  python scripts/leads_spool.py --client-slug <slug> --flush [--force]
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import Iterable
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+if str(BASE_DIR) not in sys.path:
+    sys.path.insert(0, str(BASE_DIR))
+
+from scripts.leads_ch_rows import DEFAULT_LEADS_TABLE, LEADS_INSERT_COLUMNS, LeadColumns, to_datetime
+
+STATE_DIR = BASE_DIR / "var" / "state"
+DEFAULT_FLUSH_BLOCK_ROWS = 50_000
+
+
+def spool_enabled_from_env() -> bool:
+    return (os.getenv("ETL_CH_SPOOL") or "0").strip() == "1"
+
+
+def _positive_env(name: str, default: float) -> float:
+    raw = (os.getenv(name) or "").strip()
+    if not raw:
+        return default
+    try:
+        value = float(raw)
+    except ValueError as e:
+        raise ValueError(f"{name} должен быть числом, получено: {raw!r}") from e
+    if value <= 0:
+        raise ValueError(f"{name} должен быть > 0, получено: {raw!r}")
+    return value
+
+
+def spool_path(client_slug: str, table: str = DEFAULT_LEADS_TABLE) -> Path:
+    return STATE_DIR / client_slug / f"leads_spool_{table}.sqlite"
+
+
+def partition_of(row: dict) -> str:
+    """Месяц created_at строки (YYYYMM) — вторая часть ключа партиционирования факта (sql/migrations/0001)."""
+    created = to_datetime(row.get("created_dt"))
+    # assumeNotNull(NULL) в ClickHouse — 1970-01-01
+    return f"{created:%Y%m}" if created is not None else "197001"
+
+
+@dataclass
+class SpoolPartition:
+    partition: str
+    rows: int
+    oldest_ts: float
+    batched: bool
+
+    def age_min(self, now: float) -> float:
+        return (now - self.oldest_ts) / 60
+
+
+@dataclass
+class FlushResult:
+    partitions: int = 0
+    rows: int = 0
+    inserts: int = 0
+    skipped: int = 0
+
+
+class LeadsSpool:
+    """
+    Строки дозагрузки одного клиента и одной таблицы факта, сгруппированные по партиции.
+    Соединение можно передать в другой поток (fused-режим), но использовать одновременно из двух нельзя.
+    """
+
+    def __init__(self, path: Path, *, client_id: int, table: str = DEFAULT_LEADS_TABLE):
+        self.path = Path(path)
+        self.client_id = client_id
+        self.table = table
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.conn.executescript(
+            """
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS spool (
+                seq INTEGER PRIMARY KEY AUTOINCREMENT,
+                partition TEXT NOT NULL,
+                added_ts REAL NOT NULL,
+                batch INTEGER,
+                row TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS spool_partition ON spool (partition, batch);
+            CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+            """
+        )
+
+    def __len__(self) -> int:
+        return int(self.conn.execute("SELECT count() FROM spool").fetchone()[0])
+
+    def append(self, rows: Iterable[dict]) -> int:
+        """Записывает плоские строки лидов (FIELDS) одной транзакцией; возвращает их число."""
+        now = time.time()
+        items = [
+            (partition_of(row), now, json.dumps(row, ensure_ascii=False, separators=(",", ":"), default=str))
+            for row in rows
+        ]
+        with self.conn:
+            self.conn.executemany("INSERT INTO spool (partition, added_ts, row) VALUES (?, ?, ?)", items)
+        return len(items)
+
+    def partitions(self) -> list[SpoolPartition]:
+        return [
+            SpoolPartition(str(p), int(n), float(ts), bool(b))
+            for p, n, ts, b in self.conn.execute(
+                "SELECT partition, count(), min(added_ts), max(batch IS NOT NULL) FROM spool "
+                "GROUP BY partition ORDER BY partition"
+            )
+        ]
+
+    def due(self, *, max_rows: int, max_age_s: float, force: bool = False) -> list[str]:
+        """Партиции, которые пора сбросить; недосланная пачка прошлого сброса — всегда."""
+        now = time.time()
+        return [
+            p.partition
+            for p in self.partitions()
+            if force or p.batched or p.rows >= max_rows or now - p.oldest_ts >= max_age_s
+        ]
+
+    def _next_batch(self) -> int:
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'batch'").fetchone()
+        batch = int(row[0]) + 1 if row else 1
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('batch', ?)", (str(batch),))
+        return batch
+
+    def _claim(self, partition: str) -> list[int]:
+        """Номера пачек партиции: недосланные и новая — для строк, ещё ни за кем не закреплённых."""
+        with self.conn:
+            batches = [
+                int(b)
+                for (b,) in self.conn.execute(
+                    "SELECT DISTINCT batch FROM spool WHERE partition = ? AND batch IS NOT NULL ORDER BY batch",
+                    (partition,),
+                )
+            ]
+            if self.conn.execute(
+                "SELECT 1 FROM spool WHERE partition = ? AND batch IS NULL LIMIT 1", (partition,)
+            ).fetchone():
+                batch = self._next_batch()
+                self.conn.execute("UPDATE spool SET batch = ? WHERE partition = ? AND batch IS NULL", (batch, partition))
+                batches.append(batch)
+        return batches
+
+    def _send_batch(
+        self,
+        ch,
+        full_table: str,
+        partition: str,
+        batch: int,
+        *,
+        block_rows: int,
+        dedup: bool,
+        result: FlushResult,
+        log,
+    ) -> None:
+        from scripts.clickhouse_db import dedup_token, insert_block
+
+        etl_loaded_at = datetime.now(timezone.utc).replace(tzinfo=None)
+        cols = LeadColumns(client_id=self.client_id, etl_loaded_at=etl_loaded_at, digest=dedup)
+        block = 0
+
+        def send() -> None:
+            nonlocal block
+            if not len(cols):
+                return
+            block += 1
+            window = f"spool:{partition}:{batch}:{block}"
+            token = dedup_token(self.client_id, self.table, window, cols.digest()) if dedup else None
+            insert_block(
+                ch,
+                full_table,
+                cols.columns(),
+                column_names=LEADS_INSERT_COLUMNS,
+                column_oriented=True,
+                token=token,
+                log=log,
+            )
+            result.rows += len(cols)
+            result.inserts += 1
+            cols.clear()
+
+        rows = self.conn.execute("SELECT row FROM spool WHERE batch = ? ORDER BY seq", (batch,)).fetchall()
+        for (raw,) in rows:
+            cols.append(json.loads(raw))
+            if len(cols) >= block_rows:
+                send()
+        send()
+        result.skipped += cols.skipped
+        with self.conn:
+            self.conn.execute("DELETE FROM spool WHERE batch = ?", (batch,))
+
+    def flush(
+        self,
+        ch,
+        db: str,
+        *,
+        force: bool = False,
+        max_rows: int | None = None,
+        max_age_s: float | None = None,
+        block_rows: int = DEFAULT_FLUSH_BLOCK_ROWS,
+        log=print,
+    ) -> FlushResult:
+        """
+        Сбрасывает в {db}.{table} партиции, набравшие max_rows строк или ждущие дольше max_age_s
+        (force — все). Один INSERT на партицию (больше — только если строк больше block_rows).
+        """
+        max_rows = max_rows if max_rows is not None else int(_positive_env("ETL_CH_SPOOL_ROWS", 20_000))
+        max_age_s = max_age_s if max_age_s is not None else _positive_env("ETL_CH_SPOOL_MAX_AGE_MIN", 30) * 60
+        dedup = (os.getenv("ETL_INSERT_DEDUP") or "1").strip() != "0"
+        full_table = f"{db}.{self.table}"
+        result = FlushResult()
+        for partition in self.due(max_rows=max_rows, max_age_s=max_age_s, force=force):
+            for batch in self._claim(partition):
+                self._send_batch(
+                    ch, full_table, partition, batch, block_rows=block_rows, dedup=dedup, result=result, log=log
+                )
+            result.partitions += 1
+        return result
+
+    def clear(self) -> int:
+        """Удаляет все строки буфера (после полной перезаписи клиента); возвращает их число."""
+        with self.conn:
+            return self.conn.execute("DELETE FROM spool").rowcount
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+def open_spool(client_slug: str, client_id: int, table: str = DEFAULT_LEADS_TABLE) -> LeadsSpool:
+    return LeadsSpool(spool_path(client_slug, table), client_id=client_id, table=table)
+
+
+def format_spool_state(spool: LeadsSpool) -> str:
+    parts = spool.partitions()
+    if not parts:
+        return f"Буфер {spool.table}: пуст"
+    now = time.time()
+    oldest = max(p.age_min(now) for p in parts)
+    return (
+        f"Буфер {spool.table}: {sum(p.rows for p in parts)} строк в {len(parts)} партициях, "
+        f"старейшая ждёт {oldest:.0f} мин"
+    )
+
+
+def flush_spool(
+    client_slug: str,
+    client_id: int,
+    *,
+    table: str = DEFAULT_LEADS_TABLE,
+    force: bool = False,
+    spool: LeadsSpool | None = None,
+    log=print,
+) -> FlushResult:
+    """
+    Сбрасывает созревшие партиции буфера клиента (leads_current получает строки через MV).
+    Без файла буфера ничего не делает (ClickHouse не трогается). spool — уже открытый буфер (не закрывается).
+    """
+    if spool is None and not spool_path(client_slug, table).exists():
+        return FlushResult()
+    from scripts.clickhouse_db import get_clickhouse_client
+
+    own = spool is None
+    spool = spool or open_spool(client_slug, client_id, table)
+    try:
+        ch, db = get_clickhouse_client()
+        t0 = time.monotonic()
+        result = spool.flush(ch, db, force=force, log=log)
+        if result.rows:
+            log(
+                f"Буфер: сброшено {result.rows} строк из {result.partitions} партиций "
+                f"({result.inserts} INSERT) за {time.monotonic() - t0:.2f} c"
+                + (f", пропущено с lead_id <= 0: {result.skipped}" if result.skipped else "")
+            )
+        log(format_spool_state(spool))
+        return result
+    finally:
+        if own:
+            spool.close()
+
+
+def discard_spool(client_slug: str, client_id: int, *, table: str = DEFAULT_LEADS_TABLE, log=print) -> int:
+    """Очищает буфер клиента после полной перезаписи (строки буфера — старее новой версии); возвращает их число."""
+    if not spool_path(client_slug, table).exists():
+        return 0
+    spool = open_spool(client_slug, client_id, table)
+    try:
+        n = spool.clear()
+    finally:
+        spool.close()
+    if n:
+        log(f"Буфер {table}: {n} не сброшенных строк отброшено — данные клиента перезаписаны целиком")
+    return n
+
+
+def main(argv: list[str] | None = None) -> None:
+    p = argparse.ArgumentParser(description="Буфер дозагрузок лидов по партициям факта (ETL_CH_SPOOL).")
+    p.add_argument("--client-slug", required=True, help="client_slug клиента")
+    p.add_argument("--ch-table", default=DEFAULT_LEADS_TABLE, help="Таблица факта (без БД)")
+    p.add_argument("--flush", action="store_true", help="Сбросить созревшие партиции в ClickHouse")
+    p.add_argument("--force", action="store_true", help="С --flush: сбросить все партиции, не дожидаясь порогов")
+    args = p.parse_args(argv)
+
+    from scripts.clients_map import get_client_id
+
+    client_id = get_client_id(args.client_slug)
+    path = spool_path(args.client_slug, args.ch_table)
+    if not path.exists():
+        print(f"Буфера нет: {path}")
+        return
+    if args.flush:
+        flush_spool(args.client_slug, client_id, table=args.ch_table, force=args.force)
+        return
+    spool = open_spool(args.client_slug, client_id, args.ch_table)
+    try:
+        now = time.time()
+        print(format_spool_state(spool))
+        for part in spool.partitions():
+            print(
+                f"  {part.partition}: {part.rows} строк, ждёт {part.age_min(now):.0f} мин"
+                + (" (недосланная пачка)" if part.batched else "")
+            )
+    finally:
+        spool.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,343 @@
+"""
+Потоковый (fused) пайплайн лидов: amoCRM → client_id → плоская строка → INSERT в ClickHouse
+за один проход, без промежуточных add_leads_crm*.json и CSV.
+
+Три стадии в отдельных потоках, между ними — очереди ограниченного размера:
+  1) выгрузка страниц из amoCRM (та же пагинация, что в amocrm_export_leads);
+  2) преобразование: add_client_id.tag_record → leads_json_to_datalens_csv.leads_to_rows
+     (transform_utils + apply_rules по колонкам страницы) → leads_ch_rows.to_insert_row,
+     строки собираются в пачки;
+  3) INSERT пачек в ClickHouse с insert_deduplication_token (клиент, таблица, окно since_dt,
+     хэш пачки) — повтор той же пачки ClickHouse отбросит.
+Медленная стадия притормаживает быструю (очередь заполнена — put ждёт), так что в памяти
+не больше ETL_FUSED_QUEUE_PAGES страниц и пары пачек. Ошибка в любой стадии
+останавливает остальные и пробрасывается вызывающему (run_pipeline) — watermark не двигается.
+
+replace=True (полная выгрузка): пачки идут в staging-таблицу, а в конце данные клиента подменяются
+целиком через REPLACE PARTITION (clickhouse_db.swap_client_partitions) — при ошибке на любой стадии
+целевая таблица не меняется.
+
+fingerprints (scripts/lead_fingerprints.py) — лиды, чья запись не изменилась с прошлой загрузки,
+отбрасываются до преобразования (кроме полной выгрузки); отпечатки остальных копятся в pending,
+фиксирует их вызывающий после записи watermark.
+
+Промежуточные файлы пишутся только при artifacts_dir (run_pipeline --leads-artifacts):
+add_leads_crm_with_client.ndjson и add_leads_crm_flat_datalens.csv — для отладки и аудита.
+
+Env:
+  ETL_FUSED_QUEUE_PAGES — ёмкость очереди страниц (по умолчанию 4)
+  ETL_FUSED_BATCH_ROWS — минимальный размер пачки INSERT, набирается целыми страницами (по умолчанию 5000)
+  AMOCRM_EXPORT_WORKERS — параллельная выгрузка страниц, как в amocrm_export_leads
+  ETL_INSERT_DEDUP — 0: не передавать insert_deduplication_token
+  ETL_CH_SPOOL — 1: дозагрузка (не replace) через буфер по партициям, см. scripts/leads_spool.py
+"""
+
+from __future__ import annotations
+
+import csv
+import os
+import queue
+import threading
+import time
+from contextlib import ExitStack
+from dataclasses import dataclass, field
+from datetime import datetime, timezone
+from pathlib import Path
+
+from scripts.add_client_id import tag_record
+from scripts.amocrm_client import format_session_stats, get_valid_access_token
+from scripts.amocrm_export_leads import fetch_lead_pages
+from scripts.clickhouse_db import (
+    SortingKeyCounter,
+    dedup_token,
+    drop_staging,
+    get_clickhouse_client,
+    insert_block,
+    prepare_staging,
+    replace_min_ratio_from_env,
+    rows_content_digest,
+    sorting_key_columns,
+    supports_client_replace,
+    swap_client_partitions,
+)
+from scripts.leads_ch_rows import DEFAULT_LEADS_TABLE, DIGEST_INDEXES, LEADS_INSERT_COLUMNS, to_insert_row
+from scripts.lead_fingerprints import LeadFingerprintStore
+from scripts.leads_current import sync_after_load
+from scripts.leads_io import NdjsonWriter
+from scripts.leads_spool import discard_spool, flush_spool, open_spool, spool_enabled_from_env
+from scripts.custom_fields import load_field_index, refresh_field_cache
+from scripts.leads_json_to_datalens_csv import FIELDS, TransformCache, leads_to_rows
+from scripts.source_rules import load_rules
+from scripts.transform_utils import format_normalizer_stats, normalizer_cache_stats
+
+_UPDATED_DT_IDX = LEADS_INSERT_COLUMNS.index("updated_dt")
+_DONE = object()
+
+
+def _int_env(name: str, default: int) -> int:
+    raw = (os.getenv(name) or "").strip()
+    if not raw:
+        return default
+    try:
+        n = int(raw)
+    except ValueError as e:
+        raise ValueError(f"{name} должен быть целым числом, получено: {raw!r}") from e
+    return max(1, n)
+
+
+class _Stopped(Exception):
+    """Другая стадия упала — текущая выходит, не дожидаясь места в очереди."""
+
+
+def _put(q: queue.Queue, item, stop: threading.Event) -> None:
+    while True:
+        if stop.is_set():
+            raise _Stopped
+        try:
+            q.put(item, timeout=0.2)
+            return
+        except queue.Full:
+            continue
+
+
+def _get(q: queue.Queue, stop: threading.Event):
+    while True:
+        if stop.is_set():
+            raise _Stopped
+        try:
+            return q.get(timeout=0.2)
+        except queue.Empty:
+            continue
+
+
+@dataclass
+class FusedResult:
+    pages: int = 0
+    leads: int = 0
+    leads_unchanged: int = 0
+    rows_inserted: int = 0
+    batches: int = 0
+    max_updated_dt: datetime | None = None
+    elapsed_s: float = 0.0
+    artifacts: list[Path] = field(default_factory=list)
+
+
+def run_fused_leads(
+    client_slug: str,
+    client_id: int,
+    log,
+    *,
+    since_dt: datetime | None = None,
+    artifacts_dir: Path | None = None,
+    table: str = DEFAULT_LEADS_TABLE,
+    replace: bool = False,
+    allow_shrink: bool = False,
+    fingerprints: LeadFingerprintStore | None = None,
+) -> FusedResult:
+    """
+    Выгружает лиды клиента (since_dt — нижняя граница updated_at, None — все) и вставляет их
+    в {db}.{table} пачками. max_updated_dt в результате — максимум updated_dt вставленных строк
+    (то же, что run_pipeline считает по CSV для watermark).
+    replace=True — через staging и REPLACE PARTITION, если таблица партиционирована по client_id
+    (иначе предупреждение и обычная дозагрузка).
+    fingerprints — хранилище отпечатков после begin(): без replace неизменившиеся лиды пропускаются.
+    """
+    queue_pages = _int_env("ETL_FUSED_QUEUE_PAGES", 4)
+    batch_rows = _int_env("ETL_FUSED_BATCH_ROWS", 5000)
+
+    account_domain, access_token = get_valid_access_token(client_slug)
+    refresh_field_cache(client_slug, log=log)
+    normalize_since = normalizer_cache_stats()
+    until_ts: int | None = int(time.time()) if since_dt is not None else None
+
+    # полная выгрузка не пропускает ничего, даже если перезапись откатится к дозагрузке
+    skip_unchanged = not replace
+    ch, db = get_clickhouse_client()
+    if replace and not supports_client_replace(ch, db, table):
+        log(
+            f"WARNING: PARTITION BY {db}.{table} не содержит client_id — перезапись через REPLACE PARTITION невозможна, "
+            "выполняется обычная дозагрузка (примените миграции схемы)."
+        )
+        replace = False
+    staging = prepare_staging(ch, db, table, client_id) if replace else None
+    # staging сверяется по числу уникальных ключей сортировки вставленных строк
+    keys = SortingKeyCounter(LEADS_INSERT_COLUMNS, sorting_key_columns(ch, db, table)) if staging is not None else None
+    full_table = f"{db}.{staging or table}"
+    etl_loaded_at = datetime.now(timezone.utc).replace(tzinfo=None)
+    window = f"since={since_dt:%Y-%m-%dT%H:%M:%S}" if since_dt is not None else "full"
+    dedup = (os.getenv("ETL_INSERT_DEDUP") or "1").strip() != "0"
+    # дозагрузка через буфер: пачки пишутся в буфер клиента, в ClickHouse — созревшие партиции
+    spool = open_spool(client_slug, client_id, table) if staging is None and spool_enabled_from_env() else None
+
+    log(
+        f"Fused: {full_table}, пачка {batch_rows} строк, очередь {queue_pages} стр."
+        + (f", через буфер {spool.path}" if spool is not None else "")
+        + (f", артефакты → {artifacts_dir}" if artifacts_dir else "")
+    )
+
+    pages_q: queue.Queue = queue.Queue(maxsize=queue_pages)
+    batches_q: queue.Queue = queue.Queue(maxsize=2)
+    stop = threading.Event()
+    errors: list[BaseException] = []
+    result = FusedResult()
+
+    def fail(e: BaseException) -> None:
+        errors.append(e)
+        stop.set()
+
+    def export_stage() -> None:
+        try:
+            result.pages = fetch_lead_pages(
+                account_domain,
+                access_token,
+                since_dt,
+                lambda leads: _put(pages_q, leads, stop),
+                until_ts=until_ts,
+                log=log,
+            )
+            _put(pages_q, _DONE, stop)
+        except _Stopped:
+            pass
+        except BaseException as e:
+            fail(e)
+
+    def transform_stage() -> None:
+        try:
+            with ExitStack() as stack:
+                leads_out = csv_out = None
+                if artifacts_dir is not None:
+                    artifacts_dir.mkdir(parents=True, exist_ok=True)
+                    leads_path = artifacts_dir / "add_leads_crm_with_client.ndjson"
+                    csv_path = artifacts_dir / "add_leads_crm_flat_datalens.csv"
+                    leads_out = stack.enter_context(NdjsonWriter(leads_path))
+                    f = stack.enter_context(open(csv_path, "w", newline="", encoding="utf-8-sig"))
+                    csv_out = csv.DictWriter(f, fieldnames=FIELDS, delimiter=";", quoting=csv.QUOTE_MINIMAL)
+                    csv_out.writeheader()
+                    result.artifacts = [leads_path, csv_path]
+
+                batch: list[list] = []
+                flat: list[dict] = []
+                cache = TransformCache()
+                rules = load_rules(client_slug)
+                rules.reset_stats()
+                fields = load_field_index(client_slug)
+                fields.reset_stats()
+                while True:
+                    page = _get(pages_q, stop)
+                    if page is _DONE:
+                        break
+                    for lead in page:
+                        tag_record(lead, client_id, client_slug)
+                    result.leads += len(page)
+                    if fingerprints is not None:
+                        page, skipped = fingerprints.changed(page, skip_unchanged=skip_unchanged)
+                        result.leads_unchanged += skipped
+                    for lead, row in zip(page, leads_to_rows(page, client_id, client_slug, cache, rules, fields)):
+                        if leads_out is not None:
+                            leads_out.write(lead)
+                        if csv_out is not None:
+                            csv_out.writerow(row)
+                        values = to_insert_row(row, client_id=client_id, etl_loaded_at=etl_loaded_at)
+                        if values is not None:
+                            batch.append(values)
+                            if spool is not None:
+                                flat.append(row)
+                    if len(batch) >= batch_rows:
+                        _put(batches_q, (batch, rows_content_digest(batch, DIGEST_INDEXES) if dedup and spool is None else None, flat), stop)
+                        batch, flat = [], []
+                if batch:
+                    _put(batches_q, (batch, rows_content_digest(batch, DIGEST_INDEXES) if dedup and spool is None else None, flat), stop)
+            _put(batches_q, _DONE, stop)
+        except _Stopped:
+            pass
+        except BaseException as e:
+            fail(e)
+
+    threads = [
+        threading.Thread(target=export_stage, name="fused-export", daemon=True),
+        threading.Thread(target=transform_stage, name="fused-transform", daemon=True),
+    ]
+    started = time.monotonic()
+    for t in threads:
+        t.start()
+
+    try:
+        while True:
+            item = _get(batches_q, stop)
+            if item is _DONE:
+                break
+            batch, digest, flat = item
+            t0 = time.monotonic()
+            if spool is not None:
+                spool.append(flat)
+            else:
+                token = dedup_token(client_id, table, window, digest) if digest is not None else None
+                insert_block(ch, full_table, batch, column_names=LEADS_INSERT_COLUMNS, token=token, log=log)
+                if keys is not None:
+                    keys.add_rows(batch)
+            result.batches += 1
+            result.rows_inserted += len(batch)
+            for values in batch:
+                u = values[_UPDATED_DT_IDX]
+                if u is not None and (result.max_updated_dt is None or u > result.max_updated_dt):
+                    result.max_updated_dt = u
+            log(
+                f"Fused: {'в буфер' if spool is not None else 'INSERT'} #{result.batches}: {len(batch)} строк "
+                f"за {time.monotonic() - t0:.2f} c "
+                f"(всего {result.rows_inserted}, лидов прочитано {result.leads})"
+            )
+    except _Stopped:
+        pass
+    except BaseException as e:
+        fail(e)
+    finally:
+        for t in threads:
+            t.join()
+
+    if errors:
+        if staging is not None:
+            drop_staging(ch, db, staging)
+        if spool is not None:
+            spool.close()
+        raise errors[0]
+    if staging is not None:
+        swap_client_partitions(
+            ch,
+            db,
+            table,
+            staging,
+            client_id,
+            expected_keys=len(keys),
+            key_column="lead_id",
+            min_ratio=replace_min_ratio_from_env(),
+            allow_shrink=allow_shrink,
+            log=log,
+        )
+        discard_spool(client_slug, client_id, table=table, log=log)
+    if spool is not None:
+        # строки уже в буфере (watermark можно двигать); в ClickHouse — созревшие партиции
+        try:
+            flush_spool(client_slug, client_id, table=table, spool=spool, log=log)
+        except Exception as e:
+            log(f"WARNING: сброс буфера не удался ({e}) — строки остаются в буфере, повтор при следующем запуске")
+        finally:
+            spool.close()
+    elif result.rows_inserted:
+        sync_after_load(ch, db, client_id, replaced=staging is not None, source=table, log=log)
+    result.elapsed_s = time.monotonic() - started
+
+    if result.max_updated_dt is not None:
+        result.max_updated_dt = result.max_updated_dt.replace(tzinfo=timezone.utc)
+    log(
+        f"Fused: страниц {result.pages}, лидов {result.leads}"
+        + (f" (не изменились: {result.leads_unchanged})" if result.leads_unchanged else "")
+        + f", {'в буфер' if spool is not None else 'вставлено'} строк {result.rows_inserted} "
+        f"({result.batches} {'пачек' if spool is not None else 'INSERT'}) за {result.elapsed_s:.1f} c"
+    )
+    log(load_rules(client_slug).format_stats())
+    fields = load_field_index(client_slug)
+    log(fields.format_stats())
+    log(format_normalizer_stats(normalizer_cache_stats(since=normalize_since)))
+    fields.mark_stale_if_unknown()
+    log(format_session_stats())
+    return result
@@ -11,132 +11,306 @@ from scripts.load_dev_env import load_local_env_files
 
 load_local_env_files()
 
-import pandas as pd
-import clickhouse_connect
-from pathlib import Path
+import csv
+import gc
+import time
 from datetime import datetime, timezone
+from typing import Iterator
+
+from scripts.clickhouse_db import (
+    SortingKeyCounter,
+    dedup_token,
+    drop_staging,
+    get_clickhouse_client,
+    insert_block,
+    prepare_staging,
+    replace_min_ratio_from_env,
+    sorting_key_columns,
+    supports_client_replace,
+    swap_client_partitions,
+)
 from scripts.clients_map import get_client_id
-
-BASE_DIR = Path(__file__).resolve().parent.parent
+from scripts.leads_ch_rows import DEFAULT_LEADS_TABLE, LEADS_INSERT_COLUMNS, LeadColumns, to_number
+from scripts.leads_current import sync_after_load
+from scripts.leads_io import is_ndjson, iter_records
+from scripts.leads_spool import discard_spool, flush_spool, open_spool, spool_enabled_from_env
 
 DEFAULT_LEADS_CSV = BASE_DIR / "data" / "add_leads_crm_flat_datalens.csv"
-DEFAULT_TABLE = "leads_fact_v2"
+DEFAULT_TABLE = DEFAULT_LEADS_TABLE
 
+DEFAULT_BLOCK_ROWS = 50_000
+DEFAULT_BLOCK_MB = 32.0
+MIN_BLOCK_ROWS = 1_000
+# блок растёт обратно к заданному размеру, когда RSS ниже этой доли потолка
+RSS_GROW_RATIO = 0.7
 
-def parse_dt(series: pd.Series) -> pd.Series:
-    """
-    Парсим 'YYYY-MM-DD HH:MM:SS' в datetime (без таймзоны),
-    чтобы ClickHouse (DateTime) принял без проблем.
-    """
-    dt = pd.to_datetime(series, errors="coerce")
-    # ClickHouse DateTime обычно без tz, убираем timezone если вдруг появилась
-    try:
-        dt = dt.dt.tz_localize(None)
-    except Exception:
-        pass
-    return dt
+REQUIRED_COLS = [
+    "id",
+    "created_dt",
+    "updated_dt",
+    "closed_dt",
+    "status_id",
+    "pipeline_id",
+    "account_id",
+    "responsible_user_id",
+    "client_slug",
+    "name",
+]
 
 
-def validate_csv(path: Path, *, allow_empty: bool = False) -> pd.DataFrame | None:
+def _iter_csv_rows(path: Path) -> Iterator[dict]:
+    with open(path, "r", encoding="utf-8-sig", newline="") as f:
+        yield from csv.DictReader(f, delimiter=";")
+
+
+def _chain_first(first: dict | None, rest: Iterator[dict]) -> Iterator[dict]:
+    if first is not None:
+        yield first
+        yield from rest
+
+
+def open_source(path: Path) -> tuple[list[str], Iterator[dict]] | None:
     """
-    Базовая валидация CSV перед загрузкой в ClickHouse.
+    Базовая валидация источника перед загрузкой в ClickHouse.
+    Источник — плоские строки лидов: CSV (';', utf-8-sig) или NDJSON (*.ndjson / *.jsonl).
     Проверяем:
     - файл существует;
     - не пустой;
-    - содержит обязательные колонки, которые дальше используются.
+    - содержит обязательные колонки, которые дальше используются
+      (для NDJSON — ключи первой записи).
+    Возвращает (колонки, итератор строк) или None (ошибка уже выведена).
     """
     if not path.exists():
-        print(f"ERROR: CSV не найден: {path}")
+        print(f"ERROR: файл не найден: {path}")
         return None
 
     if path.stat().st_size == 0:
-        print(f"ERROR: CSV пустой (size=0): {path}")
+        print(f"ERROR: файл пустой (size=0): {path}")
         return None
 
     try:
-        df = pd.read_csv(path, sep=";", encoding="utf-8-sig")
+        if is_ndjson(path):
+            rows = iter_records(path)
+            first = next(rows, None)
+            columns = list(first.keys()) if first is not None else []
+            rows = _chain_first(first, rows)
+        else:
+            with open(path, "r", encoding="utf-8-sig", newline="") as f:
+                columns = next(csv.reader(f, delimiter=";"), [])
+            rows = _iter_csv_rows(path)
     except Exception as e:
-        print(f"ERROR: не удалось прочитать CSV {path}: {e}")
+        print(f"ERROR: не удалось прочитать {path}: {e}")
         return None
 
-    if df.empty:
-        if allow_empty:
-            return df
-        print(f"ERROR: CSV прочитан, но не содержит строк: {path}")
-        return None
+    if columns:
+        missing = [c for c in REQUIRED_COLS if c not in columns]
+        if missing:
+            print(
+                "ERROR: в источнике отсутствуют обязательные колонки.\n"
+                f"Файл: {path}\n"
+                f"Нет колонок: {', '.join(missing)}"
+            )
+            return None
 
-    required_cols = [
-        "id",
-        "created_dt",
-        "updated_dt",
-        "closed_dt",
-        "status_id",
-        "pipeline_id",
-        "account_id",
-        "responsible_user_id",
-        "client_slug",
-        "name",
-    ]
-    missing = [c for c in required_cols if c not in df.columns]
-    if missing:
-        print(
-            "ERROR: в CSV отсутствуют обязательные колонки.\n"
-            f"Файл: {path}\n"
-            f"Нет колонок: {', '.join(missing)}"
+    return columns, rows
+
+
+def _assert_row_matches_client(row: dict, client_id: int, client_slug: str) -> None:
+    raw_id = to_number(row.get("client_id"))
+    if isinstance(raw_id, int) and raw_id > 0 and raw_id != client_id:
+        raise ValueError(
+            f"Источник содержит client_id {raw_id} (lead id={row.get('id')}), но ожидается только {client_id}. "
+            "Остановлено, чтобы не повредить данные."
+        )
+    slug = row.get("client_slug")
+    slug = str(slug).strip() if slug is not None else ""
+    if slug and slug != client_slug:
+        raise ValueError(
+            f"Источник содержит client_slug '{slug}' (lead id={row.get('id')}), "
+            f"но ожидается только '{client_slug}'. Остановлено, чтобы не повредить данные."
         )
-        return None
 
-    return df
 
+def _int_env(name: str, default: int) -> int:
+    raw = (os.getenv(name) or "").strip()
+    if not raw:
+        return default
+    try:
+        return int(raw)
+    except ValueError as e:
+        raise ValueError(f"{name} должен быть целым числом, получено: {raw!r}") from e
 
-def _env_required(name: str) -> str:
-    v = os.getenv(name)
-    if v is None or str(v).strip() == "":
-        raise ValueError(f"Не задан env {name} (обязателен).")
-    return v
 
+def _float_env(name: str, default: float) -> float:
+    raw = (os.getenv(name) or "").strip()
+    if not raw:
+        return default
+    try:
+        return float(raw)
+    except ValueError as e:
+        raise ValueError(f"{name} должен быть числом, получено: {raw!r}") from e
 
-def _clickhouse_client():
-    host = _env_required("CLICKHOUSE_HOST")
-    port = int(os.getenv("CLICKHOUSE_PORT", "8123"))
-    user = _env_required("CLICKHOUSE_USER")
-    password = _env_required("CLICKHOUSE_PASSWORD")
-    db = _env_required("CLICKHOUSE_DB")
 
-    client = clickhouse_connect.get_client(
-        host=host,
-        port=port,
-        username=user,
-        password=password,
-        database=db,
-    )
-    return client, db
+def rss_mb() -> float | None:
+    """Текущий RSS процесса в МБ (Linux: /proc/self/statm); где недоступно — None."""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            resident_pages = int(f.read().split()[1])
+        return resident_pages * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
 
 
-def _assert_csv_matches_client(df: pd.DataFrame, client_id: int, client_slug: str) -> None:
-    if "client_id" in df.columns:
-        try:
-            ids = pd.to_numeric(df["client_id"], errors="coerce").dropna().astype("int64").unique().tolist()
-        except Exception:
-            ids = []
-        ids = [int(x) for x in ids if int(x) > 0]
-        if ids and set(ids) != {client_id}:
-            raise ValueError(
-                f"CSV содержит client_id {sorted(set(ids))}, но ожидается только {client_id}. "
-                "Остановлено, чтобы не повредить данные."
-            )
+def precheck_source(rows: Iterator[dict], *, client_id: int, client_slug: str) -> int:
+    """
+    Первый проход по источнику (в памяти — одна строка): чужой client_id / client_slug
+    в любой строке — ValueError до первого INSERT. Возвращает число строк.
+    """
+    n = 0
+    for row in rows:
+        _assert_row_matches_client(row, client_id, client_slug)
+        n += 1
+    return n
 
-    if "client_slug" in df.columns:
-        slugs = df["client_slug"].dropna().astype(str).str.strip()
-        uniq = sorted(set([s for s in slugs.tolist() if s]))
-        if uniq and set(uniq) != {client_slug}:
-            raise ValueError(
-                f"CSV содержит client_slug {uniq}, но ожидается только '{client_slug}'. "
-                "Остановлено, чтобы не повредить данные."
+
+class BlockInserter:
+    """
+    Колоночный INSERT блоками: блок уходит, как только набрал block_rows строк или ~block_bytes.
+    По каждому блоку печатается строк/объём/время/скорость и RSS. При max_rss_mb RSS проверяется
+    каждые MIN_BLOCK_ROWS строк (превышен — блок уходит досрочно) и после каждого INSERT: выше потолка —
+    размер следующих блоков уменьшается вдвое (не ниже MIN_BLOCK_ROWS), а если блок уже минимальный —
+    загрузка прерывается (MemoryError); ниже RSS_GROW_RATIO потолка — размер растёт вдвое обратно
+    к заданному.
+    С dedup_table каждый блок идёт с insert_deduplication_token (клиент, таблица, окно, хэш содержимого):
+    повтор того же блока — после сетевой ошибки или при перезапуске на том же окне — ClickHouse отбросит.
+    keys — счётчик ключей сортировки вставленных строк (для сверки staging при --replace).
+    """
+
+    def __init__(
+        self,
+        client,
+        full_table: str,
+        *,
+        client_id: int,
+        block_rows: int,
+        block_bytes: int,
+        max_rss_mb: float | None = None,
+        dedup_table: str | None = None,
+        window: str = "",
+        keys: SortingKeyCounter | None = None,
+    ):
+        self.client = client
+        self.keys = keys
+        self.client_id = client_id
+        self.dedup_table = dedup_table
+        self.window = window
+        self.full_table = full_table
+        self.target_rows = max(MIN_BLOCK_ROWS, block_rows)
+        self.block_rows = self.target_rows
+        self.block_bytes = max(1, block_bytes)
+        self.max_rss_mb = max_rss_mb
+        etl_loaded_at = datetime.now(timezone.utc).replace(tzinfo=None)
+        self.cols = LeadColumns(client_id=client_id, etl_loaded_at=etl_loaded_at, digest=dedup_table is not None)
+        self.blocks = 0
+        self.rows = 0
+        self.insert_s = 0.0
+        self.peak_rss_mb: float | None = None
+
+    def add(self, row: dict) -> None:
+        self.cols.append(row)
+        n = len(self.cols)
+        if self.max_rss_mb and n % MIN_BLOCK_ROWS == 0:
+            rss = rss_mb()
+            if rss is not None and rss > self.max_rss_mb:
+                print(f"RSS {rss:.0f} МБ > потолка {self.max_rss_mb:.0f} МБ: блок из {n} строк отправляется досрочно")
+                self.flush()
+                return
+        if n >= self.block_rows or self.cols.approx_bytes >= self.block_bytes:
+            self.flush()
+
+    def _adapt_block_rows(self, rss: float) -> None:
+        """После INSERT: уменьшает блок при RSS выше потолка (на минимальном — MemoryError), растит при запасе."""
+        if rss > self.max_rss_mb:
+            if self.block_rows <= MIN_BLOCK_ROWS:
+                raise MemoryError(
+                    f"RSS {rss:.0f} МБ превышает потолок {self.max_rss_mb:.0f} МБ даже при блоке "
+                    f"{MIN_BLOCK_ROWS} строк — увеличьте --max-memory-mb"
+                )
+            new_rows = max(MIN_BLOCK_ROWS, self.block_rows // 2)
+            print(f"RSS {rss:.0f} МБ > потолка {self.max_rss_mb:.0f} МБ: размер блока {self.block_rows} → {new_rows} строк")
+            self.block_rows = new_rows
+        elif self.block_rows < self.target_rows and rss < self.max_rss_mb * RSS_GROW_RATIO:
+            new_rows = min(self.target_rows, self.block_rows * 2)
+            print(
+                f"RSS {rss:.0f} МБ < {RSS_GROW_RATIO:.0%} потолка: размер блока {self.block_rows} → {new_rows} строк"
             )
+            self.block_rows = new_rows
+
+    def flush(self) -> None:
+        n = len(self.cols)
+        if n == 0:
+            return
+        approx_mb = self.cols.approx_bytes / (1024 * 1024)
+        token = None
+        if self.dedup_table is not None:
+            token = dedup_token(self.client_id, self.dedup_table, self.window, self.cols.digest())
+        t0 = time.monotonic()
+        insert_block(
+            self.client,
+            self.full_table,
+            self.cols.columns(),
+            column_names=LEADS_INSERT_COLUMNS,
+            column_oriented=True,
+            token=token,
+        )
+        dt = time.monotonic() - t0
+        if self.keys is not None:
+            self.keys.add_columns(self.cols.columns())
+        self.blocks += 1
+        self.rows += n
+        self.insert_s += dt
+        self.cols.clear()
+        gc.collect()
+
+        rss = rss_mb()
+        if rss is not None:
+            self.peak_rss_mb = rss if self.peak_rss_mb is None else max(self.peak_rss_mb, rss)
+        speed = n / dt if dt > 0 else float("inf")
+        print(
+            f"Блок #{self.blocks}: {n} строк, ~{approx_mb:.1f} МБ, INSERT {dt:.2f} c "
+            f"({speed:,.0f} строк/с), всего {self.rows}"
+            + (f", RSS {rss:.0f} МБ" if rss is not None else "")
+        )
+        if self.max_rss_mb and rss is not None:
+            self._adapt_block_rows(rss)
+
+    @property
+    def skipped(self) -> int:
+        return self.cols.skipped
+
+
+def load_via_spool(rows: Iterator[dict], *, client_slug: str, client_id: int, table: str) -> None:
+    """Дозагрузка через буфер: строки записываются в буфер клиента, созревшие партиции уходят в ClickHouse."""
+    started = time.monotonic()
+    spool = open_spool(client_slug, client_id, table)
+    try:
+        n = spool.append(rows)
+        print(f"Буфер: записано {n} строк ({spool.path})")
+        try:
+            flushed = flush_spool(client_slug, client_id, table=table, spool=spool).rows
+        except Exception as e:
+            # строки уже в буфере: загрузка не должна падать (и повторяться) из-за сброса
+            print(f"WARNING: сброс буфера не удался ({e}) — строки остаются в буфере, повтор при следующем запуске")
+            flushed = 0
+    finally:
+        spool.close()
+    print("OK. Spooled rows:", n, "| inserted from spool:", flushed)
+    print("Client:", client_id, "| slug:", client_slug)
+    print("Mode: append через буфер по партициям")
+    print(f"Всего {time.monotonic() - started:.2f} c")
 
 
-def main():
+def main(argv: list[str] | None = None) -> None:
     p = argparse.ArgumentParser(
         description="Загрузка лидов в ClickHouse (append-only, ReplacingMergeTree по version)."
     )
@@ -145,7 +319,11 @@ def main():
         required=True,
         help="client_slug клиента (PostgreSQL / client_registry; fallback — clients_map)",
     )
-    p.add_argument("--csv-path", default=str(DEFAULT_LEADS_CSV), help="Путь к CSV add_leads_crm_flat_datalens.csv")
+    p.add_argument(
+        "--csv-path",
+        default=str(DEFAULT_LEADS_CSV),
+        help="Путь к CSV add_leads_crm_flat_datalens.csv (или к NDJSON плоских строк: *.ndjson / *.jsonl)",
+    )
     p.add_argument("--ch-table", default=DEFAULT_TABLE, help="Имя таблицы ClickHouse (без БД)")
     p.add_argument("--dry-run", action="store_true", help="Не выполнять INSERT, только проверки и план действий")
     p.add_argument(
@@ -153,110 +331,191 @@ def main():
         action="store_true",
         help="Режим инкрементального CSV (как в пайплайне): пустой CSV допустим, загрузка пропускается.",
     )
-    args = p.parse_args()
+    p.add_argument(
+        "--block-rows",
+        type=int,
+        default=None,
+        help=f"Строк в одном INSERT (env ETL_CH_BLOCK_ROWS, по умолчанию {DEFAULT_BLOCK_ROWS}).",
+    )
+    p.add_argument(
+        "--block-mb",
+        type=float,
+        default=None,
+        help=f"Примерный объём одного INSERT в МБ (env ETL_CH_BLOCK_MB, по умолчанию {DEFAULT_BLOCK_MB:g}).",
+    )
+    p.add_argument(
+        "--max-memory-mb",
+        type=float,
+        default=None,
+        help="Потолок RSS процесса в МБ: при превышении блоки уменьшаются (env ETL_LOAD_MAX_RSS_MB, 0 — без потолка).",
+    )
+    p.add_argument(
+        "--window",
+        default=None,
+        help="Метка окна выгрузки для токена дедупликации INSERT (run_pipeline: since=... или full). "
+        "По умолчанию — своя на каждый запуск (manual=<время запуска>): ручная перезаливка того же CSV "
+        "не отбрасывается как повтор.",
+    )
+    p.add_argument(
+        "--no-dedup-token",
+        action="store_true",
+        help="Не передавать insert_deduplication_token (env ETL_INSERT_DEDUP=0).",
+    )
+    p.add_argument(
+        "--spool",
+        action="store_true",
+        default=None,
+        help="Дозагрузка через буфер по партициям (scripts/leads_spool.py): строки уходят в ClickHouse "
+        "одним INSERT на партицию по ETL_CH_SPOOL_ROWS / ETL_CH_SPOOL_MAX_AGE_MIN "
+        "(env ETL_CH_SPOOL=1; с --replace не используется).",
+    )
+    p.add_argument(
+        "--replace",
+        action="store_true",
+        help="Полная перезапись данных клиента: загрузка в staging-таблицу и REPLACE PARTITION "
+        "(нужен PARTITION BY с client_id; иначе — обычная дозагрузка с предупреждением).",
+    )
+    p.add_argument(
+        "--allow-shrink",
+        action="store_true",
+        help="С --replace: разрешить новую версию, где лидов меньше ETL_REPLACE_MIN_RATIO от текущей.",
+    )
+    args = p.parse_args(argv)
 
     client_slug = args.client_slug
     client_id = get_client_id(client_slug)
     if not isinstance(client_id, int) or client_id <= 0:
         raise ValueError("client_id должен быть положительным целым числом.")
 
-    leads_csv = Path(args.csv_path)
+    block_rows = args.block_rows if args.block_rows is not None else _int_env("ETL_CH_BLOCK_ROWS", DEFAULT_BLOCK_ROWS)
+    block_mb = args.block_mb if args.block_mb is not None else _float_env("ETL_CH_BLOCK_MB", DEFAULT_BLOCK_MB)
+    max_rss = args.max_memory_mb if args.max_memory_mb is not None else _float_env("ETL_LOAD_MAX_RSS_MB", 0.0)
+
+    source = Path(args.csv_path)
     incremental = bool(args.incremental)
-    # 0) валидация CSV перед любыми изменениями в ClickHouse
-    df = validate_csv(leads_csv, allow_empty=incremental)
-    if df is None:
-        # Лог уже выведен в validate_csv
+    # 0) валидация источника перед любыми изменениями в ClickHouse: колонки + client_id / client_slug
+    #    по всем строкам (отдельный потоковый проход — до первого блока INSERT)
+    opened = open_source(source)
+    if opened is None:
+        # Лог уже выведен в open_source
         return
-
-    if incremental and df.empty:
-        print("OK. Incremental: CSV без строк — INSERT не выполняется.")
-        print("Client:", client_id, "| slug:", client_slug)
+    _, rows = opened
+    total = precheck_source(rows, client_id=client_id, client_slug=client_slug)
+
+    # staging заливается целиком и сверяется по ключам вставленных строк — буфер только для дозагрузки
+    spool = (args.spool if args.spool is not None else spool_enabled_from_env()) and not args.replace
+
+    if total == 0:
+        if incremental:
+            print("OK. Incremental: источник без строк — INSERT не выполняется.")
+            print("Client:", client_id, "| slug:", client_slug)
+            if spool and not args.dry_run:
+                # созревшие партиции буфера уходят и без новых строк
+                flush_spool(client_slug, client_id, table=args.ch_table)
+        else:
+            print(f"ERROR: источник прочитан, но не содержит строк: {source}")
         return
 
-    _assert_csv_matches_client(df, client_id=client_id, client_slug=client_slug)
-
-    client, db = _clickhouse_client()
+    client, db = get_clickhouse_client()
     table = args.ch_table
     full_table = f"{db}.{table}"
 
+    replace = bool(args.replace)
+    if replace and not supports_client_replace(client, db, table):
+        print(
+            f"WARNING: PARTITION BY таблицы {full_table} не содержит client_id — перезапись через "
+            "REPLACE PARTITION невозможна, выполняется обычная дозагрузка (примените миграции схемы)."
+        )
+        replace = False
+    min_ratio = replace_min_ratio_from_env()
+    no_dedup = bool(args.no_dedup_token) or (os.getenv("ETL_INSERT_DEDUP") or "1").strip() == "0"
+
     # 1) dry-run: только проверки и вывод плана (без INSERT)
     if args.dry_run:
         print("DRY RUN")
         print("Target table:", full_table)
         print("Client:", client_slug, "id=", client_id)
-        print("CSV:", leads_csv, "rows=", len(df))
-        print("Planned: INSERT rows only (append-only, version = updated_at или etl_loaded_at)")
-        return
-
-    etl_loaded_at = datetime.now(timezone.utc).replace(tzinfo=None)
-
-    # 2) строим датафрейм ровно под схему ClickHouse
-    out = pd.DataFrame()
-    out["client_id"] = client_id
-
-    # CSV.id -> CH.lead_id
-    out["lead_id"] = pd.to_numeric(df.get("id"), errors="coerce").fillna(0).astype("int64")
-
-    # created_at/updated_at/closed_at в CH будем заполнять из *_dt (они уже красивые)
-    out["created_at"] = parse_dt(df.get("created_dt"))
-    out["updated_at"] = parse_dt(df.get("updated_dt"))
-    out["closed_at"] = parse_dt(df.get("closed_dt"))
-
-    # оставим и сами *_dt как отдельные поля (если хочешь хранить их тоже)
-    out["created_dt"] = parse_dt(df.get("created_dt"))
-    out["updated_dt"] = parse_dt(df.get("updated_dt"))
-    out["closed_dt"] = parse_dt(df.get("closed_dt"))
-
-    # числовые поля
-    out["status_id"] = pd.to_numeric(df.get("status_id"), errors="coerce")
-    out["pipeline_id"] = pd.to_numeric(df.get("pipeline_id"), errors="coerce")
-    out["loss_reason_id"] = pd.to_numeric(df.get("loss_reason_id"), errors="coerce")
-    out["price"] = pd.to_numeric(df.get("price"), errors="coerce")
-    out["account_id"] = pd.to_numeric(df.get("account_id"), errors="coerce")
-    out["created_by"] = pd.to_numeric(df.get("created_by"), errors="coerce")
-    out["updated_by"] = pd.to_numeric(df.get("updated_by"), errors="coerce")
-    out["score"] = pd.to_numeric(df.get("score"), errors="coerce")
-
-    # responsible_user_id -> manager_id
-    out["manager_id"] = pd.to_numeric(df.get("responsible_user_id"), errors="coerce")
-
-    # is_deleted -> UInt8 (0/1)
-    if "is_deleted" in df.columns:
-        out["is_deleted"] = pd.to_numeric(df["is_deleted"], errors="coerce").fillna(0).astype("int64")
-    else:
-        out["is_deleted"] = 0
-
-    # строки
-    str_cols = [
-        "client_slug", "name", "utm_source", "utm_medium", "utm_campaign",
-        "utm_content", "utm_term", "source", "phone", "email",
-        "channel", "phone_from_name", "name_clean"
-    ]
-    for col in str_cols:
-        if col in df.columns:
-            out[col] = df[col].astype("string")
+        print("Source:", source, "rows=", total)
+        if replace:
+            print(
+                f"Planned: INSERT блоками по {block_rows} строк / ~{block_mb:g} МБ в staging, затем REPLACE PARTITION "
+                f"партиций клиента (защита от сокращения: {'выкл.' if args.allow_shrink else f'>= {min_ratio:.0%}'})"
+            )
+        elif spool:
+            print("Planned: строки в буфер по партициям, INSERT созревших партиций (scripts/leads_spool.py)")
         else:
-            out[col] = pd.Series([None] * len(out), dtype="string")
-
-    out["etl_loaded_at"] = etl_loaded_at
-    _etl_ts = pd.Timestamp(etl_loaded_at)
-    out["version"] = out["updated_at"].where(out["updated_at"].notna(), _etl_ts)
-
-    # 3) базовые фильтры качества
-    out = out[out["lead_id"] > 0].copy()
-
-    # NaN -> None для Nullable
-    out = out.where(pd.notnull(out), None)
-
-    # client_id — NOT NULL, фиксируем ЖЁСТКО
-    out["client_id"] = client_id
+            print(
+                f"Planned: INSERT блоками по {block_rows} строк / ~{block_mb:g} МБ (append-only, version = updated_at или etl_loaded_at)"
+            )
+        return
 
-    # 4) вставка
-    client.insert_df(full_table, out)
+    staging = None
+    keys = None
+    if replace:
+        # staging сверяется по числу уникальных ключей сортировки вставленных строк
+        keys = SortingKeyCounter(LEADS_INSERT_COLUMNS, sorting_key_columns(client, db, table))
+        staging = prepare_staging(client, db, table, client_id)
+        full_table = f"{db}.{staging}"
+        print(f"Replace: загрузка в staging {full_table}")
+
+    # 2) второй проход: колоночные блоки ограниченного размера, в памяти — только текущий блок
+    opened = open_source(source)
+    if opened is None:
+        raise RuntimeError(f"Источник {source} стал недоступен между проходами")
+    _, rows = opened
+    if spool:
+        load_via_spool(rows, client_slug=client_slug, client_id=client_id, table=table)
+        return
+    inserter = BlockInserter(
+        client,
+        full_table,
+        client_id=client_id,
+        block_rows=block_rows,
+        block_bytes=int(block_mb * 1024 * 1024),
+        max_rss_mb=max_rss or None,
+        dedup_table=None if no_dedup else table,
+        window=args.window or f"manual={datetime.now(timezone.utc):%Y-%m-%dT%H:%M:%S.%f}",
+        keys=keys,
+    )
+    started = time.monotonic()
+    try:
+        for row in rows:
+            inserter.add(row)
+        inserter.flush()
+    except BaseException:
+        if staging is not None:
+            drop_staging(client, db, staging)
+        raise
+    if staging is not None:
+        # swap_client_partitions удаляет staging и при успехе, и при ошибке
+        swap_client_partitions(
+            client,
+            db,
+            table,
+            staging,
+            client_id,
+            expected_keys=len(keys),
+            key_column="lead_id",
+            min_ratio=min_ratio,
+            allow_shrink=bool(args.allow_shrink),
+        )
+        discard_spool(client_slug, client_id, table=table)
+    # текущее состояние (leads_current), если таблица заведена
+    sync_after_load(client, db, client_id, replaced=staging is not None, source=table)
+    elapsed = time.monotonic() - started
 
-    print("OK. Inserted rows:", len(out))
+    print("OK. Inserted rows:", inserter.rows)
     print("Client:", client_id, "| slug:", client_slug)
-
+    if staging is not None:
+        print("Mode: replace (данные клиента в", f"{db}.{table}", "заменены целиком)")
+    if inserter.skipped:
+        print(f"Пропущено строк с lead_id <= 0: {inserter.skipped}")
+    speed = inserter.rows / elapsed if elapsed > 0 else float("inf")
+    print(
+        f"Блоков: {inserter.blocks} | всего {elapsed:.2f} c (INSERT {inserter.insert_s:.2f} c) | "
+        f"{speed:,.0f} строк/с"
+        + (f" | пик RSS {inserter.peak_rss_mb:.0f} МБ" if inserter.peak_rss_mb is not None else "")
+    )
 
 if __name__ == "__main__":
     main()
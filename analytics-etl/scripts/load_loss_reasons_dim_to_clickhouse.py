@@ -1,6 +1,5 @@
 import sys
 from pathlib import Path
-import os
 import argparse
 
 BASE_DIR = Path(__file__).resolve().parent.parent
@@ -15,12 +14,19 @@ import csv
 from datetime import datetime
 from pathlib import Path
 
-import clickhouse_connect
+from scripts.clickhouse_db import get_clickhouse_client, refresh_client_dim
 from scripts.clients_map import get_client_id
 
 DEFAULT_TABLE = "loss_reasons_dim_v2"
 DEFAULT_CSV_PATH = Path(__file__).resolve().parent.parent / "data" / "loss_reasons.csv"
 
+INSERT_COLUMNS = [
+    "client_id", "client_slug",
+    "loss_reason_id", "loss_reason_name",
+    "created_at", "updated_at",
+    "sort"
+]
+
 
 def parse_datetime(value):
     """
@@ -39,31 +45,7 @@ def parse_datetime(value):
     raise ValueError(f"Не удалось распарсить дату: {value}")
 
 
-def _env_required(name: str) -> str:
-    v = os.getenv(name)
-    if v is None or str(v).strip() == "":
-        raise ValueError(f"Не задан env {name} (обязателен).")
-    return v
-
-
-def _clickhouse_client():
-    host = _env_required("CLICKHOUSE_HOST")
-    port = int(os.getenv("CLICKHOUSE_PORT", "8123"))
-    user = _env_required("CLICKHOUSE_USER")
-    password = _env_required("CLICKHOUSE_PASSWORD")
-    db = _env_required("CLICKHOUSE_DB")
-
-    ch = clickhouse_connect.get_client(
-        host=host,
-        port=port,
-        username=user,
-        password=password,
-        database=db,
-    )
-    return ch, db
-
-
-def main():
+def main(argv: list[str] | None = None) -> None:
     p = argparse.ArgumentParser(description="Загрузка loss_reasons_dim в ClickHouse (safe multi-client).")
     p.add_argument(
         "--client-slug",
@@ -73,7 +55,12 @@ def main():
     p.add_argument("--csv-path", default=str(DEFAULT_CSV_PATH), help="Путь к CSV loss_reasons.csv")
     p.add_argument("--ch-table", default=DEFAULT_TABLE, help="Имя таблицы ClickHouse (без БД)")
     p.add_argument("--dry-run", action="store_true", help="Не выполнять DELETE/INSERT, только проверки и план действий")
-    args = p.parse_args()
+    p.add_argument(
+        "--allow-shrink",
+        action="store_true",
+        help="Разрешить справочник, в котором ключей меньше ETL_REPLACE_MIN_RATIO от текущего.",
+    )
+    args = p.parse_args(argv)
 
     client_slug = args.client_slug
     client_id = get_client_id(client_slug)
@@ -84,7 +71,7 @@ def main():
     if not csv_path.exists() or csv_path.stat().st_size == 0:
         raise FileNotFoundError(f"CSV не найден или пустой: {csv_path}")
 
-    ch, db = _clickhouse_client()
+    ch, db = get_clickhouse_client()
     table = args.ch_table
     full_table = f"{db}.{table}"
 
@@ -145,26 +132,19 @@ def main():
         print("Target table:", full_table)
         print("Client:", client_slug, "id=", client_id)
         print("CSV:", csv_path, "rows=", len(rows))
-        print("Planned:", f"DELETE WHERE client_id = {client_id}", "+ INSERT rows")
-        return
-
-    # очищаем данные клиента
-    ch.command(f"ALTER TABLE {full_table} DELETE WHERE client_id = {client_id}")
 
-    # вставляем
-    ch.insert(
-        full_table,
+    refresh_client_dim(
+        ch,
+        db,
+        table,
+        client_id,
         rows,
-        column_names=[
-            "client_id", "client_slug",
-            "loss_reason_id", "loss_reason_name",
-            "created_at", "updated_at",
-            "sort"
-        ],
+        column_names=INSERT_COLUMNS,
+        key_column="loss_reason_id",
+        allow_shrink=bool(args.allow_shrink),
+        dry_run=bool(args.dry_run),
     )
 
-    print(f"OK. Inserted {len(rows)} rows into {full_table} for client_id={client_id}")
-
 
 if __name__ == "__main__":
     main()
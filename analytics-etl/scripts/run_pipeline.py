@@ -1,10 +1,18 @@
 import argparse
+import contextlib
 import csv
+import hashlib
+import importlib
+import io
 import json
 import os
+import re
 import subprocess
 import sys
 import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
 from pathlib import Path
 
@@ -18,14 +26,34 @@ from scripts.load_dev_env import load_local_env_files
 
 load_local_env_files()
 
+from scripts.client_registry import ClientContext, list_enabled_clients
 from scripts.clients_map import get_client_id
-from scripts.sync_state import get_watermark, save_last_error, save_watermark, touch_last_success
+from scripts.lead_fingerprints import fingerprints_enabled_from_env, open_store
+from scripts.leads_io import count_records, is_ndjson
+from scripts.sync_state import (
+    SyncStateSchemaError,
+    get_content_fingerprint,
+    get_watermark,
+    save_content_fingerprint,
+    save_last_error,
+    save_watermark,
+    touch_last_success,
+)
 
 DATA_DIR = BASE_DIR / "data"
 LOGS_DIR = BASE_DIR / "logs"
 VAR_DIR = BASE_DIR / "var"
 
 ENTITY_LEADS = "leads"
+ENTITY_LOSS_REASONS = "loss_reasons"
+ENTITY_STATUSES = "statuses"
+# колонки, которые меняются при каждой выгрузке без изменения справочника (statuses.updated_at = время выгрузки)
+_FINGERPRINT_IGNORE = {ENTITY_LOSS_REASONS: (), ENTITY_STATUSES: ("updated_at",)}
+# таблицы ClickHouse справочников (DEFAULT_TABLE загрузчиков) — проверка перед пропуском загрузки
+_DIM_TABLES = {ENTITY_LOSS_REASONS: "loss_reasons_dim_v2", ENTITY_STATUSES: "statuses_dim_v2"}
+LEADS_FORMATS = ("json", "ndjson")
+STEP_MODES = ("inprocess", "subprocess")
+LEADS_MODES = ("staged", "fused")
 
 
 def _leads_overlap_from_env() -> timedelta:
@@ -47,6 +75,23 @@ def _leads_overlap_from_env() -> timedelta:
     return timedelta(minutes=n)
 
 
+def _export_shards_from_env() -> int:
+    """
+    Число окон updated_at для полной выгрузки лидов (amocrm_export_leads.py --shards).
+    Env: ETL_LEADS_EXPORT_SHARDS (целое). Если не задан — 1 (без шардирования, с checkpoint).
+    """
+    raw = (os.getenv("ETL_LEADS_EXPORT_SHARDS") or "").strip()
+    if not raw:
+        return 1
+    try:
+        n = int(raw)
+    except ValueError as e:
+        raise ValueError(
+            f"ETL_LEADS_EXPORT_SHARDS должен быть целым числом, получено: {raw!r}"
+        ) from e
+    return max(1, n)
+
+
 def max_updated_dt_from_csv(path: Path, log) -> datetime | None:
     """Максимум колонки updated_dt в CSV лидов (UTC)."""
     if not path.exists():
@@ -87,32 +132,93 @@ def make_logger(client_slug: str):
     return log, log_path
 
 
+def _step_mode_from_env() -> str:
+    """
+    Как запускать шаги пайплайна: inprocess (по умолчанию) — вызов main(argv) модуля шага
+    в текущем процессе с общими клиентами (ClickHouse, keep-alive к amoCRM, контекст клиента);
+    subprocess — отдельный интерпретатор на шаг (полная изоляция, как раньше).
+    Env: ETL_STEP_MODE.
+    """
+    v = (os.getenv("ETL_STEP_MODE") or "inprocess").strip().lower()
+    if v not in STEP_MODES:
+        raise ValueError(f"ETL_STEP_MODE должен быть одним из {STEP_MODES}, получено: {v!r}")
+    return v
+
+
+_step_mode = "inprocess"
+
+
+def set_step_mode(mode: str) -> None:
+    global _step_mode
+    if mode not in STEP_MODES:
+        raise ValueError(f"Неизвестный режим шагов: {mode!r}")
+    _step_mode = mode
+
+
+def _step_module_name(script: str) -> str:
+    """scripts/amocrm_export_leads.py → scripts.amocrm_export_leads"""
+    p = Path(script)
+    return ".".join((*p.parent.parts, p.stem))
+
+
+def _run_step_inprocess(cmd: list[str]) -> tuple[int, str, str]:
+    """
+    Вызывает main(argv) модуля шага. Вывод шага (print и logging в stderr) перехватывается
+    и возвращается как у subprocess; SystemExit превращается в код возврата,
+    исключение — в код 1 с traceback в stderr.
+    """
+    out, err = io.StringIO(), io.StringIO()
+    code = 0
+    with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+        try:
+            module = importlib.import_module(_step_module_name(cmd[0]))
+            module.main(list(cmd[1:]))
+        except SystemExit as e:
+            if isinstance(e.code, int):
+                code = e.code
+            elif e.code is not None:
+                print(e.code, file=sys.stderr)
+                code = 1
+        except Exception:
+            traceback.print_exc()
+            code = 1
+    return code, out.getvalue(), err.getvalue()
+
+
+def _run_step_subprocess(cmd: list[str]) -> tuple[int, str, str]:
+    result = subprocess.run(
+        [sys.executable, *cmd],
+        cwd=BASE_DIR,
+        text=True,
+        capture_output=True,
+    )
+    return result.returncode, result.stdout, result.stderr
+
+
 def run_step(cmd: list[str], description: str, log) -> None:
     log(f"=== START: {description} ===")
-    log("Команда: " + " ".join(cmd))
+    log(f"Команда ({_step_mode}): " + " ".join(cmd))
     start = time.monotonic()
     try:
-        result = subprocess.run(
-            [sys.executable, *cmd],
-            cwd=BASE_DIR,
-            text=True,
-            capture_output=True,
-        )
+        if _step_mode == "subprocess":
+            returncode, stdout, stderr = _run_step_subprocess(cmd)
+        else:
+            returncode, stdout, stderr = _run_step_inprocess(cmd)
     except Exception as e:
         log(f"✖ Не удалось запустить шаг '{description}': {e}")
         raise
 
     duration = time.monotonic() - start
 
-    if result.stdout:
-        for line in result.stdout.splitlines():
+    if stdout:
+        for line in stdout.splitlines():
             log(f"[stdout] {line}")
-    if result.stderr:
-        for line in result.stderr.splitlines():
+    if stderr:
+        for line in stderr.splitlines():
             log(f"[stderr] {line}")
 
-    if result.returncode != 0:
-        log(f"✖ Шаг '{description}' завершился с ошибкой, код={result.returncode}, время={duration:.1f} c")
+    if returncode != 0:
+        log(f"✖ Шаг '{description}' завершился с ошибкой, код={returncode}, время={duration:.1f} c")
         raise RuntimeError(f"Step failed: {description}")
 
     log(f"✔ Шаг '{description}' успешно выполнен за {duration:.1f} c")
@@ -157,11 +263,104 @@ def count_csv_rows(
     return row_count
 
 
+def csv_content_fingerprint(path: Path, ignore_cols: tuple[str, ...] = ()) -> str:
+    """
+    sha256 содержимого CSV справочника: строки сортируются (порядок выдачи API не важен),
+    ignore_cols не учитываются.
+    """
+    with path.open("r", encoding="utf-8-sig", newline="") as f:
+        reader = csv.DictReader(f, delimiter=";")
+        cols = sorted(c for c in (reader.fieldnames or []) if c not in ignore_cols)
+        rows = sorted("\x1f".join(r.get(c) or "" for c in cols) for r in reader)
+    h = hashlib.sha256("\x1f".join(cols).encode("utf-8"))
+    for row in rows:
+        h.update(b"\x1e" + row.encode("utf-8"))
+    return h.hexdigest()
+
+
+def _dim_rows_in_clickhouse(entity: str, client_id: int) -> int:
+    """Строк клиента в таблице справочника ClickHouse (0 — таблицы нет или она пуста для клиента)."""
+    from scripts.clickhouse_db import get_clickhouse_client, ident, table_exists
+
+    client, db = get_clickhouse_client()
+    table = _DIM_TABLES[entity]
+    if not table_exists(client, db, table):
+        return 0
+    return int(
+        client.query(
+            f"SELECT count() FROM {ident(db)}.{ident(table)} WHERE client_id = {{cid:UInt32}}",
+            parameters={"cid": int(client_id)},
+        ).result_rows[0][0]
+    )
+
+
+def _load_dim_if_changed(
+    client_id: int,
+    entity: str,
+    csv_path: Path,
+    load_cmd: list[str],
+    description: str,
+    log,
+    *,
+    force: bool,
+) -> None:
+    """
+    Загрузка справочника, только если выгрузка отличается от последней загруженной версии
+    (content_fingerprint в etl_sync_state) или в ClickHouse нет строк клиента (таблицу пересоздали,
+    партицию удалили вручную). Хэш сохраняется после успешной загрузки.
+    """
+    fingerprint = csv_content_fingerprint(csv_path, _FINGERPRINT_IGNORE.get(entity, ()))
+    if not force:
+        try:
+            previous = get_content_fingerprint(client_id, entity)
+        except SyncStateSchemaError:
+            raise
+        except Exception as e:
+            previous = None
+            log(f"WARNING: не удалось прочитать content_fingerprint ({entity}) из etl_sync_state: {e} — загружаем")
+        if previous == fingerprint:
+            try:
+                loaded = _dim_rows_in_clickhouse(entity, client_id)
+            except Exception as e:
+                loaded = None
+                log(f"WARNING: не удалось проверить {entity} клиента в ClickHouse: {e} — загружаем")
+            if loaded == 0:
+                log(f"Выгрузка {entity} не изменилась, но в ClickHouse строк клиента нет — загружаем")
+            if not loaded:
+                previous = None
+        if previous == fingerprint:
+            log(f"↷ Шаг '{description}' пропущен: {entity} не изменились с прошлой загрузки (fingerprint {fingerprint[:12]})")
+            try:
+                touch_last_success(client_id, entity)
+            except Exception as e:
+                log(f"WARNING: не удалось обновить last_success_at ({entity}) в etl_sync_state: {e}")
+            return
+
+    run_step(load_cmd, description, log)
+    try:
+        save_content_fingerprint(client_id, entity, fingerprint)
+    except SyncStateSchemaError:
+        raise
+    except Exception as e:
+        log(f"WARNING: не удалось сохранить content_fingerprint ({entity}) в etl_sync_state: {e}")
+
+
 def count_json_leads(path: Path, log) -> int:
     if not path.exists():
         log(f"ERROR: JSON не найден: {path}")
         return -1
 
+    if is_ndjson(path):
+        try:
+            n = count_records(path)
+        except Exception as e:
+            log(f"ERROR: не удалось прочитать NDJSON {path}: {e}")
+            return -1
+        log(f"NDJSON '{path.name}': найдено лидов = {n}")
+        if n == 0:
+            log(f"WARNING: NDJSON '{path.name}' не содержит лидов.")
+        return n
+
     try:
         with path.open("r", encoding="utf-8") as f:
             data = json.load(f)
@@ -188,10 +387,53 @@ def count_json_leads(path: Path, log) -> int:
     return n
 
 
-def run_leads_pipeline(client_slug: str, log, *, full_refresh_leads: bool = False) -> None:
+def _leads_format_from_env() -> str:
+    """
+    Формат промежуточных файлов лидов: json (массив, по умолчанию) или ndjson (по лиду на строку,
+    выгрузка и add_client_id пишут потоково). Env: ETL_LEADS_FORMAT.
+    """
+    v = (os.getenv("ETL_LEADS_FORMAT") or "json").strip().lower()
+    if v not in LEADS_FORMATS:
+        raise ValueError(f"ETL_LEADS_FORMAT должен быть одним из {LEADS_FORMATS}, получено: {v!r}")
+    return v
+
+
+def _leads_mode_from_env() -> str:
+    """
+    Как гонять лиды: staged (по умолчанию) — шаги со своими файлами JSON → JSON → CSV → ClickHouse;
+    fused — один потоковый проход amoCRM → ClickHouse (scripts/leads_stream.py). Env: ETL_LEADS_MODE.
+    """
+    v = (os.getenv("ETL_LEADS_MODE") or "staged").strip().lower()
+    if v not in LEADS_MODES:
+        raise ValueError(f"ETL_LEADS_MODE должен быть одним из {LEADS_MODES}, получено: {v!r}")
+    return v
+
+
+def _leads_artifacts_from_env() -> bool:
+    """Писать ли промежуточные файлы в режиме fused. Env: ETL_LEADS_ARTIFACTS (1/true/yes)."""
+    return (os.getenv("ETL_LEADS_ARTIFACTS") or "").strip().lower() in ("1", "true", "yes", "on")
+
+
+def run_leads_pipeline(
+    client_slug: str,
+    log,
+    *,
+    full_refresh_leads: bool = False,
+    leads_format: str = "json",
+    leads_mode: str = "staged",
+    leads_artifacts: bool = False,
+) -> None:
     client_id = get_client_id(client_slug)
     try:
-        _run_leads_pipeline_impl(client_slug, log, client_id=client_id, full_refresh_leads=full_refresh_leads)
+        _run_leads_pipeline_impl(
+            client_slug,
+            log,
+            client_id=client_id,
+            full_refresh_leads=full_refresh_leads,
+            leads_format=leads_format,
+            leads_mode=leads_mode,
+            leads_artifacts=leads_artifacts,
+        )
     except Exception as e:
         try:
             save_last_error(client_id, ENTITY_LEADS, str(e))
@@ -210,19 +452,25 @@ def _run_leads_pipeline_impl(
     *,
     client_id: int,
     full_refresh_leads: bool = False,
+    leads_format: str = "json",
+    leads_mode: str = "staged",
+    leads_artifacts: bool = False,
 ) -> None:
     log(f"##### Запуск пайплайна лидов для клиента: {client_slug} (id={client_id}) #####")
 
     client_data_dir = VAR_DIR / "data" / client_slug
     client_data_dir.mkdir(parents=True, exist_ok=True)
 
-    leads_json = client_data_dir / "add_leads_crm.json"
-    leads_with_client_json = client_data_dir / "add_leads_crm_with_client.json"
+    ext = "ndjson" if leads_format == "ndjson" else "json"
+    leads_json = client_data_dir / f"add_leads_crm.{ext}"
+    leads_with_client_json = client_data_dir / f"add_leads_crm_with_client.{ext}"
     leads_csv = client_data_dir / "add_leads_crm_flat_datalens.csv"
 
     log("Контекст клиента (leads):")
     log(f"- client_slug={client_slug}")
     log(f"- client_id={client_id}")
+    log(f"- leads_mode={leads_mode}")
+    log(f"- leads_format={leads_format}")
     log(f"- leads_json={leads_json}")
     log(f"- leads_with_client_json={leads_with_client_json}")
     log(f"- leads_csv={leads_csv}")
@@ -263,8 +511,34 @@ def _run_leads_pipeline_impl(
             f"ETL_LEADS_OVERLAP_MINUTES (effective): {overlap_label} — до появления watermark не используется."
         )
 
+    if leads_mode == "fused":
+        _run_leads_fused(
+            client_slug,
+            log,
+            client_id=client_id,
+            since_dt=since_dt,
+            incremental=incremental_ch,
+            wm_before=wm_before,
+            artifacts_dir=client_data_dir if leads_artifacts else None,
+        )
+        return
+
     # 1) Выгрузка лидов из amoCRM
-    export_cmd = ["scripts/amocrm_export_leads.py", "--client-slug", client_slug, "--out", str(leads_json)]
+    # --checkpoint: повторный запуск после сбоя (watermark не сдвинут → то же окно) продолжит выгрузку.
+    # Полную выгрузку можно вместо этого шардировать по окнам updated_at (ETL_LEADS_EXPORT_SHARDS).
+    export_cmd = [
+        "scripts/amocrm_export_leads.py",
+        "--client-slug",
+        client_slug,
+        "--out",
+        str(leads_json),
+    ]
+    export_shards = _export_shards_from_env() if since_dt is None else 1
+    if export_shards > 1:
+        log(f"Выгрузка лидов: {export_shards} параллельных окон updated_at (ETL_LEADS_EXPORT_SHARDS).")
+        export_cmd += ["--shards", str(export_shards)]
+    else:
+        export_cmd.append("--checkpoint")
     if since_dt is not None:
         export_cmd += ["--since-updated-at", since_dt.strftime("%Y-%m-%d %H:%M:%S")]
     run_step(
@@ -291,16 +565,21 @@ def _run_leads_pipeline_impl(
     count_json_leads(leads_with_client_json, log)
 
     # 3) Построение плоского CSV для DataLens/ClickHouse
+    # отпечатки: лиды из overlap, не изменившиеся с прошлой загрузки, в CSV не попадают
+    transform_cmd = [
+        "scripts/leads_json_to_datalens_csv.py",
+        "--client-slug",
+        client_slug,
+        "--in",
+        str(leads_with_client_json),
+        "--out",
+        str(leads_csv),
+    ]
+    fingerprints = fingerprints_enabled_from_env()
+    if fingerprints:
+        transform_cmd += ["--fingerprints", "incremental" if incremental_ch else "full"]
     run_step(
-        [
-            "scripts/leads_json_to_datalens_csv.py",
-            "--client-slug",
-            client_slug,
-            "--in",
-            str(leads_with_client_json),
-            "--out",
-            str(leads_csv),
-        ],
+        transform_cmd,
         "Лиды: шаг 3/4 — преобразование JSON в плоский CSV для отчётности",
         log,
     )
@@ -328,7 +607,8 @@ def _run_leads_pipeline_impl(
 
     if incremental_ch and rows_csv == 0:
         log(
-            "Инкремент: получено 0 строк в CSV — нет лидов, обновлённых после since_updated_at. "
+            "Инкремент: получено 0 строк в CSV — нет лидов, обновлённых после since_updated_at "
+            "(или все они не изменились с прошлой загрузки). "
             "Шаг ClickHouse пропущен. Watermark (leads) не меняем — прежнее значение сохраняется."
         )
         if wm_before is not None:
@@ -337,6 +617,7 @@ def _run_leads_pipeline_impl(
             touch_last_success(client_id, ENTITY_LEADS)
         except Exception as e:
             log(f"WARNING: не удалось обновить last_success_at в etl_sync_state: {e}")
+        flush_leads_spool(client_slug, client_id, log)
         log(f"##### Пайплайн лидов для {client_slug} (id={client_id}) завершён успешно #####")
         return
 
@@ -348,8 +629,13 @@ def _run_leads_pipeline_impl(
         "--csv-path",
         str(leads_csv),
     ]
+    # метка окна — в токен дедупликации блоков: перезапуск на том же окне не вставит блоки повторно
+    load_cmd += ["--window", f"since={since_dt:%Y-%m-%dT%H:%M:%S}" if since_dt is not None else "full"]
     if incremental_ch:
         load_cmd.append("--incremental")
+    else:
+        # полная выгрузка: данные клиента подменяются целиком (staging + REPLACE PARTITION)
+        load_cmd.append("--replace")
     run_step(
         load_cmd,
         "Лиды: шаг 4/4 — загрузка CSV в ClickHouse",
@@ -369,11 +655,119 @@ def _run_leads_pipeline_impl(
             log(
                 "WARNING: не вычислен max(updated_dt) по CSV — watermark_updated_at в etl_sync_state не менялся."
             )
+        if fingerprints:
+            commit_lead_fingerprints(client_slug, client_id, log)
+
+    log(f"##### Пайплайн лидов для {client_slug} (id={client_id}) завершён успешно #####")
+
+
+def flush_leads_spool(client_slug: str, client_id: int, log) -> None:
+    """
+    Инкремент без новых строк (шаг загрузки не запускался): созревшие партиции буфера дозагрузок
+    (ETL_CH_SPOOL, scripts/leads_spool.py) всё равно уходят в ClickHouse. Ошибка не валит пайплайн.
+    """
+    # импорт здесь: leads_spool тянет clickhouse_connect, а в пошаговом режиме его грузит шаг загрузки
+    from scripts.leads_spool import flush_spool, spool_enabled_from_env
+
+    if not spool_enabled_from_env():
+        return
+    try:
+        flush_spool(client_slug, client_id, log=log)
+    except Exception as e:
+        log(f"WARNING: сброс буфера дозагрузок не удался ({e}) — строки остаются в буфере")
+
+
+def commit_lead_fingerprints(client_slug: str, client_id: int, log, store=None) -> None:
+    """
+    Фиксирует отпечатки лидов этого запуска (после загрузки в ClickHouse и watermark).
+    Ошибка не валит пайплайн: отпечатки останутся прежними, и лиды обработаются повторно.
+    Переданный store закрывает вызывающий; открытый здесь — закрывается здесь.
+    """
+    own = None
+    try:
+        if store is None:
+            store = own = open_store(client_slug, client_id)
+        n = store.commit()
+        log(f"Отпечатки лидов: зафиксировано {n}, всего {len(store)}.")
+    except Exception as e:
+        log(f"WARNING: не удалось зафиксировать отпечатки лидов: {e}")
+    finally:
+        if own is not None:
+            own.close()
+
+
+def _run_leads_fused(
+    client_slug: str,
+    log,
+    *,
+    client_id: int,
+    since_dt: datetime | None,
+    incremental: bool,
+    wm_before: datetime | None,
+    artifacts_dir: Path | None,
+) -> None:
+    """
+    Лиды одним потоковым проходом: страницы amoCRM → client_id → transform → INSERT пачками.
+    Правила watermark те же, что у пошагового режима: сдвигается только после успешной вставки,
+    на max(updated_dt) вставленных строк; пустой инкремент — только last_success_at.
+    """
+    # импорт здесь: в пошаговом режиме clickhouse_connect грузится шагом загрузки
+    from scripts.leads_stream import run_fused_leads
+
+    log("=== START: Лиды (fused): amoCRM → transform → ClickHouse ===")
+    store = open_store(client_slug, client_id) if fingerprints_enabled_from_env() else None
+    try:
+        if store is not None:
+            if store.reset:
+                log("Код преобразования изменился — отпечатки лидов сброшены, все лиды обрабатываются заново.")
+            store.begin(full=not incremental)
+        result = run_fused_leads(
+            client_slug,
+            client_id,
+            log,
+            since_dt=since_dt,
+            artifacts_dir=artifacts_dir,
+            replace=not incremental,
+            fingerprints=store,
+        )
+        for path in result.artifacts:
+            log(f"Артефакт: {path}")
+
+        if result.rows_inserted == 0:
+            if not incremental:
+                raise RuntimeError("Полная выгрузка лидов вернула 0 строк — нечего загружать в ClickHouse.")
+            log(
+                "Инкремент: 0 лидов, обновлённых после since_updated_at (или все они не изменились с прошлой загрузки). "
+                "Watermark (leads) не меняем — прежнее значение сохраняется."
+            )
+            if wm_before is not None:
+                log(f"Watermark без изменений: {wm_before.isoformat()}")
+            try:
+                touch_last_success(client_id, ENTITY_LEADS)
+            except Exception as e:
+                log(f"WARNING: не удалось обновить last_success_at в etl_sync_state: {e}")
+        elif result.max_updated_dt is not None:
+            try:
+                save_watermark(client_id, ENTITY_LEADS, result.max_updated_dt)
+                log(
+                    f"Новый watermark (leads): {result.max_updated_dt.isoformat()} — записан в etl_sync_state "
+                    "(max updated_dt вставленных строк)."
+                )
+            except Exception as e:
+                log(f"✖ Не удалось сохранить watermark в etl_sync_state: {e}")
+                raise
+        else:
+            log("WARNING: у вставленных строк нет updated_dt — watermark_updated_at в etl_sync_state не менялся.")
+        if store is not None:
+            commit_lead_fingerprints(client_slug, client_id, log, store)
+    finally:
+        if store is not None:
+            store.close()
 
     log(f"##### Пайплайн лидов для {client_slug} (id={client_id}) завершён успешно #####")
 
 
-def run_dims_pipeline(client_slug: str, log) -> None:
+def run_dims_pipeline(client_slug: str, log, *, force: bool = False, allow_shrink: bool = False) -> None:
     client_id = get_client_id(client_slug)
     log(f"##### Запуск пайплайна справочников для клиента: {client_slug} (id={client_id}) #####")
 
@@ -408,17 +802,25 @@ def run_dims_pipeline(client_slug: str, log) -> None:
     if loss_rows < 0:
         raise RuntimeError("Валидация CSV loss_reasons не пройдена, загрузка в ClickHouse отменена.")
 
-    # 2) Загрузка причин потерь в ClickHouse
-    run_step(
+    # --allow-shrink загрузчиков: справочник клиента осознанно стал заметно меньше (см. ETL_REPLACE_MIN_RATIO)
+    shrink_flag = ["--allow-shrink"] if allow_shrink else []
+
+    # 2) Загрузка причин потерь в ClickHouse (если выгрузка изменилась)
+    _load_dim_if_changed(
+        client_id,
+        ENTITY_LOSS_REASONS,
+        loss_csv,
         [
             "scripts/load_loss_reasons_dim_to_clickhouse.py",
             "--client-slug",
             client_slug,
             "--csv-path",
             str(loss_csv),
+            *shrink_flag,
         ],
         "Справочники: шаг 2/4 — загрузка loss_reasons в ClickHouse",
         log,
+        force=force,
     )
 
     # 3) Выгрузка статусов по пайплайнам
@@ -444,22 +846,177 @@ def run_dims_pipeline(client_slug: str, log) -> None:
     if statuses_rows < 0:
         raise RuntimeError("Валидация CSV статусов не пройдена, загрузка в ClickHouse отменена.")
 
-    # 4) Загрузка статусов в ClickHouse
-    run_step(
+    # 4) Загрузка статусов в ClickHouse (если выгрузка изменилась)
+    _load_dim_if_changed(
+        client_id,
+        ENTITY_STATUSES,
+        statuses_csv,
         [
             "scripts/load_statuses_dim_to_clickhouse.py",
             "--client-slug",
             client_slug,
             "--csv-path",
             str(statuses_csv),
+            *shrink_flag,
         ],
         "Справочники: шаг 4/4 — загрузка статусов в ClickHouse",
         log,
+        force=force,
     )
 
     log(f"##### Пайплайн справочников для {client_slug} (id={client_id}) завершён успешно #####")
 
 
+def _fleet_workers_from_env() -> int:
+    """Сколько клиентов гонять одновременно в режиме --all-clients. Env: ETL_FLEET_WORKERS (по умолчанию 4)."""
+    raw = (os.getenv("ETL_FLEET_WORKERS") or "").strip()
+    if not raw:
+        return 4
+    try:
+        n = int(raw)
+    except ValueError as e:
+        raise ValueError(f"ETL_FLEET_WORKERS должен быть целым числом, получено: {raw!r}") from e
+    return max(1, n)
+
+
+@dataclass
+class TenantResult:
+    client_slug: str
+    client_id: int
+    returncode: int
+    duration_s: float
+    log_path: str = ""
+    error: str = ""
+
+    @property
+    def ok(self) -> bool:
+        return self.returncode == 0
+
+
+_CHILD_LOG_PATH_RE = re.compile(r"Лог-файл: (.+)$", re.MULTILINE)
+
+
+def _fleet_child_argv(args: argparse.Namespace) -> list[str]:
+    """Флаги запуска, которые пробрасываются в пайплайн каждого клиента."""
+    argv: list[str] = []
+    for name in ("leads", "dims", "all", "leads_full_refresh", "leads_artifacts", "dims_force", "dims_allow_shrink"):
+        if getattr(args, name):
+            argv.append("--" + name.replace("_", "-"))
+    for name in ("leads_format", "step_mode", "leads_mode"):
+        value = getattr(args, name)
+        if value:
+            argv += ["--" + name.replace("_", "-"), value]
+    return argv
+
+
+def _run_tenant(ctx: ClientContext, child_argv: list[str]) -> TenantResult:
+    """
+    Пайплайн одного клиента — отдельным процессом run_pipeline.py --client-slug ...:
+    свой лог-файл, свой watermark в etl_sync_state, падение не задевает остальных.
+    """
+    cmd = [sys.executable, str(Path(__file__).resolve()), "--client-slug", ctx.client_slug, *child_argv]
+    start = time.monotonic()
+    try:
+        result = subprocess.run(cmd, cwd=BASE_DIR, text=True, capture_output=True)
+    except Exception as e:
+        return TenantResult(ctx.client_slug, ctx.client_id, -1, time.monotonic() - start, error=str(e))
+    duration = time.monotonic() - start
+
+    m = _CHILD_LOG_PATH_RE.search(result.stdout or "")
+    error = ""
+    if result.returncode != 0:
+        tail = (result.stderr or result.stdout or "").strip().splitlines()
+        error = tail[-1] if tail else f"код возврата {result.returncode}"
+    return TenantResult(
+        ctx.client_slug,
+        ctx.client_id,
+        result.returncode,
+        duration,
+        log_path=m.group(1).strip() if m else "",
+        error=error,
+    )
+
+
+def format_fleet_summary(results: list[TenantResult]) -> list[str]:
+    header = ("client_slug", "id", "статус", "время, c", "лог / ошибка")
+    rows = [
+        (
+            r.client_slug,
+            str(r.client_id),
+            "OK" if r.ok else f"FAIL ({r.returncode})",
+            f"{r.duration_s:.1f}",
+            r.log_path if r.ok else " — ".join(x for x in (r.error, r.log_path) if x),
+        )
+        for r in sorted(results, key=lambda r: r.client_slug)
+    ]
+    widths = [max(len(row[i]) for row in [header, *rows]) for i in range(len(header) - 1)]
+
+    def fmt(row) -> str:
+        return " | ".join(cell.ljust(w) for cell, w in zip(row, widths)) + " | " + row[-1]
+
+    lines = [fmt(header), "-+-".join("-" * w for w in widths) + "-+-" + "-" * len(header[-1])]
+    lines += [fmt(row) for row in rows]
+    return lines
+
+
+def log_parts_report(log, hours: float = 1.0) -> None:
+    """
+    Темп создания частей в таблицах ETL за последний час (scripts/ch_parts_report.py): после прогона
+    по всем клиентам видно, не подбирается ли какая-то партиция к «Too many parts».
+    Ошибка отчёта на результат fleet не влияет.
+    """
+    try:
+        from scripts.ch_parts_report import DEFAULT_TABLES, format_parts_report, part_thresholds, parts_report
+        from scripts.clickhouse_db import get_clickhouse_client
+
+        client, db = get_clickhouse_client()
+        stats = parts_report(client, db, DEFAULT_TABLES, hours=hours)
+        lines, warnings = format_parts_report(stats, part_thresholds(client), hours=hours)
+    except Exception as e:
+        log(f"WARNING: отчёт по частям ClickHouse не построен: {e}")
+        return
+    for line in lines + warnings:
+        log(line)
+
+
+def run_fleet(args: argparse.Namespace, workers: int) -> int:
+    """
+    --all-clients: пайплайн для всех включённых клиентов (clients.is_enabled + amocrm_integrations),
+    не больше workers клиентов одновременно. Возвращает число клиентов, завершившихся с ошибкой.
+    """
+    log, log_path = make_logger("fleet")
+    clients = list_enabled_clients()
+    child_argv = _fleet_child_argv(args)
+    log(f"Fleet: клиентов {len(clients)}, параллельно {workers}. Лог-файл: {log_path}")
+    log("Флаги для каждого клиента: " + " ".join(child_argv))
+    started_at = time.monotonic()
+
+    results: list[TenantResult] = []
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="tenant") as pool:
+        futures = []
+        for ctx in clients:
+            log(f"→ {ctx.client_slug} (id={ctx.client_id}) поставлен в очередь")
+            futures.append(pool.submit(_run_tenant, ctx, child_argv))
+        for fut in as_completed(futures):
+            r = fut.result()
+            results.append(r)
+            if r.ok:
+                log(f"✔ {r.client_slug}: OK за {r.duration_s:.1f} c")
+            else:
+                log(f"✖ {r.client_slug}: ошибка за {r.duration_s:.1f} c — {r.error}")
+
+    failed = sum(1 for r in results if not r.ok)
+    log("Итог по клиентам:")
+    for line in format_fleet_summary(results):
+        log(line)
+    log_parts_report(log)
+    log(
+        f"Fleet завершён за {time.monotonic() - started_at:.1f} c: "
+        f"успешно {len(results) - failed}, с ошибкой {failed}"
+    )
+    return failed
+
+
 def main() -> None:
     parser = argparse.ArgumentParser(
         description="Боевой one-click ETL из amoCRM в ClickHouse (лиды и справочники)."
@@ -467,9 +1024,21 @@ def main() -> None:
     parser.add_argument(
         "--client-slug",
         dest="client_slug",
-        required=True,
+        default=None,
         help="client_slug клиента (PostgreSQL / client_registry; например artroyal_detailing)",
     )
+    parser.add_argument(
+        "--all-clients",
+        dest="all_clients",
+        action="store_true",
+        help="Вместо --client-slug: все включённые клиенты из PostgreSQL, каждый отдельным процессом.",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Для --all-clients: сколько клиентов обрабатывать одновременно. Env: ETL_FLEET_WORKERS (4).",
+    )
     parser.add_argument(
         "--leads",
         action="store_true",
@@ -485,19 +1054,74 @@ def main() -> None:
         action="store_true",
         help="Полный refresh: справочники + лиды (dims → leads)",
     )
+    parser.add_argument(
+        "--dims-force",
+        dest="dims_force",
+        action="store_true",
+        help="Загрузить справочники в ClickHouse, даже если выгрузка не изменилась (content_fingerprint).",
+    )
+    parser.add_argument(
+        "--dims-allow-shrink",
+        dest="dims_allow_shrink",
+        action="store_true",
+        help="Справочники: разрешить подмену, даже если у клиента стало заметно меньше строк (--allow-shrink загрузчиков).",
+    )
     parser.add_argument(
         "--leads-full-refresh",
         action="store_true",
         help="Для пайплайна лидов: полная выгрузка из amoCRM и полная перезапись по client_id в ClickHouse (без инкремента).",
     )
+    parser.add_argument(
+        "--leads-format",
+        dest="leads_format",
+        choices=LEADS_FORMATS,
+        default=None,
+        help="Формат промежуточных файлов лидов: json (по умолчанию) или ndjson (потоковая запись). Env: ETL_LEADS_FORMAT.",
+    )
+    parser.add_argument(
+        "--step-mode",
+        dest="step_mode",
+        choices=STEP_MODES,
+        default=None,
+        help="Запуск шагов: inprocess (по умолчанию, в одном процессе) или subprocess (интерпретатор на шаг). Env: ETL_STEP_MODE.",
+    )
+    parser.add_argument(
+        "--leads-mode",
+        dest="leads_mode",
+        choices=LEADS_MODES,
+        default=None,
+        help="Лиды: staged (по умолчанию, шаги с файлами) или fused (потоково amoCRM → ClickHouse без файлов). Env: ETL_LEADS_MODE.",
+    )
+    parser.add_argument(
+        "--leads-artifacts",
+        dest="leads_artifacts",
+        action="store_true",
+        help="Для --leads-mode fused: всё же писать промежуточные NDJSON и CSV (отладка/аудит). Env: ETL_LEADS_ARTIFACTS=1.",
+    )
 
     args = parser.parse_args()
+    leads_opts = {
+        "leads_format": args.leads_format or _leads_format_from_env(),
+        "leads_mode": args.leads_mode or _leads_mode_from_env(),
+        "leads_artifacts": bool(args.leads_artifacts) or _leads_artifacts_from_env(),
+    }
+    set_step_mode(args.step_mode or _step_mode_from_env())
 
     if not (args.leads or args.dims or args.all):
         print("Нужно указать хотя бы один флаг: --leads, --dims или --all.")
         parser.print_help()
         return
 
+    if args.all_clients:
+        if args.client_slug:
+            parser.error("--all-clients и --client-slug взаимоисключающие")
+        workers = args.workers if args.workers is not None else _fleet_workers_from_env()
+        if run_fleet(args, max(1, workers)):
+            raise SystemExit(1)
+        return
+    if not args.client_slug:
+        parser.error("нужен --client-slug или --all-clients")
+
     client_slug = args.client_slug
     log, log_path = make_logger(client_slug)
     client_id = get_client_id(client_slug)
@@ -509,13 +1133,13 @@ def main() -> None:
         lfr = bool(args.leads_full_refresh)
         if args.all:
             # Полный refresh в заданном порядке: dims → leads
-            run_dims_pipeline(client_slug, log)
-            run_leads_pipeline(client_slug, log, full_refresh_leads=lfr)
+            run_dims_pipeline(client_slug, log, force=args.dims_force, allow_shrink=args.dims_allow_shrink)
+            run_leads_pipeline(client_slug, log, full_refresh_leads=lfr, **leads_opts)
         else:
             if args.dims:
-                run_dims_pipeline(client_slug, log)
+                run_dims_pipeline(client_slug, log, force=args.dims_force, allow_shrink=args.dims_allow_shrink)
             if args.leads:
-                run_leads_pipeline(client_slug, log, full_refresh_leads=lfr)
+                run_leads_pipeline(client_slug, log, full_refresh_leads=lfr, **leads_opts)
     except Exception as e:
         log(f"✖ Пайплайн завершился с ошибкой: {e}")
         total = time.monotonic() - started_at
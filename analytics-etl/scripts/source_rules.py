@@ -0,0 +1,306 @@
+"""
+Правила source / channel лида по клиентам: config/source_rules/<client_slug>.json, для клиентов без своего
+файла — config/source_rules/default.json.
+
+Файл правил:
+  {
+    "extends": "default",                  # необязательно: взять правила другого файла и дополнить
+    "rules": [
+      {
+        "name": "site_form",               # имя — для статистики и переопределения в extends
+        "priority": 30,                    # правила применяются по возрастанию priority:
+                                           # значение, выставленное правилом выше, перекрывает ниже
+        "when": {"fields": ["name", "utm_source"], "contains": ["artroyal-detailing.ru"]},
+        "set": {"source": "заявка с сайта", "channel": "заявка с сайта"}
+      }
+    ],
+    "source_rewrites": [                   # source без сработавших правил: очистка, замены, lower()
+      {"pattern": "\\bva\\b", "replace": "звонок"}
+    ]
+  }
+
+Условия "when" (объект или список объектов — сработает любой):
+  {"fields": [...], "contains": [...]}  подстрока в очищенном (clean_text) значении поля, без учёта регистра;
+  {"field": "name", "regex": "..."}     re.match по очищенному значению поля, без учёта регистра;
+  {"tags": [...]}                       среди тегов лида (поле tags: "a; b") есть один из перечисленных.
+set — только source / channel; значения ставятся как есть.
+
+Компиляция — один раз на клиента за процесс: все подстроки всех правил собираются в одно регулярное
+выражение (по lookahead на позицию, длинные — первыми), и значение поля сканируется им за один проход;
+подстроки, вложенные в найденную, засчитываются по таблице, построенной при компиляции. Если поле
+условия уже перезаписано правилом с меньшим priority, условие проверяется по выставленному значению
+(как в последовательном apply_rules): его совпадения тоже считаются при компиляции.
+Сколько раз сработало каждое правило — RuleSet.fired / format_stats.
+
+Проверка файла правил:
+  python scripts/source_rules.py --client-slug <slug>
+"""
+
+from __future__ import annotations
+
+import argparse
+import hashlib
+import json
+import re
+import sys
+import threading
+from collections import Counter
+from dataclasses import dataclass
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+if str(BASE_DIR) not in sys.path:
+    sys.path.insert(0, str(BASE_DIR))
+
+from scripts.transform_utils import clean_text
+
+RULES_DIR = BASE_DIR / "config" / "source_rules"
+DEFAULT_RULES = "default"
+SETTABLE_FIELDS = ("source", "channel")
+
+
+class SourceRulesError(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class _Condition:
+    fields: tuple[str, ...] = ()
+    literals: frozenset[int] = frozenset()
+    regex: re.Pattern | None = None
+    tags: frozenset[str] = frozenset()
+
+
+@dataclass(frozen=True)
+class Rule:
+    name: str
+    priority: int
+    conditions: tuple[_Condition, ...]
+    values: tuple[tuple[str, str], ...]
+
+
+@dataclass(frozen=True)
+class FieldState:
+    """Значение поля, подготовленное для условий: очищенный текст, найденные подстроки, теги."""
+
+    text: str
+    hits: frozenset[int]
+    tags: frozenset[str]
+
+
+def _load_config(name: str, rules_dir: Path, seen: tuple[str, ...] = ()) -> tuple[dict, list[bytes]]:
+    path = rules_dir / f"{name}.json"
+    if name in seen:
+        raise SourceRulesError(f"Циклический extends в правилах: {' → '.join(seen + (name,))}")
+    try:
+        raw = path.read_bytes()
+    except FileNotFoundError as e:
+        raise SourceRulesError(f"Нет файла правил: {path}") from e
+    try:
+        config = json.loads(raw.decode("utf-8"))
+    except ValueError as e:
+        raise SourceRulesError(f"{path}: не JSON: {e}") from e
+    parent = config.get("extends")
+    if not parent:
+        return config, [raw]
+    base, chain = _load_config(str(parent), rules_dir, seen + (name,))
+    rules = {r.get("name"): r for r in base.get("rules", [])}
+    for r in config.get("rules", []):
+        rules[r.get("name")] = r
+    merged = {
+        "rules": list(rules.values()),
+        "source_rewrites": config.get("source_rewrites", base.get("source_rewrites", [])),
+    }
+    return merged, chain + [raw]
+
+
+def rules_name_for(client_slug: str, rules_dir: Path = RULES_DIR) -> str:
+    return client_slug if (rules_dir / f"{client_slug}.json").exists() else DEFAULT_RULES
+
+
+class RuleSet:
+    def __init__(self, name: str, config: dict, digest: str = ""):
+        self.name = name
+        self.digest = digest
+        self._literals: list[str] = []
+        self._literal_ids: dict[str, int] = {}
+        self.rules = sorted(
+            (self._compile_rule(i, r) for i, r in enumerate(config.get("rules", []))),
+            key=lambda r: r.priority,
+        )
+        self.rewrites = [
+            (re.compile(str(rw["pattern"]), re.IGNORECASE), str(rw.get("replace", "")))
+            for rw in config.get("source_rewrites", [])
+        ]
+        self._compile_matcher()
+        self.fields = sorted({f for r in self.rules for c in r.conditions for f in c.fields})
+        # состояние полей, перезаписанных правилом: условие правила выше проверяется по этому значению
+        self._set_states = {
+            (rule.name, field): self.field_state(value) for rule in self.rules for field, value in rule.values
+        }
+        self.fired: Counter = Counter()
+        self.rows = 0
+
+    @property
+    def literals(self) -> tuple[str, ...]:
+        """Подстроки условий contains всех правил (в нижнем регистре) — один общий матчер."""
+        return tuple(self._literals)
+
+    def _literal_id(self, literal: str) -> int:
+        literal = literal.lower()
+        if literal not in self._literal_ids:
+            self._literal_ids[literal] = len(self._literals)
+            self._literals.append(literal)
+        return self._literal_ids[literal]
+
+    def _compile_rule(self, index: int, raw: dict) -> Rule:
+        name = str(raw.get("name") or f"rule_{index}")
+        when = raw.get("when")
+        if not when:
+            raise SourceRulesError(f"Правило {name}: нет условия when")
+        conditions = []
+        for cond in when if isinstance(when, list) else [when]:
+            if "contains" in cond:
+                literals = [str(x) for x in cond["contains"] if str(x)]
+                if not literals:
+                    raise SourceRulesError(f"Правило {name}: пустой contains")
+                conditions.append(
+                    _Condition(
+                        fields=tuple(cond.get("fields") or [cond.get("field", "name")]),
+                        literals=frozenset(self._literal_id(x) for x in literals),
+                    )
+                )
+            elif "regex" in cond:
+                conditions.append(
+                    _Condition(fields=(str(cond.get("field", "name")),), regex=re.compile(cond["regex"], re.IGNORECASE))
+                )
+            elif "tags" in cond:
+                conditions.append(_Condition(fields=("tags",), tags=frozenset(str(t).lower() for t in cond["tags"])))
+            else:
+                raise SourceRulesError(f"Правило {name}: неизвестное условие {sorted(cond)}")
+        values = raw.get("set") or {}
+        bad = sorted(set(values) - set(SETTABLE_FIELDS))
+        if not values or bad:
+            raise SourceRulesError(f"Правило {name}: set должен задавать только {', '.join(SETTABLE_FIELDS)}")
+        return Rule(
+            name=name,
+            priority=int(raw.get("priority", 0)),
+            conditions=tuple(conditions),
+            values=tuple((k, str(v)) for k, v in values.items()),
+        )
+
+    def _compile_matcher(self) -> None:
+        if not self._literals:
+            self._matcher = None
+            self._implied: list[frozenset[int]] = []
+            return
+        # по lookahead на каждую позицию: находятся все вхождения, в т.ч. перекрывающиеся;
+        # на одной позиции берётся самая длинная подстрока, вложенные — через _implied
+        order = sorted(range(len(self._literals)), key=lambda i: -len(self._literals[i]))
+        self._group_literal = order
+        self._matcher = re.compile(
+            "(?=(?:" + "|".join(f"({re.escape(self._literals[i])})" for i in order) + "))"
+        )
+        self._implied = [
+            frozenset(j for j, other in enumerate(self._literals) if other in literal) for literal in self._literals
+        ]
+
+    def scan(self, text: str) -> frozenset[int]:
+        """Подстроки правил, встречающиеся в тексте (text уже в нижнем регистре)."""
+        if self._matcher is None:
+            return frozenset()
+        found: set[int] = set()
+        for m in self._matcher.finditer(text):
+            found |= self._implied[self._group_literal[m.lastindex - 1]]
+        return frozenset(found)
+
+    def field_state(self, value: str) -> FieldState:
+        text = clean_text(value)
+        low = text.lower()
+        return FieldState(
+            text=text,
+            hits=self.scan(low),
+            tags=frozenset(t.strip() for t in low.split(";") if t.strip()),
+        )
+
+    def normalize_source(self, value: str) -> str:
+        src = clean_text(value)
+        for pattern, replace in self.rewrites:
+            src = pattern.sub(replace, src)
+        return src.lower()
+
+    def _matches(self, cond: _Condition, states: dict, overridden: dict) -> bool:
+        for field in cond.fields:
+            state = overridden.get(field) or states[field]
+            if cond.literals and not cond.literals.isdisjoint(state.hits):
+                return True
+            if cond.regex is not None and cond.regex.match(state.text):
+                return True
+            if cond.tags and not cond.tags.isdisjoint(state.tags):
+                return True
+        return False
+
+    def apply(self, row: dict, states: dict | None = None) -> dict:
+        """
+        source / channel строки по правилам. states — FieldState полей условий (пакетное преобразование
+        считает их по уникальным значениям); без них считаются здесь.
+        """
+        if states is None:
+            states = {f: self.field_state(str(row.get(f, ""))) for f in self.fields}
+        overridden: dict[str, FieldState] = {}
+        result: dict[str, str] = {}
+        for rule in self.rules:
+            if any(self._matches(c, states, overridden) for c in rule.conditions):
+                self.fired[rule.name] += 1
+                for field, value in rule.values:
+                    result[field] = value
+                    overridden[field] = self._set_states[(rule.name, field)]
+        self.rows += 1
+        row["source"] = result["source"] if "source" in result else self.normalize_source(str(row.get("source", "")))
+        channel = result.get("channel", row.get("channel"))
+        row["channel"] = clean_text(channel) if isinstance(channel, str) else channel
+        return row
+
+    def reset_stats(self) -> None:
+        self.fired.clear()
+        self.rows = 0
+
+    def format_stats(self) -> str:
+        parts = [f"{r.name}={self.fired.get(r.name, 0)}" for r in self.rules]
+        return f"Правила source/channel ({self.name}, строк {self.rows}): " + (", ".join(parts) or "нет правил")
+
+
+_RULESETS: dict[str, RuleSet] = {}
+_RULESETS_LOCK = threading.Lock()
+
+
+def load_rules(client_slug: str, rules_dir: Path = RULES_DIR) -> RuleSet:
+    """Скомпилированные правила клиента (свой файл или default), одни на процесс."""
+    name = rules_name_for(client_slug, rules_dir)
+    key = f"{rules_dir}:{name}"
+    with _RULESETS_LOCK:
+        rules = _RULESETS.get(key)
+        if rules is None:
+            config, chain = _load_config(name, rules_dir)
+            digest = hashlib.sha256(b"\0".join(chain)).hexdigest()
+            rules = _RULESETS[key] = RuleSet(name, config, digest)
+    return rules
+
+
+def main(argv: list[str] | None = None) -> None:
+    p = argparse.ArgumentParser(description="Проверка правил source/channel клиента (config/source_rules).")
+    p.add_argument("--client-slug", required=True, help="client_slug (без своего файла — default.json)")
+    args = p.parse_args(argv)
+    try:
+        rules = load_rules(args.client_slug)
+    except (SourceRulesError, re.error) as e:
+        raise SystemExit(f"ERROR: {e}")
+    print(f"Правила {args.client_slug}: {RULES_DIR / (rules.name + '.json')} (sha256 {rules.digest[:12]})")
+    for rule in rules.rules:
+        values = ", ".join(f"{k}={v!r}" for k, v in rule.values)
+        print(f"  [{rule.priority}] {rule.name}: условий {len(rule.conditions)} → {values}")
+    print(f"  подстрок в общем матчере: {len(rules.literals)}, замен source: {len(rules.rewrites)}")
+
+
+if __name__ == "__main__":
+    main()
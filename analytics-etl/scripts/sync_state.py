@@ -9,10 +9,19 @@
       watermark_updated_at TIMESTAMPTZ,
       last_success_at TIMESTAMPTZ,
       last_error TEXT,
+      content_fingerprint TEXT,
       PRIMARY KEY (client_id, entity)
   );
 
 watermark_updated_at — верхняя граница updated_at (amoCRM) по реально загруженным сущностям, UTC.
+content_fingerprint — хэш содержимого последней загруженной версии справочника (entities loss_reasons,
+statuses): run_pipeline не перезагружает справочник, если выгрузка не изменилась. В таблицу, созданную
+до её появления, колонка добавляется один раз явно:
+
+  python scripts/sync_state.py --setup
+
+Без колонки get_content_fingerprint / save_content_fingerprint падают с SyncStateSchemaError
+(схема сама во время работы пайплайна не меняется).
 
 Поведение при ошибках: save_watermark вызывается только после успешной загрузки в ClickHouse;
 save_last_error / сбой пайплайна не изменяют watermark_updated_at (колонка не трогается
@@ -21,15 +30,60 @@ save_last_error / сбой пайплайна не изменяют watermark_up
 
 from __future__ import annotations
 
+import argparse
+import sys
 from datetime import datetime, timezone
+from pathlib import Path
+
+BASE_DIR = Path(__file__).resolve().parent.parent
+if str(BASE_DIR) not in sys.path:
+    sys.path.insert(0, str(BASE_DIR))
 
 from scripts.db import get_connection
 
 
+_fingerprint_column_ready = False
+
+
+class SyncStateSchemaError(Exception):
+    pass
+
+
 def _utcnow() -> datetime:
     return datetime.now(timezone.utc)
 
 
+def _require_fingerprint_column(conn) -> None:
+    global _fingerprint_column_ready
+    if _fingerprint_column_ready:
+        return
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT 1 FROM information_schema.columns
+            WHERE table_name = 'etl_sync_state' AND column_name = 'content_fingerprint'
+              AND table_schema = ANY (current_schemas(false))
+            """
+        )
+        found = cur.fetchone() is not None
+    if not found:
+        raise SyncStateSchemaError(
+            "В etl_sync_state нет колонки content_fingerprint — выполните python scripts/sync_state.py --setup"
+        )
+    _fingerprint_column_ready = True
+
+
+def setup_schema() -> None:
+    """Явный шаг установки: добавляет в etl_sync_state колонки, появившиеся после её создания."""
+    conn = get_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("ALTER TABLE etl_sync_state ADD COLUMN IF NOT EXISTS content_fingerprint TEXT")
+        conn.commit()
+    finally:
+        conn.close()
+
+
 def get_watermark(client_id: int, entity: str) -> datetime | None:
     """
     Возвращает сохранённый watermark (UTC, aware) или None, если записи нет.
@@ -164,3 +218,73 @@ def touch_last_success(client_id: int, entity: str) -> None:
         conn.commit()
     finally:
         conn.close()
+
+
+def get_content_fingerprint(client_id: int, entity: str) -> str | None:
+    """Хэш содержимого последней успешно загруженной версии сущности или None."""
+    cid = int(client_id)
+    ent = (entity or "").strip()
+    if cid <= 0 or not ent:
+        raise ValueError("client_id и entity должны быть заданы")
+
+    conn = get_connection()
+    try:
+        _require_fingerprint_column(conn)
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT content_fingerprint
+                FROM etl_sync_state
+                WHERE client_id = %s AND entity = %s
+                """,
+                (cid, ent),
+            )
+            row = cur.fetchone()
+    finally:
+        conn.close()
+    return str(row[0]) if row and row[0] else None
+
+
+def save_content_fingerprint(client_id: int, entity: str, fingerprint: str) -> None:
+    """
+    Сохраняет хэш загруженного содержимого и отмечает успешный прогон (last_success_at, last_error = NULL).
+    Вызывать только после успешной загрузки в ClickHouse.
+    """
+    cid = int(client_id)
+    ent = (entity or "").strip()
+    if cid <= 0 or not ent:
+        raise ValueError("client_id и entity должны быть заданы")
+
+    conn = get_connection()
+    try:
+        _require_fingerprint_column(conn)
+        with conn.cursor() as cur:
+            now = _utcnow()
+            cur.execute(
+                """
+                INSERT INTO etl_sync_state (client_id, entity, content_fingerprint, last_success_at, last_error)
+                VALUES (%s, %s, %s, %s, NULL)
+                ON CONFLICT (client_id, entity) DO UPDATE SET
+                    content_fingerprint = EXCLUDED.content_fingerprint,
+                    last_success_at = EXCLUDED.last_success_at,
+                    last_error = NULL
+                """,
+                (cid, ent, fingerprint, now),
+            )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def main(argv: list[str] | None = None) -> None:
+    p = argparse.ArgumentParser(description="Схема etl_sync_state (PostgreSQL).")
+    p.add_argument("--setup", action="store_true", help="Добавить недостающие колонки (content_fingerprint)")
+    args = p.parse_args(argv)
+    if not args.setup:
+        p.error("укажите --setup")
+    setup_schema()
+    print("OK. etl_sync_state: колонка content_fingerprint на месте")
+
+
+if __name__ == "__main__":
+    main()
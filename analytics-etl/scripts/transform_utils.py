@@ -1,3 +1,5 @@
+import functools
+import os
 import re
 import html
 from typing import Any, Dict, List, Tuple
@@ -7,6 +9,79 @@ TAG_RE = re.compile(r"<[^>]+>")
 PHONE_RE = re.compile(r"\+?\d[\d\s\-\(\)]{8,}\d")
 
 
+def _cache_size_from_env() -> int:
+    """
+    Размер LRU-кэша каждой функции нормализации (clean_text, fix_mojibake, normalize_phone,
+    parse_name_fields). Env: ETL_NORMALIZE_CACHE_SIZE (целое, 0 — без кэша). По умолчанию 100000.
+    """
+    raw = (os.getenv("ETL_NORMALIZE_CACHE_SIZE") or "").strip()
+    if not raw:
+        return 100_000
+    try:
+        return max(0, int(raw))
+    except ValueError as e:
+        raise ValueError(f"ETL_NORMALIZE_CACHE_SIZE должен быть целым числом, получено: {raw!r}") from e
+
+
+NORMALIZE_CACHE_SIZE = _cache_size_from_env()
+# длиннее — свободный текст (комментарии, описания, переписка в полях): не повторяется и раздувал бы
+# кэш в байтах при ограничении только по числу записей, поэтому считается без кэша
+CACHE_MAX_LEN = 256
+_NORMALIZERS: Dict[str, Any] = {}
+
+
+def _memoized(name: str):
+    """
+    LRU-кэш чистой функции нормализации: теги, названия полей, источники, префиксы name повторяются
+    от лида к лиду, и повтор — поиск в словаре вместо прохода регулярками. Общий на процесс.
+    Возвращает кэширующую копию; исходная функция остаётся для строк длиннее CACHE_MAX_LEN.
+    """
+
+    def decorate(fn):
+        cached = functools.lru_cache(maxsize=NORMALIZE_CACHE_SIZE)(fn)
+        _NORMALIZERS[name] = cached
+        return cached
+
+    return decorate
+
+
+def normalizer_cache_stats(
+    since: Dict[str, Tuple[int, int, int, int]] | None = None,
+) -> Dict[str, Tuple[int, int, int, int]]:
+    """
+    name → (hits, misses, currsize, maxsize) кэшей нормализации текущего процесса. since — снимок
+    на начало запуска: hits / misses считаются от него (кэш общий на процесс, in-process шаги
+    run_pipeline и воркеры после fork наследуют счётчики).
+    """
+    out = {}
+    for name, fn in _NORMALIZERS.items():
+        info = fn.cache_info()
+        h0, m0, _, _ = (since or {}).get(name, (0, 0, 0, 0))
+        out[name] = (info.hits - h0, info.misses - m0, info.currsize, info.maxsize or 0)
+    return out
+
+
+def merge_normalizer_stats(snapshots: List[Dict[str, Tuple[int, int, int, int]]]) -> Dict[str, Tuple[int, int, int, int]]:
+    """Сумма снимков normalizer_cache_stats (воркеры преобразования)."""
+    out: Dict[str, Tuple[int, int, int, int]] = {}
+    for snap in snapshots:
+        for name, (hits, misses, size, maxsize) in snap.items():
+            h, m, sz, mx = out.get(name, (0, 0, 0, 0))
+            out[name] = (h + hits, m + misses, sz + size, mx + maxsize)
+    return out
+
+
+def format_normalizer_stats(stats: Dict[str, Tuple[int, int, int, int]] | None = None) -> str:
+    """Строка для лога: доля попаданий и заполненность кэша по каждой функции."""
+    stats = normalizer_cache_stats() if stats is None else stats
+    parts = []
+    for name, (hits, misses, size, maxsize) in stats.items():
+        calls = hits + misses
+        ratio = f"{hits / calls:.0%}" if calls else "-"
+        parts.append(f"{name} {ratio} ({hits}/{calls}, размер {size}/{maxsize})")
+    return "Кэш нормализации: " + ", ".join(parts)
+
+
 def fix_mojibake(s: str) -> str:
     """
     Чинит многоходовые кракозябры ('Ð...', 'Ñ...') в несколько проходов.
@@ -14,7 +89,10 @@ def fix_mojibake(s: str) -> str:
     """
     if not isinstance(s, str) or not s:
         return s
+    return _fix_mojibake_cached(s) if len(s) <= CACHE_MAX_LEN else _fix_mojibake(s)
+
 
+def _fix_mojibake(s: str) -> str:
     for _ in range(3):
         if "Ð" not in s and "Ñ" not in s:
             break
@@ -29,6 +107,9 @@ def fix_mojibake(s: str) -> str:
     return s
 
 
+_fix_mojibake_cached = _memoized("fix_mojibake")(_fix_mojibake)
+
+
 def clean_text(s: str) -> str:
     """
     Убираем HTML-теги/сущности, нормализуем пробелы, лечим кракозябры.
@@ -36,7 +117,10 @@ def clean_text(s: str) -> str:
     """
     if not isinstance(s, str):
         return s
+    return _clean_text_cached(s) if len(s) <= CACHE_MAX_LEN else _clean_text(s)
+
 
+def _clean_text(s: str) -> str:
     s = html.unescape(s)
     s = TAG_RE.sub(" ", s)
     s = s.replace("\r", " ").replace("\n", " ")
@@ -45,11 +129,18 @@ def clean_text(s: str) -> str:
     return s
 
 
+_clean_text_cached = _memoized("clean_text")(_clean_text)
+
+
 def normalize_phone(raw: str) -> str:
     """
     Приводит телефон к виду +7XXXXXXXXXX (если похоже на РФ),
     иначе возвращает просто цифры (как в текущих скриптах).
     """
+    return _normalize_phone_cached(raw) if len(raw) <= CACHE_MAX_LEN else _normalize_phone(raw)
+
+
+def _normalize_phone(raw: str) -> str:
     raw = clean_text(raw)
     digits = re.sub(r"\D", "", raw)
     if not digits:
@@ -64,6 +155,9 @@ def normalize_phone(raw: str) -> str:
     return digits
 
 
+_normalize_phone_cached = _memoized("normalize_phone")(_normalize_phone)
+
+
 def parse_name_fields(name: str) -> Tuple[str, str, str]:
     """
     Разбор поля name:
@@ -72,6 +166,10 @@ def parse_name_fields(name: str) -> Tuple[str, str, str]:
     - name_clean (без префиксов CRM и телефона)
     Поведение совпадает с реализацией в leads_json_to_datalens_csv.py.
     """
+    return _parse_name_fields_cached(name) if len(name) <= CACHE_MAX_LEN else _parse_name_fields(name)
+
+
+def _parse_name_fields(name: str) -> Tuple[str, str, str]:
     name = clean_text(name)
     low = name.lower()
 
@@ -106,65 +204,91 @@ def parse_name_fields(name: str) -> Tuple[str, str, str]:
     return channel, phone_from_name, name_clean
 
 
-def extract_utm(custom_fields_values: Any) -> Dict[str, str]:
+_parse_name_fields_cached = _memoized("parse_name_fields")(_parse_name_fields)
+
+
+CUSTOM_FIELD_KEYS = (
+    "phone",
+    "email",
+    "source",
+    "utm_source",
+    "utm_medium",
+    "utm_campaign",
+    "utm_content",
+    "utm_term",
+)
+_UTM_KEYS = ("utm_source", "utm_medium", "utm_campaign", "utm_content", "utm_term")
+_CODE_KEYS = {"PHONE": "phone", "EMAIL": "email"}
+
+# роли кастомного поля: группы ключей строки, значение пишется в первый ещё пустой ключ группы
+FieldRoles = Tuple[Tuple[str, ...], ...]
+
+
+def field_roles(code: Any, name: str) -> FieldRoles:
+    """
+    Роли поля по field_code и очищенному field_name: PHONE / EMAIL — по коду, UTM и source — по
+    подстроке в названии (название, где встречается несколько utm_*, заполняет первый пустой).
+    Поле с кодом PHONE / EMAIL смотрит на название, только когда phone / email уже заполнен.
+    """
+    roles = []
+    code_key = _CODE_KEYS.get((code or "").upper())
+    if code_key:
+        roles.append((code_key,))
+    lname = name.lower()
+    utm = tuple(k for k in _UTM_KEYS if k in lname)
+    if utm:
+        roles.append(utm)
+    if "источник" in lname or lname == "source":
+        roles.append(("source",))
+    return tuple(roles)
+
+
+def _join_values(values: List[Dict[str, Any]] | None) -> str:
+    arr: List[str] = []
+    for v in values or []:
+        val = v.get("value")
+        if val is None:
+            continue
+        arr.append(clean_text(str(val)))
+    return "; ".join([x for x in arr if x])
+
+
+def extract_utm(
+    custom_fields_values: Any,
+    *,
+    fields: Any = None,
+) -> Dict[str, str]:
     """
     Достаёт phone/email по field_code и UTM/source по названию поля.
     Поведение идентично extract_custom_fields из leads_json_to_datalens_csv.py.
+    fields — индекс полей клиента
+    (custom_fields.FieldIndex): роль поля берётся по field_id, без разбора названия;
+    значения полей без роли не очищаются.
     """
-    out: Dict[str, str] = {
-        "phone": "",
-        "email": "",
-        "source": "",
-        "utm_source": "",
-        "utm_medium": "",
-        "utm_campaign": "",
-        "utm_content": "",
-        "utm_term": "",
-    }
+    out: Dict[str, str] = {k: "" for k in CUSTOM_FIELD_KEYS}
 
     if not custom_fields_values:
         return out
 
-    def join_values(values: List[Dict[str, Any]] | None) -> str:
-        arr: List[str] = []
-        for v in values or []:
-            val = v.get("value")
-            if val is None:
-                continue
-            arr.append(clean_text(str(val)))
-        return "; ".join([x for x in arr if x])
-
     for field in custom_fields_values:
-        code = (field.get("field_code") or "").upper()
-        name = clean_text(field.get("field_name") or "")
-        value_str = join_values(field.get("values"))
-
-        if not value_str:
-            continue
-
-        if code == "PHONE" and not out["phone"]:
-            out["phone"] = normalize_phone(value_str)
+        if fields is not None:
+            roles = fields.roles(field)
+        else:
+            roles = field_roles(field.get("field_code"), clean_text(field.get("field_name") or ""))
+        if not roles:
             continue
 
-        if code == "EMAIL" and not out["email"]:
-            out["email"] = value_str
+        value_str = _join_values(field.get("values"))
+        if not value_str:
             continue
 
-        lname = name.lower()
-
-        if "utm_source" in lname and not out["utm_source"]:
-            out["utm_source"] = value_str
-        elif "utm_medium" in lname and not out["utm_medium"]:
-            out["utm_medium"] = value_str
-        elif "utm_campaign" in lname and not out["utm_campaign"]:
-            out["utm_campaign"] = value_str
-        elif "utm_content" in lname and not out["utm_content"]:
-            out["utm_content"] = value_str
-        elif "utm_term" in lname and not out["utm_term"]:
-            out["utm_term"] = value_str
-
-        if (("источник" in lname) or (lname == "source")) and not out["source"]:
-            out["source"] = value_str
+        for group in roles:
+            key = next((k for k in group if not out[k]), None)
+            if key is None:
+                continue
+            out[key] = normalize_phone(value_str) if key == "phone" else value_str
+            if key in ("phone", "email"):
+                break
 
     return out
 
@@ -8,7 +8,7 @@ WITH
 SELECT
   source,
   count() AS cnt
-FROM default_db.leads_fact
+FROM default_db.leads_current FINAL
 WHERE client_id = {client_id:UInt32}
   AND pipeline_id = {pipeline_id:UInt32}
   AND toDate(created_at, tz) = d
@@ -10,7 +10,7 @@ SELECT
   countIf(status_id = 142) AS won_cnt,
   ifNull(sumIf(price, status_id = 142 AND price > 0), 0) AS won_sum,
   countIf(status_id = 143) AS lost_cnt
-FROM default_db.leads_fact
+FROM default_db.leads_current FINAL
 WHERE client_id = {client_id:UInt32}
   AND pipeline_id = {pipeline_id:UInt32}
   AND closed_at IS NOT NULL
@@ -7,7 +7,7 @@ WITH
 SELECT
   ifNull(sumIf(price, status_id = 143 AND price > 0), 0) AS lost_sum,
   countIf(status_id = 143 AND (price IS NULL OR price <= 0)) AS lost_budget_unknown_cnt
-FROM default_db.leads_fact
+FROM default_db.leads_current FINAL
 WHERE client_id = {client_id:UInt32}
   AND pipeline_id = {pipeline_id:UInt32}
   AND closed_at IS NOT NULL
@@ -15,7 +15,7 @@ FROM
     coalesce(lr.loss_reason_name, 'Причина не найдена в справочнике') AS reason,
     count() AS cnt,
     ifNull(sumIf(l.price, l.price > 0), 0) AS sum_price
-  FROM default_db.leads_fact l
+  FROM default_db.leads_current AS l FINAL
   LEFT JOIN default_db.loss_reasons_dim_v2 lr
     ON l.client_id = lr.client_id
    AND l.loss_reason_id = lr.loss_reason_id
@@ -35,7 +35,7 @@ FROM
     'Причины отказов не заполнены' AS reason,
     count() AS cnt,
     ifNull(sumIf(price, price > 0), 0) AS sum_price
-  FROM default_db.leads_fact
+  FROM default_db.leads_current FINAL
   WHERE client_id = {client_id:UInt32}
     AND pipeline_id = {pipeline_id:UInt32}
     AND closed_at IS NOT NULL
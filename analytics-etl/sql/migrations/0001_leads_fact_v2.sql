@@ -0,0 +1,56 @@
+/* 0001_leads_fact_v2.sql
+   Факт лидов: строка на каждую версию лида (снимок при загрузке).
+
+   PARTITION BY (client_id, месяц created_at):
+     - партиция целиком принадлежит одному клиенту — полная перезапись клиента идёт через
+       REPLACE PARTITION (clickhouse_db.swap_client_partitions);
+     - created_at у лида не меняется, поэтому все версии лида лежат в одной партиции.
+   ORDER BY (client_id, pipeline_id, lead_id, version):
+     - отчёты фильтруют client_id + pipeline_id — читаются только нужные гранулы;
+     - version в ключе: ReplacingMergeTree схлопывает только одинаковые версии (повторная загрузка
+       того же снимка в overlap), история версий сохраняется. Последняя версия — в leads_current (0003).
+   LowCardinality — для повторяющихся строк (source, channel, utm_*), Delta+ZSTD — для дат.
+   Skip-индексы — под предикаты отчётов: status_id IN (142, 143) и дата closed_at.
+*/
+CREATE TABLE IF NOT EXISTS {db}.leads_fact_v2
+(
+    client_id        UInt32,
+    lead_id          UInt64,
+    created_at       Nullable(DateTime) CODEC(Delta, ZSTD(1)),
+    updated_at       Nullable(DateTime) CODEC(Delta, ZSTD(1)),
+    closed_at        Nullable(DateTime) CODEC(Delta, ZSTD(1)),
+    created_dt       Nullable(DateTime) CODEC(Delta, ZSTD(1)),
+    updated_dt       Nullable(DateTime) CODEC(Delta, ZSTD(1)),
+    closed_dt        Nullable(DateTime) CODEC(Delta, ZSTD(1)),
+    status_id        Nullable(UInt32),
+    pipeline_id      UInt32,
+    loss_reason_id   Nullable(UInt32),
+    price            Nullable(Float64) CODEC(ZSTD(1)),
+    account_id       Nullable(UInt32),
+    created_by       Nullable(UInt32),
+    updated_by       Nullable(UInt32),
+    score            Nullable(Float64) CODEC(ZSTD(1)),
+    manager_id       Nullable(UInt32),
+    is_deleted       UInt8,
+    client_slug      LowCardinality(String),
+    name             Nullable(String) CODEC(ZSTD(3)),
+    utm_source       LowCardinality(Nullable(String)),
+    utm_medium       LowCardinality(Nullable(String)),
+    utm_campaign     LowCardinality(Nullable(String)),
+    utm_content      LowCardinality(Nullable(String)),
+    utm_term         LowCardinality(Nullable(String)),
+    source           LowCardinality(Nullable(String)),
+    phone            Nullable(String) CODEC(ZSTD(3)),
+    email            Nullable(String) CODEC(ZSTD(3)),
+    channel          LowCardinality(Nullable(String)),
+    phone_from_name  Nullable(String) CODEC(ZSTD(3)),
+    name_clean       Nullable(String) CODEC(ZSTD(3)),
+    etl_loaded_at    DateTime CODEC(Delta, ZSTD(1)),
+    version          DateTime CODEC(Delta, ZSTD(1)),
+
+    INDEX idx_status_id status_id TYPE set(64) GRANULARITY 4,
+    INDEX idx_closed_at closed_at TYPE minmax GRANULARITY 1
+)
+ENGINE = ReplacingMergeTree(version)
+PARTITION BY (client_id, toYYYYMM(assumeNotNull(created_at)))
+ORDER BY (client_id, pipeline_id, lead_id, version);
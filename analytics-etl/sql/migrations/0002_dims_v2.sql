@@ -0,0 +1,36 @@
+/* 0002_dims_v2.sql
+   Справочники статусов и причин отказа.
+   PARTITION BY client_id: справочник клиента — одна партиция, её можно подменить целиком.
+   ReplacingMergeTree по ключу справочника: повторная вставка того же набора не плодит дубли.
+*/
+CREATE TABLE IF NOT EXISTS {db}.statuses_dim_v2
+(
+    client_id      UInt32,
+    client_slug    LowCardinality(String),
+    pipeline_id    UInt32,
+    pipeline_name  LowCardinality(String),
+    status_id      UInt32,
+    status_name    String,
+    sort           Int32,
+    is_final       UInt8,
+    is_won         UInt8,
+    is_lost        UInt8,
+    updated_at     DateTime
+)
+ENGINE = ReplacingMergeTree(updated_at)
+PARTITION BY client_id
+ORDER BY (client_id, pipeline_id, status_id);
+
+CREATE TABLE IF NOT EXISTS {db}.loss_reasons_dim_v2
+(
+    client_id         UInt32,
+    client_slug       LowCardinality(String),
+    loss_reason_id    UInt32,
+    loss_reason_name  String,
+    created_at        Nullable(DateTime),
+    updated_at        Nullable(DateTime),
+    sort              Int32
+)
+ENGINE = ReplacingMergeTree
+PARTITION BY client_id
+ORDER BY (client_id, loss_reason_id);
@@ -0,0 +1,53 @@
+/* 0003_leads_current.sql
+   Текущее состояние лидов: одна строка на (client_id, lead_id) — см. scripts/leads_current.py.
+   ORDER BY (client_id, lead_id) — ключ дедупликации (pipeline_id лида может меняться, поэтому
+   в ключ он не входит); фильтр по воронке, статусу и closed_at — через skip-индексы.
+   Первичное заполнение из факта: python scripts/leads_current.py --setup
+*/
+CREATE TABLE IF NOT EXISTS {db}.leads_current
+(
+    client_id        UInt32,
+    lead_id          UInt64,
+    created_at       Nullable(DateTime) CODEC(Delta, ZSTD(1)),
+    updated_at       Nullable(DateTime) CODEC(Delta, ZSTD(1)),
+    closed_at        Nullable(DateTime) CODEC(Delta, ZSTD(1)),
+    created_dt       Nullable(DateTime) CODEC(Delta, ZSTD(1)),
+    updated_dt       Nullable(DateTime) CODEC(Delta, ZSTD(1)),
+    closed_dt        Nullable(DateTime) CODEC(Delta, ZSTD(1)),
+    status_id        Nullable(UInt32),
+    pipeline_id      UInt32,
+    loss_reason_id   Nullable(UInt32),
+    price            Nullable(Float64) CODEC(ZSTD(1)),
+    account_id       Nullable(UInt32),
+    created_by       Nullable(UInt32),
+    updated_by       Nullable(UInt32),
+    score            Nullable(Float64) CODEC(ZSTD(1)),
+    manager_id       Nullable(UInt32),
+    is_deleted       UInt8,
+    client_slug      LowCardinality(String),
+    name             Nullable(String) CODEC(ZSTD(3)),
+    utm_source       LowCardinality(Nullable(String)),
+    utm_medium       LowCardinality(Nullable(String)),
+    utm_campaign     LowCardinality(Nullable(String)),
+    utm_content      LowCardinality(Nullable(String)),
+    utm_term         LowCardinality(Nullable(String)),
+    source           LowCardinality(Nullable(String)),
+    phone            Nullable(String) CODEC(ZSTD(3)),
+    email            Nullable(String) CODEC(ZSTD(3)),
+    channel          LowCardinality(Nullable(String)),
+    phone_from_name  Nullable(String) CODEC(ZSTD(3)),
+    name_clean       Nullable(String) CODEC(ZSTD(3)),
+    etl_loaded_at    DateTime CODEC(Delta, ZSTD(1)),
+    version          DateTime CODEC(Delta, ZSTD(1)),
+
+    INDEX idx_pipeline_id pipeline_id TYPE set(32) GRANULARITY 4,
+    INDEX idx_status_id status_id TYPE set(64) GRANULARITY 4,
+    INDEX idx_closed_at closed_at TYPE minmax GRANULARITY 1,
+    INDEX idx_created_at created_at TYPE minmax GRANULARITY 1
+)
+ENGINE = ReplacingMergeTree(version)
+PARTITION BY client_id
+ORDER BY (client_id, lead_id);
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS {db}.leads_current_mv TO {db}.leads_current
+AS SELECT * FROM {db}.leads_fact_v2;
@@ -0,0 +1,10 @@
+/* 0004_insert_dedup_window.sql
+   Дедупликация INSERT по insert_deduplication_token (clickhouse_db.insert_block) для MergeTree без
+   репликации: ClickHouse помнит токены последних N блоков таблицы. Блок с уже виденным токеном
+   (повтор после сетевой ошибки, перезапуск пайплайна на том же окне) не вставляется.
+*/
+ALTER TABLE {db}.leads_fact_v2 MODIFY SETTING non_replicated_deduplication_window = 1000;
+
+ALTER TABLE {db}.statuses_dim_v2 MODIFY SETTING non_replicated_deduplication_window = 100;
+
+ALTER TABLE {db}.loss_reasons_dim_v2 MODIFY SETTING non_replicated_deduplication_window = 100;